@@ -0,0 +1,61 @@
+"""
+Cost of AdmissionFilter.admit per datagram, for datagrams admitted, dropped
+as malformed, from a blocked network and from a throttled source, against
+decoding the datagram with krpc.parse. Sources are seen again every round,
+as the best round is kept these are the costs once their buckets exist.
+
+Run with: python -m benchmarks.bench_admission
+"""
+
+import os
+import random
+import time
+
+from dhtpy.dht import krpc
+from dhtpy.dht.admission import AdmissionFilter
+
+DATAGRAMS = 200_000
+# A blocklist the size of the public ones
+NETWORKS = 10_000
+SOURCES = 50_000
+ROUNDS = 5
+
+PING = b"d1:ad2:id20:" + os.urandom(20) + b"e1:q4:ping1:t2:aa1:y1:qe"
+
+
+def random_host() -> str:
+    return ".".join(str(random.randrange(1, 224)) for _ in range(4))
+
+
+def bench(name: str, admit, datagrams) -> None:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for data, address in datagrams:
+            admit(data, address)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name}: {best / len(datagrams) * 1e9:,.0f} ns/datagram")
+
+
+def main():
+    random.seed(0)
+    blocklist = [f"{random_host()}/{random.randint(16, 32)}" for _ in range(NETWORKS)]
+    sources = [(random_host(), 6881) for _ in range(SOURCES)]
+    datagrams = [(PING, random.choice(sources)) for _ in range(DATAGRAMS)]
+
+    admission = AdmissionFilter(blocklist=blocklist, rate=1e9, burst=1e9)
+    bench("admitted", admission.admit, datagrams)
+    bench("malformed", admission.admit, [(b"x" + PING, a) for _, a in datagrams])
+
+    blocked = AdmissionFilter(blocklist=["0.0.0.0/0"])
+    bench("blocked", blocked.admit, datagrams)
+
+    flooding = [(PING, ("6.6.6.6", 6881))] * DATAGRAMS
+    bench("throttled", AdmissionFilter(blocklist=blocklist).admit, flooding)
+
+    krpc.ACCELERATED = False
+    bench("krpc.parse", lambda data, address: krpc.parse(data), datagrams)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Bulk insertion, closest nodes and expiry on an ArrayRoutingTable holding
+millions of neighbors, compared with decoding into a SimpleRoutingTable.
+
+Run with: python -m benchmarks.bench_array_routing
+"""
+
+import os
+import random
+import time
+
+from dhtpy.dht.array_routing import ArrayRoutingTable
+from dhtpy.dht.routing import SimpleRoutingTable
+from dhtpy.dht.utils import decode_nodes
+
+NODES = 2_000_000
+# find_node responses carry 8 nodes
+RESPONSE_SIZE = 8 * 26
+
+
+def main():
+    buffer = os.urandom(NODES * 26)
+    responses = [
+        buffer[i : i + RESPONSE_SIZE] for i in range(0, len(buffer), RESPONSE_SIZE)
+    ]
+
+    routing_table = ArrayRoutingTable(max_size=NODES)
+    start = time.perf_counter()
+    for response in responses:
+        routing_table.add_compact(response)
+    elapsed = time.perf_counter() - start
+    print(f"array add_compact: {len(routing_table) / elapsed:>12,.0f} nodes/s")
+
+    simple_routing_table = SimpleRoutingTable(max_size=NODES)
+    start = time.perf_counter()
+    for response in responses[:10_000]:
+        for node in decode_nodes(response):
+            simple_routing_table.add(node)
+    elapsed = time.perf_counter() - start
+    print(
+        f"simple decode+add: {len(simple_routing_table.nodes) / elapsed:>12,.0f} nodes/s"
+    )
+
+    queries = 100
+    start = time.perf_counter()
+    for _ in range(queries):
+        routing_table.get_closest_nodes(random.getrandbits(160))
+    elapsed = time.perf_counter() - start
+    print(
+        f"array closest 8 of {len(routing_table):,}: {queries / elapsed:,.1f} queries/s"
+    )
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        routing_table.get_closest_compact(random.getrandbits(160))
+    elapsed = time.perf_counter() - start
+    print(f"array closest compact: {queries / elapsed:,.1f} queries/s")
+
+    routing_table._last_contact[: len(routing_table) // 2] -= 3600
+    start = time.perf_counter()
+    removed = routing_table.remove_expired(1800)
+    elapsed = time.perf_counter() - start
+    print(f"array remove_expired: {removed:,} nodes in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Local load test of dhtpy.dht.cluster: load generator processes send ping
+queries to a cluster on the loopback and count the replies, for a growing
+number of workers.
+
+Every generator uses many sockets so SO_REUSEPORT can spread them across the
+workers. Needs as many cores as workers plus generators to show scaling.
+
+Run with: python -m benchmarks.bench_cluster
+"""
+
+import multiprocessing
+import os
+import select
+import socket
+import time
+
+from dhtpy.dht.cluster import Cluster
+
+PORT = 16881
+DURATION = 5
+GENERATORS = 2
+SOCKETS = 32
+# Queries in flight per socket
+WINDOW = 8
+PING = b"d1:ad2:id20:" + bytes(20) + b"e1:q4:ping1:t2:aa1:y1:qe"
+
+
+def generate_load(_) -> int:
+    sockets = []
+    for _ in range(SOCKETS):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.connect(("127.0.0.1", PORT))
+        sockets.append(sock)
+
+    replies = 0
+    in_flight = {sock: 0 for sock in sockets}
+    end = time.monotonic() + DURATION
+    while time.monotonic() < end:
+        for sock in sockets:
+            while in_flight[sock] < WINDOW:
+                sock.send(PING)
+                in_flight[sock] += 1
+        readable, _, _ = select.select(sockets, [], [], 0.1)
+        if not readable:
+            # Lost queries, refill the windows
+            in_flight = {sock: 0 for sock in sockets}
+        for sock in readable:
+            try:
+                while True:
+                    sock.recv(2048)
+                    replies += 1
+                    in_flight[sock] = max(0, in_flight[sock] - 1)
+            except BlockingIOError:
+                pass
+    return replies
+
+
+def main():
+    cores = os.cpu_count() or 1
+    workers = 1
+    while workers <= max(1, cores - GENERATORS):
+        cluster = Cluster(workers=workers, address="127.0.0.1", port=PORT)
+        cluster.start()
+        # Let the workers bind
+        time.sleep(2)
+        with multiprocessing.Pool(GENERATORS) as pool:
+            replies = sum(pool.map(generate_load, range(GENERATORS)))
+        cluster.stop()
+        print(f"{workers} workers: {replies / DURATION:,.0f} replies/s")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
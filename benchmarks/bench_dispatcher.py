@@ -0,0 +1,91 @@
+"""
+Dispatches per second of DHTDispatcher over the mixed message corpus of
+bench_krpc, with handlers doing nothing so only the lookup of the handler,
+the sender node and the decoding of the fields the handlers get is measured.
+
+Run with: python -m benchmarks.bench_dispatcher
+"""
+
+import random
+import time
+
+from benchmarks.bench_krpc import MESSAGES, random_message
+from dhtpy.dht import krpc
+from dhtpy.dht.dispatcher import DHTDispatcher
+from dhtpy.dht.rpc import RPC
+
+ROUNDS = 5
+ADDRESS = ("1.2.3.4", 6881)
+
+
+class NullDispatcher(DHTDispatcher):
+    def on_ping_query(self, node, data):
+        pass
+
+    def on_find_node_query(self, node, data):
+        pass
+
+    def on_get_peers_query(self, node, data):
+        pass
+
+    def on_announce_peer_query(self, node, data, port):
+        pass
+
+    def on_sample_infohashes_query(self, node, data):
+        pass
+
+    def on_ping_response(self, tid, node):
+        pass
+
+    def on_find_node_response(self, tid, nodes):
+        pass
+
+    def on_get_peers_response(self, tid, token, nodes, values):
+        pass
+
+    def on_announce_peer_response(self, tid, node):
+        pass
+
+    def on_sample_infohashes_response(self, tid, node, samples, nodes, num, interval):
+        pass
+
+
+def query_answered(message) -> bytes:
+    """The query the response answers, the transaction tells in the RPC."""
+    response = message[b"r"]
+    if b"samples" in response:
+        return b"sample_infohashes"
+    if b"token" in response:
+        return b"get_peers"
+    if b"nodes" in response:
+        return b"find_node"
+    return b"ping"
+
+
+def main():
+    random.seed(0)
+    krpc.ACCELERATED = False
+    corpus = []
+    for data in (random_message() for _ in range(MESSAGES)):
+        message = krpc.parse(data)
+        if message is not None:
+            query = query_answered(message) if message.y == b"r" else None
+            corpus.append((data, query))
+    dispatcher = NullDispatcher(RPC())
+
+    def dispatch(parsed):
+        for message, query in parsed:
+            dispatcher.on_response(message, ADDRESS, query)
+
+    best = float("inf")
+    for _ in range(ROUNDS):
+        # Messages decode their fields once, parse them again every round
+        parsed = [(krpc.parse(data), query) for data, query in corpus]
+        start = time.perf_counter()
+        dispatch(parsed)
+        best = min(best, time.perf_counter() - start)
+    print(f"{len(corpus)} messages: {len(corpus) / best:,.0f} dispatches/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Decoding speed of krpc.parse on a corpus of KRPC messages, with the lazy
+scanner and with the full decode it replaces, both the C extension of
+better_bencode when it builds and its pure Python fallback.
+
+The corpus mimics what a crawler receives: mostly get_peers and find_node
+queries and responses, some announces, pings, sample_infohashes responses
+and errors, plus a few malformed packets. A recorded corpus, datagrams each
+prefixed with their length as 2 bytes big endian, can be given instead.
+
+Run with: python -m benchmarks.bench_krpc [corpus]
+"""
+
+import os
+import random
+import sys
+import time
+from typing import Callable, List
+
+from better_bencode import _pure  # type: ignore
+
+from dhtpy.bittorrent.bencoding import decode
+from dhtpy.dht import krpc
+
+MESSAGES = 20_000
+ROUNDS = 10
+
+
+def random_message() -> bytes:
+    nid = os.urandom(20)
+    tid = os.urandom(2)
+    kind = random.random()
+    if kind < 0.3:
+        message = {
+            b"t": tid,
+            b"y": b"q",
+            b"q": b"get_peers",
+            b"a": {b"id": nid, b"info_hash": os.urandom(20)},
+        }
+    elif kind < 0.5:
+        message = {
+            b"t": tid,
+            b"y": b"q",
+            b"q": b"find_node",
+            b"a": {b"id": nid, b"target": os.urandom(20)},
+        }
+    elif kind < 0.75:
+        message = {
+            b"t": tid,
+            b"y": b"r",
+            b"r": {b"id": nid, b"nodes": os.urandom(26 * 8), b"token": os.urandom(8)},
+        }
+    elif kind < 0.8:
+        message = {
+            b"t": tid,
+            b"y": b"r",
+            b"r": {
+                b"id": nid,
+                b"token": os.urandom(8),
+                b"values": [os.urandom(6) for _ in range(random.randint(1, 50))],
+            },
+        }
+    elif kind < 0.85:
+        message = {
+            b"t": tid,
+            b"y": b"q",
+            b"q": b"announce_peer",
+            b"a": {
+                b"id": nid,
+                b"implied_port": 1,
+                b"info_hash": os.urandom(20),
+                b"port": 6881,
+                b"token": os.urandom(8),
+            },
+        }
+    elif kind < 0.9:
+        message = {b"t": tid, b"y": b"q", b"q": b"ping", b"a": {b"id": nid}}
+    elif kind < 0.95:
+        message = {
+            b"t": tid,
+            b"y": b"r",
+            b"r": {
+                b"id": nid,
+                b"interval": 21600,
+                b"nodes": os.urandom(26 * 8),
+                b"num": 1000,
+                b"samples": os.urandom(20 * 20),
+            },
+        }
+    elif kind < 0.98:
+        message = {b"t": tid, b"y": b"e", b"e": [203, b"Protocol Error"]}
+    else:
+        return os.urandom(random.randint(1, 200))
+    message[b"v"] = b"LT\x01\x02"
+    return _pure.dumps(message)
+
+
+def load_corpus(path: str) -> List[bytes]:
+    with open(path, "rb") as f:
+        data = f.read()
+    corpus, i = [], 0
+    while i < len(data):
+        size = int.from_bytes(data[i : i + 2], "big")
+        corpus.append(data[i + 2 : i + 2 + size])
+        i += 2 + size
+    return corpus
+
+
+def bench(name: str, decoder: Callable[[bytes], object], corpus: List[bytes]):
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for data in corpus:
+            try:
+                decoder(data)
+            except Exception:
+                pass
+        best = min(best, time.perf_counter() - start)
+    print(f"{name}: {best / len(corpus) * 1e6:.2f} us/message")
+
+
+def main():
+    if len(sys.argv) > 1:
+        corpus = load_corpus(sys.argv[1])
+    else:
+        random.seed(0)
+        corpus = [random_message() for _ in range(MESSAGES)]
+    print(f"{len(corpus)} messages, {sum(map(len, corpus)) / len(corpus):.0f} bytes")
+
+    krpc.ACCELERATED = False
+    bench("krpc.parse, scanner", krpc.parse, corpus)
+    bench("krpc.scan", krpc.scan, corpus)
+    bench("better_bencode pure", _pure.loads, corpus)
+    try:
+        decode(corpus[0])
+    except Exception:
+        print("better_bencode C extension: not available")
+    else:
+        krpc.ACCELERATED = True
+        bench("krpc.parse, C extension", krpc.parse, corpus)
+        bench("better_bencode", decode, corpus)
+
+
+if __name__ == "__main__":
+    main()
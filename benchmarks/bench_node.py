@@ -0,0 +1,102 @@
+"""
+Compares the slotted, integer keyed ``Node`` against the previous dataclass
+based implementation: memory per node and add/lookup throughput.
+
+Run with: python -m benchmarks.bench_node
+"""
+
+from __future__ import annotations
+
+import os
+import struct
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+from socket import inet_ntoa
+from typing import Callable, List
+
+from dhtpy.dht.structures import Bucket, Node
+
+NODES = 200_000
+
+
+@dataclass
+class LegacyNode:
+    """The dataclass based node as it was before the slotted implementation."""
+
+    id: str
+    address: str
+    port: int
+    added: datetime = datetime.now()
+    last_contact: datetime = datetime.now()
+
+    def __hash__(self) -> int:
+        return hash(self.id + self.address + str(self.port))
+
+    @property
+    def id_bytes(self) -> bytes:
+        return bytes.fromhex(self.id)
+
+    @property
+    def compact_info(self) -> bytes:
+        return struct.pack(
+            "!20s4sH", self.id_bytes, bytes(self.address.encode("ascii")), self.port
+        )
+
+
+def legacy_in_range(bucket: Bucket, nid: str) -> bool:
+    return bucket.start_bytes <= bytes.fromhex(nid) < bucket.end_bytes
+
+
+def measure_memory(factory: Callable[[int], object]) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    nodes = [factory(i) for i in range(NODES)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # The list itself is not part of the node footprint
+    return (after - before - 8 * len(nodes)) / len(nodes)
+
+
+def timeit(label: str, function: Callable[[], object]) -> None:
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<24} {NODES / elapsed:>14,.0f} ops/s")
+
+
+def main():
+    ids = [os.urandom(20) for _ in range(NODES)]
+    packed_addresses = [(0x0A000000 + i).to_bytes(4, "big") for i in range(NODES)]
+    addresses = [inet_ntoa(address) for address in packed_addresses]
+
+    # Build the ids and addresses the way decode_nodes does, so each node owns
+    # its own strings
+    def legacy_factory(i: int) -> LegacyNode:
+        return LegacyNode(ids[i].hex(), inet_ntoa(packed_addresses[i]), 6881)
+
+    def node_factory(i: int) -> Node:
+        return Node(ids[i], addresses[i], 6881)
+
+    def compact_factory(i: int) -> Node:
+        return Node.from_compact(ids[i] + packed_addresses[i] + b"\x1a\xe1")
+
+    bucket = Bucket()
+    for label, factory, in_range in (
+        ("dataclass", legacy_factory, lambda n: legacy_in_range(bucket, n.id)),
+        ("slots", node_factory, lambda n: bucket.in_range(n.nid)),
+        ("slots (from_compact)", compact_factory, lambda n: bucket.in_range(n.nid)),
+    ):
+        print(f"{label}: {measure_memory(factory):.0f} bytes/node")
+
+        nodes: List = [factory(i) for i in range(NODES)]
+        table: set = set()
+        timeit("set add", lambda: [table.add(node) for node in nodes])
+        timeit("set lookup", lambda: [node in table for node in nodes])
+        timeit("compact_info", lambda: [node.compact_info for node in nodes])
+        timeit("bucket in_range", lambda: [in_range(node) for node in nodes])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Metadata fetches per second of MetadataWorker, reading messages with
+StreamReader, against MetadataProtocol, parsing them out of its receive
+buffer.
+
+Peers are simulated by a local server answering the requests at once with
+messages built beforehand, so the cost measured is the one of the clients.
+
+Run with: python -m benchmarks.bench_protocol
+"""
+
+import asyncio
+import hashlib
+import time
+
+import better_bencode  # type: ignore
+from better_bencode import _pure  # type: ignore
+
+from dhtpy.bittorrent.bencoding import encode
+from dhtpy.bittorrent.constants import BT_PROTOCOL_PREFIX
+from dhtpy.bittorrent.metadata import MetadataWorker
+from dhtpy.bittorrent.protocol import MetadataProtocol
+
+PIECE_SIZE = 2 ** 14
+FETCHES = 200
+CONCURRENCY = 50
+ROUNDS = 5
+
+
+def frame(message: bytes) -> bytes:
+    return len(message).to_bytes(4, "big") + message
+
+
+class FakePeer(asyncio.Protocol):
+    """Sends its handshakes, then every piece requested."""
+
+    def __init__(self, infohash: bytes, handshakes: bytes, pieces: dict):
+        self.infohash = infohash
+        self.handshakes = handshakes
+        self.pieces = pieces
+        self.buffer = b""
+        self.handshaked = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        if not self.handshaked:
+            if len(self.buffer) < 68:
+                return
+            self.buffer = self.buffer[68:]
+            self.handshaked = True
+            self.transport.write(self.handshakes)
+        while len(self.buffer) >= 4:
+            length = int.from_bytes(self.buffer[:4], "big")
+            if len(self.buffer) < 4 + length:
+                return
+            message, self.buffer = (
+                self.buffer[4 : 4 + length],
+                self.buffer[4 + length :],
+            )
+            if message[:2] == bytes([20, 3]):
+                self.transport.write(self.pieces[_pure.loads(message[2:])[b"piece"]])
+
+
+async def serve(metadata: bytes):
+    infohash = hashlib.sha1(metadata).digest()
+    handshakes = (
+        BT_PROTOCOL_PREFIX
+        + infohash
+        + b"-XX0000-000000000000"
+        + frame(
+            bytes([20, 0])
+            + _pure.dumps({b"m": {b"ut_metadata": 3}, b"metadata_size": len(metadata)})
+        )
+    )
+    pieces = {}
+    for piece in range(0, (len(metadata) + PIECE_SIZE - 1) // PIECE_SIZE):
+        header = _pure.dumps(
+            {b"msg_type": 1, b"piece": piece, b"total_size": len(metadata)}
+        )
+        data = metadata[piece * PIECE_SIZE : (piece + 1) * PIECE_SIZE]
+        pieces[piece] = frame(bytes([20, 1]) + header + data)
+
+    server = await asyncio.get_running_loop().create_server(
+        lambda: FakePeer(infohash, handshakes, pieces), "127.0.0.1", 0
+    )
+    return server, infohash
+
+
+async def run(worker_class, metadata: bytes) -> float:
+    server, infohash = await serve(metadata)
+    address = server.sockets[0].getsockname()[:2]
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def fetch():
+        async with semaphore:
+            worker = worker_class(
+                infohash, address, max_metadata_size=len(metadata) + 1
+            )
+            assert await worker.work() == metadata
+
+    start = time.perf_counter()
+    await asyncio.gather(*(fetch() for _ in range(FETCHES)))
+    elapsed = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    return elapsed
+
+
+def main():
+    try:
+        encode({})
+    except Exception:
+        print("better_bencode C extension: not available, using the pure one")
+        for name in ("dumps", "loads", "load"):
+            setattr(better_bencode, name, getattr(_pure, name))
+
+    for size in (20_000, 1_000_000):
+        metadata = _pure.dumps({b"name": b"bench", b"pieces": b"x" * size})
+        print(f"metadata of {len(metadata):,} bytes")
+        for worker_class in (MetadataWorker, MetadataProtocol):
+            best = min(asyncio.run(run(worker_class, metadata)) for _ in range(ROUNDS))
+            print(
+                f"  {worker_class.__name__}: {FETCHES / best:,.0f} fetches/s, "
+                f"{len(metadata) * FETCHES / best / 1e6:,.0f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
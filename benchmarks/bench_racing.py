@@ -0,0 +1,134 @@
+"""
+Time to metadata and connections opened per fetch for peers connected to
+all at once, as the scheduler did before racing, against staggered racing
+with the stagger it used to have and with the default one.
+
+Peers are simulated: some connect and send the metadata after a short
+while, some refuse the connection, some never answer the SYN until the
+connect timeout and some connect but never send the handshake. Every
+infohash is announced by a handful of them at once, either picked at random
+or with the first ones blackholed. Durations are scaled down by SCALE and
+reported unscaled.
+
+Run with: python -m benchmarks.bench_racing
+"""
+
+import asyncio
+import random
+import statistics
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+
+from dhtpy.bittorrent import metadata
+from dhtpy.bittorrent.metadata import FetchScheduler
+from dhtpy.config import (
+    METADATA_CONNECT_TIMEOUT,
+    METADATA_HANDSHAKE_TIMEOUT,
+    METADATA_RACE_STAGGER,
+)
+
+INFOHASHES = 200
+PEERS_PER_INFOHASH = 5
+BLACKHOLED_PEERS = 2
+SCALE = 0.1
+PREVIOUS_STAGGER = 2.0
+
+# Kinds of peers, the port of their address
+HEALTHY, REFUSING, BLACKHOLED, SILENT = range(4)
+
+
+async def fake_fetch_metadata(
+    infohash,
+    peer_address,
+    max_metadata_size,
+    on_worker_done=None,
+    worker_class=None,
+    on_worker_started=None,
+):
+    worker = SimpleNamespace(stage=metadata.STAGE_CONNECT)
+    if on_worker_started is not None:
+        on_worker_started(worker)
+
+    kind = peer_address[1]
+    if kind == BLACKHOLED:
+        await asyncio.sleep(METADATA_CONNECT_TIMEOUT * SCALE)
+        return None
+    # A round trip to connect
+    await asyncio.sleep(random.uniform(0.03, 0.1) * SCALE)
+    if kind == REFUSING:
+        return None
+    worker.stage = metadata.STAGE_HANDSHAKE
+    if kind == SILENT:
+        await asyncio.sleep(METADATA_HANDSHAKE_TIMEOUT * SCALE)
+        return None
+    await asyncio.sleep(random.uniform(0.1, 0.3) * SCALE)
+    return b"metadata"
+
+
+def mixed(index: int) -> int:
+    return random.choices(
+        (HEALTHY, REFUSING, BLACKHOLED, SILENT), weights=(4, 3, 2, 1)
+    )[0]
+
+
+def blackholed_first(index: int) -> int:
+    return BLACKHOLED if index < BLACKHOLED_PEERS else HEALTHY
+
+
+async def run(stagger: float, kind_of):
+    scheduler = FetchScheduler(
+        max_connections=100_000,
+        max_connections_per_ip=100_000,
+        max_queued=INFOHASHES,
+        stagger=stagger * SCALE,
+    )
+    submitted: Dict[bytes, float] = {}
+    times: List[float] = []
+    finished = asyncio.get_running_loop().create_future()
+
+    def on_done(infohash, data):
+        if data:
+            times.append((time.monotonic() - submitted[infohash]) / SCALE)
+        del submitted[infohash]
+        if not submitted:
+            finished.set_result(None)
+
+    scheduler.on_done = on_done
+    for i in range(INFOHASHES):
+        infohash = i.to_bytes(20, "big")
+        submitted[infohash] = time.monotonic()
+        for j in range(PEERS_PER_INFOHASH):
+            scheduler.submit(infohash, (f"10.{i >> 8}.{i & 255}.{j}", kind_of(j)))
+    await finished
+    # Let the cancelled connections finish
+    await asyncio.sleep(0.01)
+    return times, scheduler.stats
+
+
+def main():
+    metadata.fetch_metadata = fake_fetch_metadata
+    for scenario, kind_of in (
+        ("mixed peers", mixed),
+        (f"first {BLACKHOLED_PEERS} peers blackholed", blackholed_first),
+    ):
+        print(f"{scenario}:")
+        for name, stagger in (
+            ("all at once", 0.0),
+            (f"stagger {PREVIOUS_STAGGER * 1000:.0f} ms", PREVIOUS_STAGGER),
+            (f"stagger {METADATA_RACE_STAGGER * 1000:.0f} ms", METADATA_RACE_STAGGER),
+        ):
+            random.seed(0)
+            times, stats = asyncio.run(run(stagger, kind_of))
+            print(
+                f"  {name}: median time to metadata "
+                f"{statistics.median(times) * 1000:.0f} ms, "
+                f"p90 {statistics.quantiles(times, n=10)[-1] * 1000:.0f} ms, "
+                f"{stats['started'] / stats['succeeded']:.2f} connections per fetch, "
+                f"{stats['cancelled']} cancelled, "
+                f"{stats['succeeded']}/{INFOHASHES} fetched"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Replies per second built by ResponseBuilder against encoding the equivalent
+dict, with better_bencode's C extension when it builds and its pure Python
+fallback.
+
+Run with: python -m benchmarks.bench_responses
+"""
+
+import os
+import time
+from typing import Callable, Dict
+
+from better_bencode import _pure  # type: ignore
+
+from dhtpy.bittorrent.bencoding import encode
+from dhtpy.dht.responses import ResponseBuilder
+
+REPLIES = 100_000
+
+NID = os.urandom(20)
+TID = os.urandom(2)
+TOKEN = os.urandom(2)
+NODES = os.urandom(26 * 8)
+VALUES = [os.urandom(6) for _ in range(20)]
+
+
+# The dicts the handlers built for every reply
+DICTS: Dict[str, Callable[[], dict]] = {
+    "ping": lambda: {b"t": TID, b"y": b"r", b"r": {b"id": NID}},
+    "find_node": lambda: {b"t": TID, b"y": b"r", b"r": {b"id": NID, b"nodes": NODES}},
+    "get_peers": lambda: {
+        b"t": TID,
+        b"y": b"r",
+        b"r": {b"id": NID, b"token": TOKEN, b"values": VALUES},
+    },
+}
+
+
+def bench(name: str, build: Callable[[], bytes]) -> None:
+    start = time.perf_counter()
+    for _ in range(REPLIES):
+        build()
+    elapsed = time.perf_counter() - start
+    print(f"  {name}: {REPLIES / elapsed:,.0f} replies/s")
+
+
+def main():
+    responses = ResponseBuilder(NID)
+    templates = {
+        "ping": lambda: responses.ping(TID),
+        "find_node": lambda: responses.find_node(TID, NODES),
+        "get_peers": lambda: responses.get_peers(TID, TOKEN, VALUES),
+    }
+    try:
+        encode({})
+        encoders = {"encode": encode, "pure encode": _pure.dumps}
+    except Exception:
+        print("better_bencode C extension: not available")
+        encoders = {"pure encode": _pure.dumps}
+
+    for reply, build in DICTS.items():
+        print(reply)
+        bench("ResponseBuilder", templates[reply])
+        for name, encoder in encoders.items():
+            bench(name, lambda: encoder(build()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Inserts 1M random ids in a RoutingTable and compares the prefix indexed bucket
+selection against the linear scan over the buckets it replaced.
+
+Uniformly random ids nearly always land in the first buckets, which is the
+best case for a linear scan, so lookups are also timed with ids spread evenly
+across every prefix length.
+
+Run with: python -m benchmarks.bench_routing
+"""
+
+import os
+import random
+import time
+from typing import List
+
+from dhtpy.dht.routing import RoutingTable
+from dhtpy.dht.structures import Node
+
+INSERTS = 1_000_000
+
+
+def random_nodes(count: int) -> List[Node]:
+    return [
+        Node.from_compact(os.urandom(20) + b"\x01\x02\x03\x04\x1a\xe1")
+        for _ in range(count)
+    ]
+
+
+def spread_ids(own: int, count: int) -> List[int]:
+    return [
+        own ^ (random.getrandbits(160) >> random.randrange(160)) for _ in range(count)
+    ]
+
+
+def lookups(label: str, routing_table: RoutingTable, ids: List[int]) -> None:
+    start = time.perf_counter()
+    for nid in ids:
+        routing_table.buckets[routing_table.bucket_index(nid)]
+    elapsed = time.perf_counter() - start
+    print(f"  {label} bucket_index: {len(ids) / elapsed:>12,.0f} lookups/s")
+
+    start = time.perf_counter()
+    for nid in ids:
+        for bucket in routing_table.buckets:
+            if bucket.in_range(nid):
+                break
+    elapsed = time.perf_counter() - start
+    print(f"  {label} linear scan:  {len(ids) / elapsed:>12,.0f} lookups/s")
+
+
+def main():
+    own = Node.create_random("1.2.3.4", 6881)
+    nodes = random_nodes(INSERTS)
+
+    routing_table = RoutingTable(own.nid)
+    start = time.perf_counter()
+    added = sum(routing_table.add(node) for node in nodes)
+    elapsed = time.perf_counter() - start
+    print(
+        f"add: {INSERTS / elapsed:,.0f} inserts/s, {added} nodes in "
+        f"{len(routing_table.buckets)} buckets"
+    )
+
+    start = time.perf_counter()
+    found = sum(node in routing_table for node in nodes)
+    elapsed = time.perf_counter() - start
+    print(f"__contains__: {INSERTS / elapsed:,.0f} lookups/s ({found} hits)")
+
+    # Fill the buckets close to our id as well, so there are ~160 of them
+    for nid in spread_ids(own.nid, INSERTS):
+        routing_table.add(Node(nid, "1.2.3.4", 6881))
+    print(f"{len(routing_table.buckets)} buckets after inserting spread ids")
+
+    lookups("uniform", routing_table, [node.nid for node in nodes])
+    lookups("spread", routing_table, spread_ids(own.nid, INSERTS))
+
+
+if __name__ == "__main__":
+    main()
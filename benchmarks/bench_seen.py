@@ -0,0 +1,50 @@
+"""
+Cost of SeenFilter lookups and additions with the default sizing, and the
+measured false positive rate once the filter holds what it was sized for.
+
+Run with: python -m benchmarks.bench_seen
+"""
+
+import os
+import time
+
+from dhtpy.bittorrent.seen import SeenFilter
+
+INFOHASHES = 200_000
+ROUNDS = 5
+
+
+def bench(name: str, operation, infohashes) -> None:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for infohash in infohashes:
+            operation(infohash)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name}: {best / len(infohashes) * 1e9:,.0f} ns/infohash")
+
+
+def main():
+    seen = SeenFilter(capacity=4 * INFOHASHES, generations=4, rotate_interval=None)
+    added = [os.urandom(20) for _ in range(INFOHASHES)]
+    others = [os.urandom(20) for _ in range(INFOHASHES)]
+
+    bench("add", seen.add, added)
+    bench("lookup, seen", seen.__contains__, added)
+    bench("lookup, not seen", seen.__contains__, others)
+
+    for _ in range(3):
+        for infohash in [os.urandom(20) for _ in range(INFOHASHES)]:
+            seen.add(infohash)
+    false_positives = sum(infohash in seen for infohash in others)
+    stats = seen.stats
+    print(
+        f"{stats['bytes'] / 2 ** 20:.1f} MiB for {stats['infohashes']:,} "
+        f"infohashes, false positives {false_positives / INFOHASHES:.5f} "
+        f"(estimated {stats['false_positive_rate']:.5f}, "
+        f"target {seen.error_rate})"
+    )
+
+
+if __name__ == "__main__":
+    main()
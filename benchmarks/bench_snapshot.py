@@ -0,0 +1,66 @@
+"""
+Dumps a routing table of 1M nodes to a snapshot file and times loading it
+back. Loading only copies the entries of each bucket, its nodes are built
+when first used, which is timed separately.
+
+Run with: python -m benchmarks.bench_snapshot
+"""
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from dhtpy.dht.routing import RoutingTable
+from dhtpy.dht.structures import Node
+
+NODES = 1_000_000
+BUCKETS = 16
+
+
+def main():
+    own = random.getrandbits(160)
+    routing_table = RoutingTable(own, bucket_size=NODES // BUCKETS)
+    while len(routing_table) < NODES * 0.95:
+        nid = own ^ (random.getrandbits(160) >> random.randrange(BUCKETS))
+        routing_table.add(Node(nid, "1.2.3.4", 6881))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "routing_table")
+
+        # The only part of save running in the event loop
+        start = time.perf_counter()
+        routing_table._snapshot_buckets()
+        elapsed = time.perf_counter() - start
+        print(f"collect nodes (event loop): {elapsed * 1000:.0f} ms")
+
+        start = time.perf_counter()
+        asyncio.run(routing_table.save(path))
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(path)
+        print(f"save: {elapsed * 1000:.0f} ms, {size / 2 ** 20:.1f} MiB")
+
+        start = time.perf_counter()
+        restored = RoutingTable.load_file(path)
+        elapsed = time.perf_counter() - start
+        print(f"load: {len(restored):,} nodes in {elapsed * 1000:.0f} ms")
+
+        start = time.perf_counter()
+        restored.get_closest_nodes(own)
+        elapsed = time.perf_counter() - start
+        print(f"first lookup of our own id: {elapsed * 1000:.0f} ms")
+
+        start = time.perf_counter()
+        asyncio.run(restored.save(path))
+        elapsed = time.perf_counter() - start
+        print(f"save after load: {elapsed * 1000:.0f} ms")
+
+        start = time.perf_counter()
+        restored.nodes
+        elapsed = time.perf_counter() - start
+        print(f"build every node, through nodes: {elapsed * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
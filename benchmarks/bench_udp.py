@@ -0,0 +1,73 @@
+"""
+Loopback throughput of the protocol based and the batched UDP transports,
+sending KRPC sized datagrams from one node to another.
+
+Run with: python -m benchmarks.bench_udp
+"""
+
+import asyncio
+import time
+
+from dhtpy.dht.udp import BatchedUDPNode, UDPNode
+
+DATAGRAMS = 200_000
+# Datagrams in flight, small enough for the socket buffers so none is lost
+WINDOW = 128
+SIZE = 100
+
+
+def bound_address(node):
+    if isinstance(node, BatchedUDPNode):
+        return node.socket.getsockname()
+    return node.transport.get_extra_info("sockname")
+
+
+async def run(transport) -> None:
+    sender, receiver = transport(), transport()
+    received = 0
+
+    def on_data_received(data, address):
+        nonlocal received
+        received += 1
+
+    receiver.on_data_received = on_data_received
+    await sender.start("127.0.0.1", 0)
+    await receiver.start("127.0.0.1", 0)
+    destination = bound_address(receiver)
+    payload = bytes(SIZE)
+
+    sent = 0
+    start = time.perf_counter()
+    lost = 0
+    progress = start
+    while received < DATAGRAMS:
+        while sent < DATAGRAMS and sent - received < WINDOW:
+            sender.send_message(payload, destination)
+            sent += 1
+        before = received
+        await asyncio.sleep(0)
+        # Datagrams lost on the way would stall the window
+        now = time.perf_counter()
+        if received != before:
+            progress = now
+        elif now - progress > 1:
+            lost += sent - received
+            received = sent
+            progress = now
+    elapsed = time.perf_counter() - start
+
+    sender.close()
+    receiver.close()
+    print(f"{transport.__name__}: {DATAGRAMS / elapsed:,.0f} datagrams/s, {lost} lost")
+
+
+def main():
+    asyncio.run(run(UDPNode))
+    if BatchedUDPNode.is_available():
+        asyncio.run(run(BatchedUDPNode))
+    else:
+        print("BatchedUDPNode: recvmmsg/sendmmsg not available")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 from __future__ import annotations
 
 from io import BytesIO
+from types import BuiltinFunctionType
 from typing import Any, Tuple
 
 import better_bencode  # type: ignore
 
+# Whether better_bencode runs its C extension rather than its pure Python
+# fallback
+ACCELERATED = isinstance(better_bencode.loads, BuiltinFunctionType)
+
 
 class BencoderError(Exception):
     pass
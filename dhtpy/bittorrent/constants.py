@@ -13,8 +13,6 @@ The full handshake message consists of:
 
 The full handshake consists of 68 bytes.
 """
-from bittorrent.bencoding import encode  # type: ignore
-
 PSTR = "BitTorrent protocol"
 PSTR_LEN = chr(len(PSTR))
 RESERVED = "\x00\x00\x00\x00\x00\x10\x00\x01"
@@ -24,6 +22,7 @@ BT_PROTOCOL_PREFIX = bytes(PSTR_LEN + PSTR + RESERVED, encoding="utf-8")
 # Extension
 ID_EXTENDED_MESSAGE = 20
 ID_EXTENDED_HANDSHAKE = 0
-EXTENDED_HANDSHAKE_MESSAGE = bytes(
-    [ID_EXTENDED_MESSAGE, ID_EXTENDED_HANDSHAKE]
-) + encode({b"m": {b"ut_metadata": 1}})
+# Followed by the bencoded {b"m": {b"ut_metadata": 1}}
+EXTENDED_HANDSHAKE_MESSAGE = (
+    bytes([ID_EXTENDED_MESSAGE, ID_EXTENDED_HANDSHAKE]) + b"d1:md11:ut_metadatai1eee"
+)
@@ -12,3 +12,7 @@ class InvalidHandshake(MetadataFetcherException):
 
 class InvalidMetadata(MetadataFetcherException):
     pass
+
+
+class MetadataRejected(MetadataFetcherException):
+    pass
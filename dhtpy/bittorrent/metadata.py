@@ -1,9 +1,15 @@
+from __future__ import annotations
+
 import asyncio
 import hashlib
+import heapq
 import logging
 import math
+import time
+from abc import ABC, abstractmethod
 from asyncio import StreamReader, StreamWriter
-from typing import Callable, Dict, Optional, Tuple
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, Type
 
 from dhtpy.bittorrent import utils as bt_utils
 from dhtpy.bittorrent.bencoding import BencoderError, decode, decode2, encode
@@ -12,12 +18,29 @@ from dhtpy.bittorrent.constants import (
     EXTENDED_HANDSHAKE_MESSAGE,
     ID_EXTENDED_MESSAGE,
 )
-from dhtpy.bittorrent.exceptions import InvalidHandshake, InvalidMetadata
+from dhtpy.bittorrent.exceptions import (
+    InvalidHandshake,
+    InvalidMetadata,
+    MetadataFetcherException,
+    MetadataRejected,
+)
+from dhtpy.bittorrent.reputation import PeerReputation
+from dhtpy.bittorrent.seen import SeenFilter
 from dhtpy.bittorrent.utils import get_random_peer_id
 from dhtpy.config import (
     DEBUG_LEVEL,
+    METADATA_CONNECT_TIMEOUT,
+    METADATA_EXTENDED_HANDSHAKE_TIMEOUT,
     METADATA_FETCH_TIMEOUT,
+    METADATA_HANDSHAKE_TIMEOUT,
+    METADATA_MAX_CONNECTIONS,
+    METADATA_MAX_CONNECTIONS_PER_IP,
+    METADATA_MAX_PEERS_PER_INFOHASH,
+    METADATA_MAX_QUEUE_WAIT,
+    METADATA_MAX_QUEUED_INFOHASHES,
     METADATA_MAX_SIMULTANEOUS_WORKERS_PER_INFOHASH,
+    METADATA_PIECE_TIMEOUT,
+    METADATA_RACE_STAGGER,
 )
 
 logging.basicConfig(level=DEBUG_LEVEL)
@@ -25,27 +48,99 @@ logger = logging.getLogger(__name__)
 
 PeerAddress = Tuple[str, int]
 
+# Stages of a fetch, each with its own timeout
+STAGE_CONNECT = "connect"
+STAGE_HANDSHAKE = "handshake"
+STAGE_EXTENDED_HANDSHAKE = "extended_handshake"
+STAGE_PIECES = "pieces"
+STAGES = (STAGE_CONNECT, STAGE_HANDSHAKE, STAGE_EXTENDED_HANDSHAKE, STAGE_PIECES)
+
+
+class StagedWorker(ABC):
+    """Fetch of the metadata of an infohash from a single peer, going through
+    the stages one after another.
+
+    Every stage of the fetch has its own timeout: opening the connection,
+    receiving the BitTorrent handshake, receiving the extension handshake,
+    and, while pieces are downloaded, the silence between two messages. The
+    stage the fetch stopped at and why are kept in ``stage`` and ``failure``.
+
+    Args:
+        connect_timeout: seconds to open the connection
+        handshake_timeout: seconds to receive the handshake once connected
+        extended_handshake_timeout: seconds to receive the extension
+        handshake once the handshake is received
+        piece_timeout: seconds without a message while downloading pieces
+    """
 
-class MetadataWorker:
     def __init__(
         self,
         infohash: bytes,
         peer_address: PeerAddress,
         max_metadata_size: int = 10_000_000,
+        connect_timeout: float = METADATA_CONNECT_TIMEOUT,
+        handshake_timeout: float = METADATA_HANDSHAKE_TIMEOUT,
+        extended_handshake_timeout: float = METADATA_EXTENDED_HANDSHAKE_TIMEOUT,
+        piece_timeout: float = METADATA_PIECE_TIMEOUT,
     ):
+        self._connect_timeout = connect_timeout
+        self._handshake_timeout = handshake_timeout
+        self._extended_handshake_timeout = extended_handshake_timeout
+        self._piece_timeout = piece_timeout
+
+        self.stage = STAGE_CONNECT
+        # timeout, refused, closed, invalid, unsupported, rejected or error,
+        # None unless it failed
+        self.failure: Optional[str] = None
+        # Seconds each stage went through took
+        self.durations: Dict[str, float] = {}
+        self._stage_started = time.monotonic()
+
         self._peer_id = get_random_peer_id()
         self._peer_address = peer_address
 
         self._infohash = infohash
 
+        self._max_metadata_size = max_metadata_size
+
+    @property
+    def peer_address(self) -> PeerAddress:
+        return self._peer_address
+
+    def _complete_stage(self) -> None:
+        now = time.monotonic()
+        self.durations[self.stage] = now - self._stage_started
+        self._stage_started = now
+
+    def _next_stage(self, stage: str) -> None:
+        self._complete_stage()
+        self.stage = stage
+
+    def fail(self, failure: str) -> None:
+        """Records why the fetch stopped at the current stage, the first
+        reason recorded is kept."""
+        if self.failure is None:
+            self.failure = failure
+
+    @abstractmethod
+    async def work(self) -> Optional[bytes]:
+        """Returns the metadata, None if it could not be fetched."""
+        pass
+
+
+class MetadataWorker(StagedWorker):
+    """Fetches the metadata of an infohash from a single peer, reading its
+    messages from a StreamReader."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
         self._reader: Optional[StreamReader] = None
         self._writer: Optional[StreamWriter] = None
 
         self._handshaked = False
         self._ut_metadata = int()
 
-        self._max_metadata_size = max_metadata_size
-
         self._metadata_size = 0
         self._metadata_received = 0
         self._metadata = bytearray()
@@ -120,7 +215,7 @@ class MetadataWorker:
                     logging.debug("Invalid metadata in on_extension_message.")
 
         elif message_type == 2:
-            logging.info("Peer rejected the connection.")
+            raise MetadataRejected(message="Peer rejected the metadata request")
 
     def _on_handshake(self) -> None:
         """
@@ -146,35 +241,70 @@ class MetadataWorker:
         if self._writer:
             self._writer.write(length + message)
 
+    async def _read_message(self) -> bytes:
+        assert self._reader is not None
+        while True:
+            buffer = await self._reader.readexactly(4)
+            length = int.from_bytes(buffer, "big")
+            # Keep alive messages are empty
+            if length:
+                return await self._reader.readexactly(length)
+
     async def work(self):
         event_loop = asyncio.get_event_loop()
         self._metadata_future = event_loop.create_future()
+        self._stage_started = time.monotonic()
 
         try:
-            self._reader, self._writer = await asyncio.open_connection(
-                *self._peer_address, loop=event_loop
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(*self._peer_address), self._connect_timeout
             )
 
+            self._next_stage(STAGE_HANDSHAKE)
             self._writer.write(BT_PROTOCOL_PREFIX + self._infohash + self._peer_id)
 
-            message = await self._reader.readexactly(68)
+            message = await asyncio.wait_for(
+                self._reader.readexactly(68), self._handshake_timeout
+            )
 
             if not bt_utils.is_handshake_valid(message, self._infohash):
+                if not bt_utils.supports_metadata_exchange(message):
+                    self.fail("unsupported")
                 raise InvalidHandshake(
                     f"Invalid handshake for {self._infohash.hex()} from peer {self._peer_address}."
                 )
 
             self._on_handshake()
 
+            # Peers may send other messages, like their bitfield, first
+            self._next_stage(STAGE_EXTENDED_HANDSHAKE)
+            deadline = event_loop.time() + self._extended_handshake_timeout
+            while not self._handshaked:
+                message = await asyncio.wait_for(
+                    self._read_message(), deadline - event_loop.time()
+                )
+                self._on_message(message)
+
+            self._next_stage(STAGE_PIECES)
             while not self._metadata_future.done():
-                buffer = await self._reader.readexactly(4)
-                length = int.from_bytes(buffer, "big")
-                message = await self._reader.readexactly(length)
+                message = await asyncio.wait_for(
+                    self._read_message(), self._piece_timeout
+                )
                 self._on_message(message)
+            self._complete_stage()
+        except asyncio.TimeoutError:
+            self.fail("timeout")
         except ConnectionRefusedError:
             # If connection is refused just ignore it
-            pass
+            self.fail("refused")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.fail("closed")
+        except MetadataRejected:
+            self.fail("rejected")
+        except MetadataFetcherException:
+            self.fail("invalid")
         except Exception as e:
+            self.fail("error")
             logger.debug(
                 f"There was an error retrieving metadata for {self._infohash.hex()} from peer {self._peer_address}."
             )
@@ -189,56 +319,480 @@ class MetadataWorker:
         return self._metadata_future.result()
 
 
+class StageStats:
+    """Outcome of every stage of the metadata fetches, to tune their
+    timeouts: how many fetches went through each stage, how long it took
+    them on average and why the others stopped there."""
+
+    def __init__(self):
+        self.completed: Dict[str, int] = {stage: 0 for stage in STAGES}
+        self._seconds: Dict[str, float] = {stage: 0.0 for stage in STAGES}
+        # (stage, failure) to count
+        self.failures: Dict[Tuple[str, str], int] = {}
+
+    def record(self, worker: StagedWorker) -> None:
+        for stage, seconds in worker.durations.items():
+            self.completed[stage] += 1
+            self._seconds[stage] += seconds
+        if worker.failure is not None:
+            key = (worker.stage, worker.failure)
+            self.failures[key] = self.failures.get(key, 0) + 1
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        stats: Dict[str, float] = {}
+        for stage in STAGES:
+            completed = self.completed[stage]
+            stats[f"{stage}_completed"] = completed
+            stats[f"{stage}_seconds"] = (
+                self._seconds[stage] / completed if completed else 0.0
+            )
+        for (stage, failure), count in self.failures.items():
+            stats[f"{stage}_{failure}"] = count
+        return stats
+
+
 async def fetch_metadata(
-    infohash: bytes, peer_address: PeerAddress, max_metadata_size: int
+    infohash: bytes,
+    peer_address: PeerAddress,
+    max_metadata_size: int,
+    on_worker_done: Optional[Callable[[StagedWorker], None]] = None,
+    worker_class: Type[StagedWorker] = MetadataWorker,
+    on_worker_started: Optional[Callable[[StagedWorker], None]] = None,
 ) -> Optional[bytes]:
+    worker = worker_class(infohash, peer_address, max_metadata_size)
+    if on_worker_started is not None:
+        on_worker_started(worker)
     try:
-        result = await asyncio.wait_for(
-            MetadataWorker(infohash, peer_address, max_metadata_size).work(),
-            timeout=METADATA_FETCH_TIMEOUT,
-        )
+        # The stages have their own timeouts, this one only bounds a peer
+        # trickling pieces just fast enough
+        result = await asyncio.wait_for(worker.work(), timeout=METADATA_FETCH_TIMEOUT)
     except asyncio.TimeoutError:
-        return None
-    else:
-        return result
-
+        worker.fail("timeout")
+        result = None
+    finally:
+        if on_worker_done is not None:
+            on_worker_done(worker)
+    return result
+
+
+class _Fetch:
+    """Metadata fetch of an infohash, from one peer at a time or a few."""
+
+    __slots__ = (
+        "infohash",
+        "max_metadata_size",
+        "peers",
+        "known",
+        "tasks",
+        "entry",
+        "done",
+        "created",
+        "next_start",
+        "timer",
+        "worker",
+    )
+
+    def __init__(self, infohash: bytes, max_metadata_size: int, created: float):
+        self.infohash = infohash
+        self.max_metadata_size = max_metadata_size
+        # Peers not connected to yet, in the order they announced
+        self.peers: Deque[PeerAddress] = deque()
+        # Distinct peers that announced the infohash, its priority
+        self.known: Set[PeerAddress] = set()
+        self.tasks: Set[asyncio.Future] = set()
+        # Entry of the fetch in the queue, older ones are stale
+        self.entry: Optional[Tuple[int, int, bytes]] = None
+        self.done = False
+        self.created = created
+        # No other connection is opened before, unless one fails
+        self.next_start = created
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # Worker of the last connection started, None until it runs or once
+        # a connection failed
+        self.worker: Optional[StagedWorker] = None
+
+
+class FetchScheduler:
+    """Runs metadata fetches within a budget of TCP connections.
+
+    Announced peers are queued by infohash, infohashes announced by the most
+    distinct peers are connected to first. A connection is only opened while
+    the total, the peer IP and the infohash are all under their budget of
+    open connections. The queue holds at most max_queued infohashes, new ones
+    are dropped once it is full, and infohashes that waited max_wait seconds
+    without a connection are dropped.
+
+    Peers of an infohash race like happy eyeballs: a single one is connected
+    to first, the next one as soon as one fails or when the last one started
+    is still connecting stagger seconds later, and the first metadata
+    received cancels the other connections. A peer that connected is not
+    raced, it has the timeouts of its stages. Peers announced while the
+    connections are busy stay queued for the next start.
+
+    Args:
+        max_connections: connections open at once
+        max_connections_per_ip: connections open at once to a single IP
+        max_connections_per_infohash: connections open at once for a single
+        infohash
+        max_queued: infohashes waiting for a connection
+        max_peers: peers remembered for each infohash
+        max_wait: seconds an infohash waits for a connection
+        stagger: seconds a peer of an infohash being fetched has to connect
+        before another one is raced, 0 to connect to all at once
+        reputation: peers skipped for failing too often, fed with the outcome
+        of every connection
+    """
 
-class MetadataFetcher:
     def __init__(
-        self, on_metadata_result: Optional[Callable[[bytes, bytes], None]] = None
+        self,
+        max_connections: int = METADATA_MAX_CONNECTIONS,
+        max_connections_per_ip: int = METADATA_MAX_CONNECTIONS_PER_IP,
+        max_connections_per_infohash: int = METADATA_MAX_SIMULTANEOUS_WORKERS_PER_INFOHASH,
+        max_queued: int = METADATA_MAX_QUEUED_INFOHASHES,
+        max_peers: int = METADATA_MAX_PEERS_PER_INFOHASH,
+        max_wait: float = METADATA_MAX_QUEUE_WAIT,
+        stagger: float = METADATA_RACE_STAGGER,
+        reputation: Optional[PeerReputation] = None,
+        worker_class: Type[StagedWorker] = MetadataWorker,
     ):
-        self._active_workers: Dict[bytes, asyncio.Future] = dict()
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.max_connections_per_infohash = max_connections_per_infohash
+        self.max_queued = max_queued
+        self.max_peers = max_peers
+        self.max_wait = max_wait
+        self.stagger = stagger
+        self.reputation = reputation
+        self.worker_class = worker_class
+
+        self._fetches: Dict[bytes, _Fetch] = {}
+        # Max heap of (-distinct peers, sequence, infohash)
+        self._queue: List[Tuple[int, int, bytes]] = []
+        self._sequence = 0
+        # Fetches with peers queued, by the time they last got a connection
+        # or were queued, oldest first
+        self._waiting: OrderedDict[bytes, float] = OrderedDict()
+        self._connections_per_ip: Dict[str, int] = {}
+        self.connections = 0
+        self.stages = StageStats()
+
+        # Callbacks
+        self.on_done: Optional[Callable[[bytes, Optional[bytes]], None]] = None
+
+        self.queued = 0
+        self.started = 0
+        self.dropped_full = 0
+        self.dropped_expired = 0
+        self.dropped_peers = 0
+        self.succeeded = 0
+        self.cancelled = 0
+        self._total_wait = 0.0
+        self._total_time_to_metadata = 0.0
+
+    def __contains__(self, infohash: bytes) -> bool:
+        return infohash in self._fetches
+
+    def __len__(self) -> int:
+        return len(self._fetches)
+
+    def submit(
+        self,
+        infohash: bytes,
+        peer_address: PeerAddress,
+        max_metadata_size: int = 10_000_000,
+    ) -> bool:
+        """Queues a peer that announced an infohash, returns False if it was
+        dropped."""
+        now = time.monotonic()
+        self._expire(now)
+        if self.reputation is not None and not self.reputation.allows(peer_address):
+            return False
+
+        fetch = self._fetches.get(infohash)
+        if fetch is None:
+            if len(self._waiting) >= self.max_queued:
+                self.dropped_full += 1
+                return False
+            fetch = self._fetches[infohash] = _Fetch(infohash, max_metadata_size, now)
+
+        if peer_address in fetch.known or len(fetch.known) >= self.max_peers:
+            self.dropped_peers += 1
+            return False
+        fetch.known.add(peer_address)
+        fetch.peers.append(peer_address)
+        if infohash not in self._waiting:
+            self._waiting[infohash] = now
+        self.queued += 1
+        self._push(fetch)
+        self._dispatch(now)
+        return True
+
+    def _push(self, fetch: _Fetch) -> None:
+        self._sequence += 1
+        fetch.entry = (-len(fetch.known), self._sequence, fetch.infohash)
+        heapq.heappush(self._queue, fetch.entry)
+
+    def _expire(self, now: float) -> None:
+        while self._waiting:
+            infohash, queued_at = next(iter(self._waiting.items()))
+            if now - queued_at < self.max_wait:
+                break
+            del self._waiting[infohash]
+            fetch = self._fetches[infohash]
+            self.dropped_expired += 1
+            fetch.peers.clear()
+            fetch.entry = None
+            if not fetch.tasks:
+                self._finish(fetch, None)
+
+    def _next_peer(self, fetch: _Fetch) -> Optional[PeerAddress]:
+        for _ in range(len(fetch.peers)):
+            peer_address = fetch.peers.popleft()
+            # Its reputation may have dropped while it was queued
+            if self.reputation is not None and not self.reputation.allows(peer_address):
+                continue
+            if (
+                self._connections_per_ip.get(peer_address[0], 0)
+                < self.max_connections_per_ip
+            ):
+                return peer_address
+            fetch.peers.append(peer_address)
+        return None
 
-        self.on_metadata_result = on_metadata_result
+    def _dispatch(self, now: float) -> None:
+        """Opens connections to the peers of the infohashes first in the queue
+        while the budgets allow."""
+        blocked = []
+        while self._queue and self.connections < self.max_connections:
+            entry = heapq.heappop(self._queue)
+            fetch = self._fetches.get(entry[2])
+            if fetch is None or fetch.entry is not entry:
+                continue
+            if len(fetch.tasks) >= self.max_connections_per_infohash:
+                # Queued again when one of its connections closes
+                fetch.entry = None
+                continue
+            if fetch.tasks and now < fetch.next_start:
+                # Racing, queued again after the stagger or a failure
+                fetch.entry = None
+                self._schedule(fetch, now)
+                continue
+            if (
+                fetch.tasks
+                and fetch.worker is not None
+                and fetch.worker.stage != STAGE_CONNECT
+            ):
+                # Connected, queued again if one of its connections fails
+                fetch.entry = None
+                continue
+
+            peer_address = self._next_peer(fetch)
+            if peer_address is None:
+                if fetch.peers:
+                    # Every peer left is an IP at its budget
+                    blocked.append(entry)
+                else:
+                    # Every peer left was skipped for its reputation
+                    fetch.entry = None
+                    del self._waiting[fetch.infohash]
+                    if not fetch.tasks:
+                        self._finish(fetch, None)
+                continue
+            self._start(fetch, peer_address, now)
+
+            if fetch.peers:
+                heapq.heappush(self._queue, entry)
+            else:
+                fetch.entry = None
+        for entry in blocked:
+            heapq.heappush(self._queue, entry)
+
+    def _schedule(self, fetch: _Fetch, now: float) -> None:
+        if fetch.timer is None:
+            fetch.timer = asyncio.get_event_loop().call_later(
+                fetch.next_start - now, self._on_stagger, fetch
+            )
 
-    def _on_parent_task_done(self, infohash: bytes, task: asyncio.Future):
-        del self._active_workers[infohash]
-        try:
-            metadata = task.result()
-            if not metadata:
-                return
-        except asyncio.CancelledError:
-            return
+    def _on_stagger(self, fetch: _Fetch) -> None:
+        fetch.timer = None
+        if not fetch.done and fetch.peers and fetch.entry is None:
+            self._push(fetch)
+            self._dispatch(time.monotonic())
 
-        if self.on_metadata_result:
-            self.on_metadata_result(infohash, metadata)
+    def _start(self, fetch: _Fetch, peer_address: PeerAddress, now: float) -> None:
+        fetch.next_start = now + self.stagger
+        fetch.worker = None
+        self._total_wait += now - self._waiting.pop(fetch.infohash)
+        if fetch.peers:
+            self._waiting[fetch.infohash] = now
 
-    def _on_child_task_done(
-        self, parent_task: asyncio.Future, child_task: asyncio.Future
-    ):
-        parent_task.child_count -= 1  # type: ignore
+        host = peer_address[0]
+        self._connections_per_ip[host] = self._connections_per_ip.get(host, 0) + 1
+        self.connections += 1
+        self.started += 1
+
+        task = asyncio.ensure_future(
+            fetch_metadata(
+                infohash=fetch.infohash,
+                peer_address=peer_address,
+                max_metadata_size=fetch.max_metadata_size,
+                on_worker_done=self._on_worker_done,
+                worker_class=self.worker_class,
+                on_worker_started=lambda worker: self._on_worker_started(fetch, worker),
+            )
+        )
+        fetch.tasks.add(task)
+        task.add_done_callback(lambda t: self._on_task_done(fetch, peer_address, t))
+
+    def _on_worker_started(self, fetch: _Fetch, worker: StagedWorker) -> None:
+        # Connections are started in order, the last one started wins
+        fetch.worker = worker
+
+    def _on_worker_done(self, worker: StagedWorker) -> None:
+        self.stages.record(worker)
+        # Connections cancelled by the scheduler say nothing about the peer
+        if self.reputation is not None and (
+            worker.failure is not None or STAGE_PIECES in worker.durations
+        ):
+            self.reputation.record(worker.peer_address, worker.failure)
+
+    def _on_task_done(
+        self, fetch: _Fetch, peer_address: PeerAddress, task: asyncio.Future
+    ) -> None:
+        host = peer_address[0]
+        count = self._connections_per_ip[host] - 1
+        if count:
+            self._connections_per_ip[host] = count
+        else:
+            del self._connections_per_ip[host]
+        self.connections -= 1
+        fetch.tasks.discard(task)
+
+        metadata = None
         try:
-            metadata = child_task.result()
-            if metadata and not parent_task.done():
-                parent_task.set_result(metadata)
+            metadata = task.result()
         except asyncio.CancelledError:
             pass
         except Exception as e:
-            logging.debug("Child task resulted in exception")
+            logging.debug("Metadata fetch resulted in exception")
             logger.exception(e)
 
-        if parent_task.child_count <= 0 and not parent_task.done():  # type: ignore
-            parent_task.set_result(None)
+        now = time.monotonic()
+        if not fetch.done:
+            if metadata:
+                self._finish(fetch, metadata)
+            elif not fetch.tasks and not fetch.peers:
+                self._finish(fetch, None)
+            else:
+                # The next peer does not wait for the stagger
+                fetch.next_start = now
+                fetch.worker = None
+                if fetch.timer is not None:
+                    fetch.timer.cancel()
+                    fetch.timer = None
+                if fetch.peers and fetch.entry is None:
+                    self._push(fetch)
+        self._dispatch(now)
+
+    def _finish(self, fetch: _Fetch, metadata: Optional[bytes]) -> None:
+        fetch.done = True
+        fetch.entry = None
+        del self._fetches[fetch.infohash]
+        self._waiting.pop(fetch.infohash, None)
+        if fetch.timer is not None:
+            fetch.timer.cancel()
+            fetch.timer = None
+        for task in fetch.tasks:
+            task.cancel()
+        if metadata:
+            self.succeeded += 1
+            self.cancelled += len(fetch.tasks)
+            self._total_time_to_metadata += time.monotonic() - fetch.created
+
+        if self.on_done:
+            self.on_done(fetch.infohash, metadata)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        now = time.monotonic()
+        oldest = next(iter(self._waiting.values()), now)
+        stats: Dict[str, float] = {
+            "fetches": len(self._fetches),
+            "queue_depth": len(self._waiting),
+            "connections": self.connections,
+            "queued": self.queued,
+            "started": self.started,
+            "dropped_full": self.dropped_full,
+            "dropped_expired": self.dropped_expired,
+            "dropped_peers": self.dropped_peers,
+            "succeeded": self.succeeded,
+            "cancelled": self.cancelled,
+            "average_time_to_metadata": (
+                self._total_time_to_metadata / self.succeeded if self.succeeded else 0.0
+            ),
+            "average_wait": self._total_wait / self.started if self.started else 0.0,
+            "oldest_wait": now - oldest,
+            **self.stages.stats,
+        }
+        if self.reputation is not None:
+            for key, value in self.reputation.stats.items():
+                stats[f"reputation_{key}"] = value
+        return stats
+
+
+class MetadataFetcher:
+    """Fetches the metadata of infohashes, at most once at a time for each.
+
+    Args:
+        on_metadata_result: called with the infohash and the metadata of
+        every fetch that succeeds
+        seen: infohashes already fetched, skipped by fetch and kept as long as
+        they are announced. Fetches that succeed are added to it.
+        scheduler: budgets the connections of the fetches, the default one
+        unless given
+        reputation: peers not connected to for failing too often
+    """
+
+    def __init__(
+        self,
+        on_metadata_result: Optional[Callable[[bytes, bytes], None]] = None,
+        seen: Optional[SeenFilter] = None,
+        scheduler: Optional[FetchScheduler] = None,
+        reputation: Optional[PeerReputation] = None,
+    ):
+        self.scheduler = FetchScheduler() if scheduler is None else scheduler
+        if reputation is not None:
+            self.scheduler.reputation = reputation
+        self.scheduler.on_done = self._on_fetch_done
+
+        self.on_metadata_result = on_metadata_result
+        self.seen = seen
+
+        self.fetched = 0
+        self.saved = 0
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        stats: Dict[str, float] = {
+            "fetched": self.fetched,
+            "saved": self.saved,
+            **self.scheduler.stats,
+        }
+        if self.seen is not None:
+            for key, value in self.seen.stats.items():
+                stats[f"seen_{key}"] = value
+        return stats
+
+    def _on_fetch_done(self, infohash: bytes, metadata: Optional[bytes]):
+        if not metadata:
+            return
+
+        self.fetched += 1
+        if self.seen is not None:
+            self.seen.add(infohash)
+        if self.on_metadata_result:
+            self.on_metadata_result(infohash, metadata)
 
     def fetch(
         self,
@@ -246,35 +800,12 @@ class MetadataFetcher:
         peer_address: PeerAddress,
         max_metadata_size: int = 10_000_000,
     ):
-        event_loop = asyncio.get_event_loop()
-
-        if infohash not in self._active_workers:
-            parent_future = event_loop.create_future()
-            parent_future.child_count = 0  # type: ignore
-            parent_future.add_done_callback(
-                lambda f: self._on_parent_task_done(infohash, f)
-            )
-            self._active_workers[infohash] = parent_future
-
-        parent_future = self._active_workers[infohash]
-
-        if parent_future.done():
-            return
-
         if (
-            parent_future.child_count  # type: ignore
-            >= METADATA_MAX_SIMULTANEOUS_WORKERS_PER_INFOHASH
+            self.seen is not None
+            and infohash not in self.scheduler
+            and self.seen.refresh(infohash)
         ):
+            self.saved += 1
             return
 
-        task = asyncio.ensure_future(
-            fetch_metadata(
-                infohash=infohash,
-                peer_address=peer_address,
-                max_metadata_size=max_metadata_size,
-            )
-        )
-        task.add_done_callback(lambda t: self._on_child_task_done(parent_future, t))
-
-        parent_future.child_count += 1  # type: ignore
-        parent_future.add_done_callback(lambda f: task.cancel())
+        self.scheduler.submit(infohash, peer_address, max_metadata_size)
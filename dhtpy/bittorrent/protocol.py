@@ -0,0 +1,338 @@
+"""
+BEP 9 metadata client written as an asyncio protocol.
+
+MetadataWorker reads every message with StreamReader.readexactly: each one
+costs a trip through a coroutine and copies the data from the socket into
+the stream buffer, out of it into a bytes object and then into the
+metadata. MetadataProtocol has the event loop receive straight into a
+buffer it owns, parses the length prefixed messages where they were
+received and copies the pieces once, from that buffer into the metadata.
+
+It goes through the same stages, with the same timeouts and failures, as
+MetadataWorker, and is used in its place with
+``FetchScheduler(worker_class=MetadataProtocol)``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import math
+import struct
+import time
+from typing import List, Optional, Set
+
+from dhtpy.bittorrent import utils as bt_utils
+from dhtpy.bittorrent.bencoding import BencoderError, decode, decode2, encode
+from dhtpy.bittorrent.constants import (
+    BT_PROTOCOL_PREFIX,
+    EXTENDED_HANDSHAKE_MESSAGE,
+    ID_EXTENDED_HANDSHAKE,
+    ID_EXTENDED_MESSAGE,
+)
+from dhtpy.bittorrent.exceptions import (
+    InvalidHandshake,
+    InvalidMetadata,
+    MetadataFetcherException,
+    MetadataRejected,
+)
+from dhtpy.bittorrent.metadata import (
+    STAGE_EXTENDED_HANDSHAKE,
+    STAGE_HANDSHAKE,
+    STAGE_PIECES,
+    StagedWorker,
+)
+
+logger = logging.getLogger(__name__)
+
+HANDSHAKE_LENGTH = 68
+PIECE_SIZE = 2 ** 14
+# The ut_metadata id sent in EXTENDED_HANDSHAKE_MESSAGE
+UT_METADATA_ID = 1
+# Bytes decoded to find the bencoded header of a piece, the piece follows it
+PIECE_HEADER_SIZE = 256
+
+_LENGTH = struct.Struct("!I")
+
+
+class MetadataProtocol(StagedWorker, asyncio.BufferedProtocol):
+    """Fetches the metadata of an infohash from a single peer, parsing its
+    messages straight out of the receive buffer.
+
+    Messages are received into one buffer, from ``_start`` to ``_end``.
+    When little room is left at its end, the remainder of a message is moved
+    to the front of the buffer, which only grows for messages longer than it.
+    """
+
+    # Bytes the buffer starts with, a piece message fits in it
+    BUFFER_SIZE = 64 * 1024
+    # Longer messages are invalid
+    MAX_MESSAGE_SIZE = 1024 * 1024
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._start = 0
+        self._end = 0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._transport: Optional[asyncio.Transport] = None
+        self._result: Optional[asyncio.Future] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # The timer fires at the deadline of the stage, pushed back by
+        # every message while downloading pieces
+        self._deadline = 0.0
+
+        self._ut_metadata = 0
+        self._metadata_size = 0
+        self._metadata = bytearray()
+        self._missing_pieces: Set[int] = set()
+
+    async def work(self) -> Optional[bytes]:
+        self._loop = asyncio.get_event_loop()
+        self._result = self._loop.create_future()
+        self._stage_started = time.monotonic()
+
+        try:
+            await asyncio.wait_for(
+                self._loop.create_connection(lambda: self, *self._peer_address),
+                self._connect_timeout,
+            )
+            return await self._result
+        except asyncio.TimeoutError:
+            self.fail("timeout")
+        except ConnectionRefusedError:
+            # If connection is refused just ignore it
+            self.fail("refused")
+        except ConnectionError:
+            self.fail("closed")
+        except Exception as e:
+            self.fail("error")
+            logger.debug(
+                f"There was an error retrieving metadata for {self._infohash.hex()} from peer {self._peer_address}."
+            )
+            logger.exception(e)
+        finally:
+            self._finish(None)
+        return None
+
+    def _finish(self, metadata: Optional[bytes]) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._result is not None and not self._result.done():
+            self._result.set_result(metadata)
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    def _arm(self, timeout: float) -> None:
+        assert self._loop is not None
+        self._deadline = self._loop.time() + timeout
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self._loop.call_at(self._deadline, self._on_timer)
+
+    def _on_timer(self) -> None:
+        assert self._loop is not None
+        if self._loop.time() < self._deadline:
+            self._timer = self._loop.call_at(self._deadline, self._on_timer)
+            return
+        self._timer = None
+        self.fail("timeout")
+        self._finish(None)
+
+    # asyncio.BufferedProtocol
+
+    def connection_made(self, transport) -> None:
+        self._transport = transport
+        self._next_stage(STAGE_HANDSHAKE)
+        transport.write(BT_PROTOCOL_PREFIX + self._infohash + self._peer_id)
+        self._arm(self._handshake_timeout)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._transport = None
+        if self._result is not None and not self._result.done():
+            self.fail("closed")
+            self._finish(None)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > self.BUFFER_SIZE:
+                self._buffer = bytearray(self.BUFFER_SIZE)
+        elif self._start and len(self._buffer) - self._end < self.BUFFER_SIZE // 4:
+            self._make_room(len(self._buffer))
+        return memoryview(self._buffer)[self._end :]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._end += nbytes
+        try:
+            self._parse()
+            return
+        except MetadataRejected:
+            self.fail("rejected")
+        except MetadataFetcherException:
+            self.fail("invalid")
+        except Exception as e:
+            self.fail("error")
+            logger.debug(
+                f"There was an error retrieving metadata for {self._infohash.hex()} from peer {self._peer_address}."
+            )
+            logger.exception(e)
+        self._finish(None)
+
+    # Messages
+
+    def _parse(self) -> None:
+        assert self._result is not None
+        while not self._result.done():
+            start = self._start
+            available = self._end - start
+
+            if self.stage == STAGE_HANDSHAKE:
+                if available < HANDSHAKE_LENGTH:
+                    return
+                self._start = start + HANDSHAKE_LENGTH
+                self._on_handshake(bytes(self._buffer[start : self._start]))
+                continue
+
+            if available < 4:
+                return
+            (length,) = _LENGTH.unpack_from(self._buffer, start)
+            if length > self.MAX_MESSAGE_SIZE:
+                raise MetadataFetcherException(message="Message too long")
+            if available < 4 + length:
+                if 4 + length > len(self._buffer) - start:
+                    self._make_room(4 + length)
+                return
+
+            self._start = start + 4 + length
+            # Keep alive messages are empty
+            if length:
+                self._on_message(start + 4, self._start)
+
+    def _make_room(self, size: int) -> None:
+        """Moves the remainder of a message to the front of the buffer, into
+        a new one if size bytes do not fit in it."""
+        remainder = self._end - self._start
+        buffer = self._buffer if size <= len(self._buffer) else bytearray(size)
+        buffer[:remainder] = self._buffer[self._start : self._end]
+        self._buffer = buffer
+        self._start, self._end = 0, remainder
+
+    def _on_handshake(self, message: bytes) -> None:
+        if not bt_utils.is_handshake_valid(message, self._infohash):
+            if not bt_utils.supports_metadata_exchange(message):
+                self.fail("unsupported")
+            raise InvalidHandshake(
+                f"Invalid handshake for {self._infohash.hex()} from peer {self._peer_address}."
+            )
+
+        self._write_messages([EXTENDED_HANDSHAKE_MESSAGE])
+        # Peers may send other messages, like their bitfield, first
+        self._next_stage(STAGE_EXTENDED_HANDSHAKE)
+        self._arm(self._extended_handshake_timeout)
+
+    def _on_message(self, start: int, end: int) -> None:
+        """Handles the message from start to end in the buffer."""
+        buffer = self._buffer
+        if self.stage == STAGE_PIECES:
+            assert self._loop is not None
+            self._deadline = self._loop.time() + self._piece_timeout
+        if end - start < 2 or buffer[start] != ID_EXTENDED_MESSAGE:
+            return
+
+        if buffer[start + 1] == ID_EXTENDED_HANDSHAKE:
+            if self.stage == STAGE_EXTENDED_HANDSHAKE:
+                self._on_extension_handshake_message(bytes(buffer[start + 2 : end]))
+        elif buffer[start + 1] == UT_METADATA_ID and self.stage == STAGE_PIECES:
+            self._on_extension_message(start + 2, end)
+
+    def _on_extension_handshake_message(self, message: bytes) -> None:
+        try:
+            message_dict = decode(message)
+        except BencoderError:
+            logger.debug(
+                "Message in on_extension_handshake_message could not be decoded."
+            )
+            return
+
+        try:
+            ut_metadata = message_dict[b"m"][b"ut_metadata"]
+            metadata_size = message_dict[b"metadata_size"]
+        except (KeyError, TypeError):
+            logger.debug(
+                f"Missing ut_metadata or metadata_size in on_extension_handshake_message: {message_dict}."
+            )
+            return
+
+        if not bt_utils.is_metadata_size_valid(message_dict, self._max_metadata_size):
+            raise InvalidMetadata(message="Invalid metadata size")
+
+        self._ut_metadata = ut_metadata
+        self._metadata = bytearray(metadata_size)
+        self._metadata_size = metadata_size
+        pieces = math.ceil(metadata_size / PIECE_SIZE)
+        self._missing_pieces = set(range(pieces))
+
+        self._next_stage(STAGE_PIECES)
+        self._arm(self._piece_timeout)
+        self._write_messages(
+            [
+                bytes([ID_EXTENDED_MESSAGE, ut_metadata])
+                + encode({b"msg_type": 0, b"piece": piece})
+                for piece in range(pieces)
+            ]
+        )
+
+    def _on_extension_message(self, start: int, end: int) -> None:
+        """Handles the ut_metadata message from start to end in the buffer,
+        a piece is copied from the buffer into the metadata."""
+        buffer = self._buffer
+        try:
+            message_dict, i = decode2(
+                bytes(buffer[start : min(end, start + PIECE_HEADER_SIZE)])
+            )
+        except BencoderError:
+            logger.debug("Message in on_extension_message could not be decoded.")
+            return
+
+        try:
+            message_type = message_dict[b"msg_type"]
+            piece = message_dict[b"piece"]
+        except (KeyError, TypeError):
+            logger.debug(
+                f"Missing msg_type or piece in on_extension_message: {message_dict}."
+            )
+            return
+
+        if message_type == 2:
+            raise MetadataRejected(message="Peer rejected the metadata request")
+        if message_type != 1:
+            return
+
+        if piece not in self._missing_pieces:
+            raise InvalidMetadata(message="Unexpected metadata piece")
+        offset = piece * PIECE_SIZE
+        size = min(PIECE_SIZE, self._metadata_size - offset)
+        if end - start - i != size:
+            raise InvalidMetadata(message="Unexpected metadata piece")
+
+        with memoryview(buffer) as view:
+            self._metadata[offset : offset + size] = view[start + i : end]
+        self._missing_pieces.discard(piece)
+
+        if not self._missing_pieces:
+            if hashlib.sha1(self._metadata).digest() != self._infohash:
+                raise InvalidMetadata(message="Metadata does not match the infohash")
+            self._complete_stage()
+            self._finish(bytes(self._metadata))
+
+    def _write_messages(self, messages: List[bytes]) -> None:
+        if self._transport is not None:
+            self._transport.write(
+                b"".join(_LENGTH.pack(len(message)) + message for message in messages)
+            )
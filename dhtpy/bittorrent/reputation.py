@@ -0,0 +1,122 @@
+"""
+Reputation of the peers metadata is fetched from.
+
+Most peers that announce an infohash never give its metadata: they refuse
+connections, never answer, do not support ut_metadata or reject requests.
+The same peers announce many infohashes, so how a connection to a peer went
+is remembered and peers that keep failing are not connected to again for a
+while.
+
+Every failure adds a penalty to the score of the peer, the score halves
+every half life and a success clears it. Peers whose score reaches the
+threshold are skipped.
+"""
+
+from __future__ import annotations
+
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from dhtpy.config import (
+    REPUTATION_HALF_LIFE,
+    REPUTATION_MAX_PEERS,
+    REPUTATION_THRESHOLD,
+)
+
+PeerAddress = Tuple[str, int]
+
+# Penalty of every failure of MetadataWorker, peers that do not support
+# ut_metadata are skipped at once and for at least a half life
+PENALTIES: Dict[str, float] = {
+    "refused": 1.0,
+    "timeout": 1.0,
+    "closed": 0.5,
+    "invalid": 1.0,
+    "unsupported": 2 * REPUTATION_THRESHOLD,
+    "rejected": 1.0,
+    "error": 0.5,
+}
+
+
+class PeerReputation:
+    """Bounded LRU of the scores of the peers.
+
+    Args:
+        max_peers: peers remembered, the least recently seen are forgotten
+        half_life: seconds for a score to halve
+        threshold: score from which a peer is skipped
+    """
+
+    def __init__(
+        self,
+        max_peers: int = REPUTATION_MAX_PEERS,
+        half_life: float = REPUTATION_HALF_LIFE,
+        threshold: float = REPUTATION_THRESHOLD,
+    ):
+        self.max_peers = max_peers
+        self.half_life = half_life
+        self.threshold = threshold
+
+        # Peer to [score, last update]
+        self._peers: OrderedDict[PeerAddress, List[float]] = OrderedDict()
+
+        self.avoided = 0
+        self.successes = 0
+        self.failures: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._peers)
+
+    def score(self, peer_address: PeerAddress) -> float:
+        entry = self._peers.get(peer_address)
+        if entry is None:
+            return 0.0
+        return self._decay(entry, time.monotonic())
+
+    def _decay(self, entry: List[float], now: float) -> float:
+        score, updated = entry
+        if score and now > updated:
+            score *= math.pow(0.5, (now - updated) / self.half_life)
+            entry[0], entry[1] = score, now
+        return score
+
+    def allows(self, peer_address: PeerAddress) -> bool:
+        """Whether to connect to the peer, counts the connections avoided."""
+        if self.score(peer_address) < self.threshold:
+            return True
+        self.avoided += 1
+        return False
+
+    def record(self, peer_address: PeerAddress, failure: Optional[str]) -> None:
+        """Records how a connection to the peer went, failure is the one of
+        MetadataWorker, None for successes."""
+        now = time.monotonic()
+        entry = self._peers.get(peer_address)
+        if entry is None:
+            entry = self._peers[peer_address] = [0.0, now]
+            if len(self._peers) > self.max_peers:
+                self._peers.popitem(last=False)
+        else:
+            self._peers.move_to_end(peer_address)
+
+        if failure is None:
+            self.successes += 1
+            entry[0], entry[1] = 0.0, now
+            return
+
+        self.failures[failure] = self.failures.get(failure, 0) + 1
+        entry[0] = self._decay(entry, now) + PENALTIES.get(failure, 1.0)
+        entry[1] = now
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        stats: Dict[str, float] = {
+            "peers": len(self._peers),
+            "avoided": self.avoided,
+            "successes": self.successes,
+        }
+        for failure, count in self.failures.items():
+            stats[f"failures_{failure}"] = count
+        return stats
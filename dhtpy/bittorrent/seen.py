@@ -0,0 +1,306 @@
+"""
+Probabilistic set of the infohashes already fetched, so a crawler running
+for days does not fetch the metadata of popular torrents over and over.
+
+The set is a chain of Bloom filters, the generations. Infohashes are added
+to the newest one, a new generation starts when it holds as many infohashes
+as it was sized for or, with a rotate interval, when it gets too old, and
+the oldest generation is dropped once there are too many. Infohashes seen
+again are copied to the newest generation, memory is bounded and only the
+infohashes not seen for a while are forgotten.
+
+Every generation is sized for a share of the error rate, the chance that an
+infohash never added is reported as seen stays under the error rate across
+all of them. The bits of a key are picked with SHAKE-128, double hashing
+the infohash bytes would leave a false positive floor well above the error
+rate of small filters.
+
+Layout of a dump, all integers big endian:
+
+    header       magic (8 bytes) | bits per generation (u64) | hashes (u8) |
+                 infohashes per generation (u32) | generations (u8)
+    generations  infohashes (u32) | bits set (u64) | age in seconds (u32) |
+                 bits, oldest generation first
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import math
+import struct
+import time
+from typing import Dict, List, Optional, Union
+
+from dhtpy.config import (
+    SEEN_FILTER_CAPACITY,
+    SEEN_FILTER_ERROR_RATE,
+    SEEN_FILTER_GENERATIONS,
+    SEEN_FILTER_ROTATE_INTERVAL,
+)
+from dhtpy.utils import PersistenceError, write_atomically
+
+MAGIC = b"DHTPYSF\x01"
+HEADER = struct.Struct("!8sQBIB")
+GENERATION = struct.Struct("!IQI")
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class FilterError(PersistenceError):
+    pass
+
+
+class _Generation:
+    __slots__ = ("bits", "count", "set_bits", "created")
+
+    def __init__(self, size: int, created: float):
+        self.bits = bytearray(size)
+        self.count = 0
+        self.set_bits = 0
+        self.created = created
+
+
+class SeenFilter:
+    """Remembers infohashes with a bounded false positive rate.
+
+    Args:
+        capacity: infohashes remembered across all the generations
+        error_rate: chance an infohash never added is reported as seen
+        generations: generations kept, 1 forgets everything at once
+        rotate_interval: seconds after which a new generation starts even if
+        the newest is not full, None to only rotate full generations
+    """
+
+    def __init__(
+        self,
+        capacity: int = SEEN_FILTER_CAPACITY,
+        error_rate: float = SEEN_FILTER_ERROR_RATE,
+        generations: int = SEEN_FILTER_GENERATIONS,
+        rotate_interval: Optional[float] = SEEN_FILTER_ROTATE_INTERVAL,
+    ):
+        self._configure(capacity, error_rate, generations, rotate_interval)
+        self._generations: List[_Generation] = [
+            _Generation(self.size, time.monotonic())
+        ]
+
+    def _configure(
+        self,
+        capacity: int = SEEN_FILTER_CAPACITY,
+        error_rate: float = SEEN_FILTER_ERROR_RATE,
+        generations: int = SEEN_FILTER_GENERATIONS,
+        rotate_interval: Optional[float] = SEEN_FILTER_ROTATE_INTERVAL,
+    ) -> None:
+        """Sets everything but the generations up."""
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        if not 1 <= generations <= 255:
+            raise ValueError("generations must be between 1 and 255")
+
+        self.error_rate = error_rate
+        self.max_generations = generations
+        self.rotate_interval = rotate_interval
+        self.generation_capacity = max(capacity // generations, 1)
+
+        # Optimal size and number of hashes for the share of the error rate
+        rate = error_rate / generations
+        bits = math.ceil(-self.generation_capacity * math.log(rate) / math.log(2) ** 2)
+        self.size = (bits + 7) // 8
+        self.bits_per_generation = self.size * 8
+        self.hashes = max(
+            round(self.bits_per_generation / self.generation_capacity * math.log(2)),
+            1,
+        )
+        # One 64 bits word of the digest per hash
+        self._words = struct.Struct(f"!{self.hashes}Q")
+
+        self.added = 0
+        self.refreshed = 0
+        self.rotations = 0
+
+    def _indexes(self, key: bytes) -> List[int]:
+        m = self.bits_per_generation
+        words = self._words.unpack(hashlib.shake_128(key).digest(self._words.size))
+        return [word % m for word in words]
+
+    def _find(self, indexes: List[int]) -> int:
+        """Returns how many generations are newer than the newest holding
+        the indexes, -1 if none does."""
+        for age, generation in enumerate(reversed(self._generations)):
+            bits = generation.bits
+            for index in indexes:
+                if not bits[index >> 3] & (1 << (index & 7)):
+                    break
+            else:
+                return age
+        return -1
+
+    def __contains__(self, key: bytes) -> bool:
+        return self._find(self._indexes(key)) >= 0
+
+    def __len__(self) -> int:
+        """Infohashes added to the generations kept, an upper bound of the
+        distinct infohashes remembered."""
+        return sum(generation.count for generation in self._generations)
+
+    def add(self, key: bytes) -> bool:
+        """Adds an infohash, returns whether it was already seen."""
+        self._rotate_if_due()
+        indexes = self._indexes(key)
+        age = self._find(indexes)
+        if age < 0:
+            self._insert(indexes)
+            self.added += 1
+        elif age > 0:
+            self._refresh(indexes)
+        return age >= 0
+
+    def refresh(self, key: bytes) -> bool:
+        """Returns whether an infohash was seen, without adding it if it was
+        not."""
+        self._rotate_if_due()
+        indexes = self._indexes(key)
+        age = self._find(indexes)
+        if age > 0:
+            self._refresh(indexes)
+        return age >= 0
+
+    def _refresh(self, indexes: List[int]) -> None:
+        # Only held by older generations, added to the newest again so the
+        # infohashes still seen are never forgotten
+        self._insert(indexes)
+        self.refreshed += 1
+
+    def _rotate_if_due(self) -> None:
+        if self.rotate_interval is None:
+            return
+        now = time.monotonic()
+        if now - self._generations[-1].created >= self.rotate_interval:
+            self.rotate(now)
+
+    def _insert(self, indexes: List[int]) -> None:
+        generation = self._generations[-1]
+        if generation.count >= self.generation_capacity:
+            generation = self.rotate()
+
+        bits = generation.bits
+        for index in indexes:
+            byte, mask = index >> 3, 1 << (index & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                generation.set_bits += 1
+        generation.count += 1
+
+    def rotate(self, now: Optional[float] = None) -> _Generation:
+        """Starts a new generation, dropping the oldest if there are too
+        many."""
+        generation = _Generation(self.size, time.monotonic() if now is None else now)
+        self._generations.append(generation)
+        del self._generations[: -self.max_generations]
+        self.rotations += 1
+        return generation
+
+    @property
+    def fill_ratio(self) -> float:
+        """Share of the bits set in the newest generation, about 0.5 once it
+        holds as many infohashes as it was sized for."""
+        return self._generations[-1].set_bits / self.bits_per_generation
+
+    @property
+    def false_positive_rate(self) -> float:
+        """Estimated chance an infohash never added is reported as seen,
+        given the bits set so far."""
+        miss = 1.0
+        for generation in self._generations:
+            miss *= 1 - (generation.set_bits / self.bits_per_generation) ** self.hashes
+        return 1 - miss
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "infohashes": len(self),
+            "added": self.added,
+            "refreshed": self.refreshed,
+            "generations": len(self._generations),
+            "rotations": self.rotations,
+            "fill_ratio": self.fill_ratio,
+            "false_positive_rate": self.false_positive_rate,
+            "bytes": self.size * len(self._generations),
+        }
+
+    def dump(self) -> bytes:
+        now = time.monotonic()
+        chunks = [
+            HEADER.pack(
+                MAGIC,
+                self.bits_per_generation,
+                self.hashes,
+                self.generation_capacity,
+                len(self._generations),
+            )
+        ]
+        for generation in self._generations:
+            chunks.append(
+                GENERATION.pack(
+                    generation.count,
+                    generation.set_bits,
+                    min(max(int(now - generation.created), 0), 0xFFFFFFFF),
+                )
+            )
+            chunks.append(bytes(generation.bits))
+        return b"".join(chunks)
+
+    async def save(self, path: str) -> None:
+        """Writes the filter to path atomically. The bits are copied in the
+        event loop, writing them runs in the default executor."""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, write_atomically, path, self.dump())
+
+    @classmethod
+    def load(cls, buffer: Buffer, **kwargs) -> SeenFilter:
+        """Restores a filter from a dump, keyword arguments are passed to the
+        constructor. The size of the generations is the one of the dump, it
+        can not change without losing what they hold."""
+        view = memoryview(buffer)
+        try:
+            magic, bits, hashes, capacity, count = HEADER.unpack_from(view)
+        except struct.error:
+            raise FilterError(message="Truncated filter header")
+        if magic != MAGIC:
+            raise FilterError(message="Not a seen filter dump")
+        if not bits or bits % 8 or not hashes or not capacity or not count:
+            raise FilterError(message="Invalid filter header")
+
+        size = bits // 8
+        if len(view) != HEADER.size + count * (GENERATION.size + size):
+            raise FilterError(message="Filter size does not match its header")
+
+        # Not through the constructor, the generation it allocates would be
+        # thrown away
+        seen = cls.__new__(cls)
+        seen._configure(**kwargs)
+        seen.size = size
+        seen.bits_per_generation = bits
+        seen.hashes = hashes
+        seen._words = struct.Struct(f"!{hashes}Q")
+        seen.generation_capacity = capacity
+
+        now = time.monotonic()
+        generations = []
+        offset = HEADER.size
+        for _ in range(count):
+            infohashes, set_bits, age = GENERATION.unpack_from(view, offset)
+            offset += GENERATION.size
+            generation = _Generation(0, now - age)
+            generation.bits = bytearray(view[offset : offset + size])
+            generation.count = infohashes
+            generation.set_bits = set_bits
+            generations.append(generation)
+            offset += size
+        seen._generations = generations[-seen.max_generations :]
+        return seen
+
+    @classmethod
+    def load_file(cls, path: str, **kwargs) -> SeenFilter:
+        with open(path, "rb") as file:
+            return cls.load(file.read(), **kwargs)
@@ -15,3 +15,33 @@ DHT_BOOTSTRAP_NODES = [
 ]
 METADATA_MAX_SIMULTANEOUS_WORKERS_PER_INFOHASH = 3
 METADATA_FETCH_TIMEOUT = 100  # In seconds
+# Seconds to open a connection to a peer, to receive its handshake, then its
+# extension handshake, and seconds without a message while receiving pieces
+METADATA_CONNECT_TIMEOUT = 5
+METADATA_HANDSHAKE_TIMEOUT = 5
+METADATA_EXTENDED_HANDSHAKE_TIMEOUT = 10
+METADATA_PIECE_TIMEOUT = 10
+# Budgets of the metadata fetches: TCP connections open at once, in total and
+# to a single IP, infohashes waiting for a connection, peers remembered for
+# each and seconds an infohash waits before it is dropped
+METADATA_MAX_CONNECTIONS = 500
+METADATA_MAX_CONNECTIONS_PER_IP = 2
+METADATA_MAX_QUEUED_INFOHASHES = 10_000
+METADATA_MAX_PEERS_PER_INFOHASH = 16
+METADATA_MAX_QUEUE_WAIT = 60
+# Seconds a peer of an infohash being fetched has to connect before another
+# one is raced, the connection attempt delay of happy eyeballs (RFC 8305)
+METADATA_RACE_STAGGER = 0.25
+# Infohashes already fetched, remembered by a chain of Bloom filters: how
+# many, chance of skipping an infohash never fetched, filters kept and
+# seconds before a new filter is started
+SEEN_FILTER_CAPACITY = 10_000_000
+SEEN_FILTER_ERROR_RATE = 0.001
+SEEN_FILTER_GENERATIONS = 4
+SEEN_FILTER_ROTATE_INTERVAL = 24 * 60 * 60
+# Reputation of the peers metadata is fetched from: peers remembered,
+# seconds for the penalties of their failures to halve and penalty from which
+# they are skipped
+REPUTATION_MAX_PEERS = 100_000
+REPUTATION_HALF_LIFE = 60 * 60
+REPUTATION_THRESHOLD = 2.0
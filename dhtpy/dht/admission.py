@@ -0,0 +1,157 @@
+"""
+Admission of incoming datagrams, checked before they are decoded.
+
+Datagrams are dropped when they cannot be a KRPC message (size out of bounds
+or not starting like a bencoded dictionary), when they come from a blocked
+network or when their source sends faster than its token bucket allows.
+"""
+
+from __future__ import annotations
+
+import bisect
+import time
+from collections import OrderedDict
+from ipaddress import ip_network
+from socket import inet_aton
+from typing import Dict, Iterable, List, Tuple
+
+from dhtpy.dht.constants import (
+    MAX_MESSAGE_SIZE,
+    MIN_MESSAGE_SIZE,
+    SOURCE_BURST,
+    SOURCE_PACKETS_PER_SECOND,
+    SOURCE_TABLE_SIZE,
+    protected_networks,
+)
+
+Address = Tuple[str, int]
+
+_DICT = ord("d")
+_END = ord("e")
+_DIGITS = frozenset(b"0123456789")
+
+
+class Blocklist:
+    """IPv4 networks, merged into sorted disjoint intervals of addresses.
+
+    Args:
+        networks: networks in CIDR notation, empty entries are ignored
+    """
+
+    def __init__(self, networks: Iterable[str] = ()):
+        intervals = []
+        for network in networks:
+            if network:
+                parsed = ip_network(network, strict=False)
+                intervals.append(
+                    (int(parsed.network_address), int(parsed.broadcast_address))
+                )
+        intervals.sort()
+
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+        for start, end in intervals:
+            if self._ends and start <= self._ends[-1] + 1:
+                self._ends[-1] = max(self._ends[-1], end)
+            else:
+                self._starts.append(start)
+                self._ends.append(end)
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __contains__(self, host: str) -> bool:
+        try:
+            ip = int.from_bytes(inet_aton(host), "big")
+        except OSError:
+            return False
+        i = bisect.bisect_right(self._starts, ip) - 1
+        return i >= 0 and ip <= self._ends[i]
+
+
+class AdmissionFilter:
+    """Decides which datagrams are worth decoding.
+
+    Every source address gets a token bucket of burst packets refilled at
+    rate packets per second. Buckets are kept in least recently used order
+    and the oldest is forgotten when there are max_sources of them, so a
+    flood of spoofed addresses costs bounded memory. Whether the source is
+    blocked is looked up once, when its bucket is created.
+
+    Args:
+        blocklist: networks whose datagrams are dropped
+        rate: sustained packets per second accepted from a source
+        burst: packets a source can send at once
+        max_sources: sources whose buckets are remembered
+    """
+
+    def __init__(
+        self,
+        blocklist: Iterable[str] = protected_networks,
+        rate: float = SOURCE_PACKETS_PER_SECOND,
+        burst: float = SOURCE_BURST,
+        max_sources: int = SOURCE_TABLE_SIZE,
+    ):
+        self.blocklist = Blocklist(blocklist)
+        self.rate = rate
+        self.burst = burst
+        self.max_sources = max_sources
+        # Source host to [tokens, last refill, blocked], lists rather than
+        # TokenBucket objects, this runs for every datagram
+        self._sources: OrderedDict[str, List] = OrderedDict()
+
+        self.admitted = 0
+        self.malformed = 0
+        self.blocked = 0
+        self.throttled = 0
+
+    def admit(self, data: bytes, address: Address) -> bool:
+        """Returns whether the datagram should be decoded."""
+        size = len(data)
+        if (
+            not MIN_MESSAGE_SIZE <= size <= MAX_MESSAGE_SIZE
+            or data[0] != _DICT
+            or data[1] not in _DIGITS
+            or data[-1] != _END
+        ):
+            self.malformed += 1
+            return False
+
+        now = time.monotonic()
+        host = address[0]
+        sources = self._sources
+        bucket = sources.get(host)
+        if bucket is None:
+            blocked = bool(self.blocklist) and host in self.blocklist
+            if len(sources) >= self.max_sources:
+                sources.popitem(last=False)
+            sources[host] = [self.burst - 1, now, blocked]
+            if blocked:
+                self.blocked += 1
+                return False
+        else:
+            sources.move_to_end(host)
+            if bucket[2]:
+                self.blocked += 1
+                return False
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                self.throttled += 1
+                return False
+            bucket[0] = tokens - 1
+
+        self.admitted += 1
+        return True
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "admitted": self.admitted,
+            "malformed": self.malformed,
+            "blocked": self.blocked,
+            "throttled": self.throttled,
+            "sources": len(self._sources),
+            "blocked_networks": len(self.blocklist),
+        }
@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import struct
+import time
+from typing import TYPE_CHECKING, Dict, Iterator, List, Set, Tuple, Union
+
+from dhtpy.dht.structures import Node, nid_to_int
+
+if TYPE_CHECKING:
+    import numpy as np
+else:
+    try:
+        import numpy as np
+    except ImportError:  # pragma: no cover
+        np = None
+
+# Layout of a node in its compact form: 20 bytes id, 4 bytes ip and 2 bytes port
+COMPACT_NODE_DTYPE = (
+    np.dtype([("id", ">u4", (5,)), ("ip", ">u4"), ("port", ">u2")]) if np else None
+)
+# The same layout with the id split in the parts its key is computed from,
+# and the port
+KEYED_NODE = struct.Struct("!QQI4xH")
+# Odd multiplier of the polynomial hashing the parts of the ids into their key
+KEY_MULTIPLIER = 0x9E3779B97F4A7C15
+KEY_MASK = (1 << 64) - 1
+
+
+def _key(high: int, low: int, last: int) -> int:
+    return ((high * KEY_MULTIPLIER + low) * KEY_MULTIPLIER + last) & KEY_MASK
+
+
+class ArrayRoutingTable:
+    """Array backed alternative to SimpleRoutingTable meant for crawlers keeping
+    millions of neighbors, requires numpy.
+
+    Ids are stored as five uint32 columns, with ips, ports and last contact
+    times in parallel arrays. Closest nodes and expiry are computed with
+    vectorized operations and Node objects are only created for the nodes that
+    are returned.
+
+    Ids already in the table are not added again, the address and last
+    contact of their node are refreshed instead. They are looked up by a 64
+    bits hash of the whole id, in a sorted array of the keys and the rows of
+    their nodes plus a dict of the keys added since it was last merged into
+    the arrays.
+    """
+
+    # Keys added before they are merged into the sorted array, at least, or
+    # a sixteenth of it so that merges cost the same for every key
+    MERGE_SIZE = 4096
+
+    def __init__(self, max_size: int = 1_000_000, initial_capacity: int = 1024):
+        if np is None:
+            raise ImportError("ArrayRoutingTable requires numpy")
+
+        self.max_size = max_size
+        self._size = 0
+        self._ids = np.zeros((0, 5), dtype=np.uint32)
+        self._ips = np.zeros(0, dtype=np.uint32)
+        self._ports = np.zeros(0, dtype=np.uint16)
+        self._last_contact = np.zeros(0, dtype=np.float64)
+        self._grow(min(initial_capacity, max_size))
+
+        self._keys = np.zeros(0, dtype=np.uint64)
+        self._key_rows = np.zeros(0, dtype=np.intp)
+        # Key to row of the nodes added since the last merge
+        self._recent_keys: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[Node]:
+        for i in range(self._size):
+            yield self._node(i)
+
+    @property
+    def is_full(self) -> bool:
+        return self._size >= self.max_size
+
+    @property
+    def is_empty(self) -> bool:
+        return self._size == 0
+
+    def _grow(self, capacity: int) -> None:
+        self._ids = np.resize(self._ids, (capacity, 5))
+        self._ips = np.resize(self._ips, capacity)
+        self._ports = np.resize(self._ports, capacity)
+        self._last_contact = np.resize(self._last_contact, capacity)
+
+    def _reserve(self, count: int) -> int:
+        """Makes room for up to count more nodes, returns how many fit."""
+        count = min(count, self.max_size - self._size)
+        needed = self._size + count
+        if needed > len(self._ips):
+            self._grow(min(max(needed, 2 * len(self._ips)), self.max_size))
+        return count
+
+    @staticmethod
+    def _id_keys(ids: np.ndarray) -> np.ndarray:
+        """64 bits keys of the ids, the same as _key computes. Two different
+        ids only share one when it was crafted to, and then the later one is
+        neither added nor refreshes the other."""
+        ids = ids.astype(np.uint64)
+        high = (ids[:, 0] << np.uint64(32)) | ids[:, 1]
+        low = (ids[:, 2] << np.uint64(32)) | ids[:, 3]
+        multiplier = np.uint64(KEY_MULTIPLIER)
+        return (high * multiplier + low) * multiplier + ids[:, 4]
+
+    def _merge_recent_keys(self) -> None:
+        count = len(self._recent_keys)
+        keys = np.fromiter(self._recent_keys.keys(), dtype=np.uint64, count=count)
+        rows = np.fromiter(self._recent_keys.values(), dtype=np.intp, count=count)
+        order = np.argsort(keys)
+        keys, rows = keys[order], rows[order]
+        positions = np.searchsorted(self._keys, keys)
+        self._keys = np.insert(self._keys, positions, keys)
+        self._key_rows = np.insert(self._key_rows, positions, rows)
+        self._recent_keys.clear()
+
+    def _lookup(
+        self, encoded_nodes: bytes, count: int
+    ) -> Tuple[List[int], List[int], List[int], List[int]]:
+        """Splits the nodes of the buffer with a port, and not repeated
+        earlier in it, into the ones to add with their keys and the ones
+        whose key is in the table with the row it belongs to. Buffers are
+        usually a response's 8 nodes, for which a loop costs less than numpy
+        calls."""
+        new: List[int] = []
+        keys: List[int] = []
+        known: List[int] = []
+        rows: List[int] = []
+        seen: Set[int] = set()
+        for index, (high, low, last, port) in enumerate(
+            KEYED_NODE.iter_unpack(encoded_nodes[: count * 26])
+        ):
+            key = _key(high, low, last)
+            if not port or key in seen:
+                continue
+            seen.add(key)
+            row = self._recent_keys.get(key)
+            if row is None:
+                new.append(index)
+                keys.append(key)
+            else:
+                known.append(index)
+                rows.append(row)
+
+        size = len(self._keys)
+        if not size or not keys:
+            return new, keys, known, rows
+
+        positions = self._keys.searchsorted(np.array(keys, dtype=np.uint64))
+        unknown: List[int] = []
+        unknown_keys: List[int] = []
+        for index, key, position in zip(new, keys, positions.tolist()):
+            if position < size and self._keys.item(position) == key:
+                known.append(index)
+                rows.append(self._key_rows.item(position))
+            else:
+                unknown.append(index)
+                unknown_keys.append(key)
+        return unknown, unknown_keys, known, rows
+
+    def _compact(self, indexes: np.ndarray) -> bytes:
+        rows = np.empty(len(indexes), dtype=COMPACT_NODE_DTYPE)
+        rows["id"] = self._ids[indexes]
+        rows["ip"] = self._ips[indexes]
+        rows["port"] = self._ports[indexes]
+        return rows.tobytes()
+
+    def _node(self, index: int) -> Node:
+        node = Node.from_compact(self._compact(np.array([index])))
+        node.last_contact = float(self._last_contact[index])
+        return node
+
+    def add(self, node: Node) -> bool:
+        return self.add_compact(node.compact_info) == 1
+
+    def add_compact(self, encoded_nodes: bytes) -> int:
+        """
+        Adds the nodes of a compact nodes buffer, as found in the ``nodes`` key
+        of find_node and get_peers responses, without decoding them into Node
+        objects. Nodes with port 0 are skipped, nodes whose id is already in
+        the table get their address and last contact refreshed.
+
+        Returns the number of nodes added.
+        """
+        now = time.monotonic()
+        count = len(encoded_nodes) // 26
+        rows = np.frombuffer(encoded_nodes, dtype=COMPACT_NODE_DTYPE, count=count)
+        new, keys, known, known_rows = self._lookup(encoded_nodes, count)
+
+        if known:
+            refreshed = rows[known]
+            table_rows = np.array(known_rows, dtype=np.intp)
+            # Only the ids sharing their key with another are left out
+            same = np.all(self._ids[table_rows] == refreshed["id"], axis=1)
+            if not same.all():
+                refreshed, table_rows = refreshed[same], table_rows[same]
+            self._ips[table_rows] = refreshed["ip"]
+            self._ports[table_rows] = refreshed["port"]
+            self._last_contact[table_rows] = now
+
+        count = self._reserve(len(new))
+        rows = rows[new[:count]]
+        start, end = self._size, self._size + count
+        self._ids[start:end] = rows["id"]
+        self._ips[start:end] = rows["ip"]
+        self._ports[start:end] = rows["port"]
+        self._last_contact[start:end] = now
+        self._size = end
+
+        for row, key in enumerate(keys[:count], start):
+            self._recent_keys[key] = row
+        if len(self._recent_keys) >= max(self.MERGE_SIZE, len(self._keys) // 16):
+            self._merge_recent_keys()
+        return count
+
+    def _closest_indexes(self, nid: Union[bytes, int, str], limit: int) -> np.ndarray:
+        if self._size == 0 or limit <= 0:
+            return np.zeros(0, dtype=np.intp)
+
+        target_bytes = nid_to_int(nid).to_bytes(20, "big")
+        target = np.frombuffer(target_bytes, dtype=">u4").astype(np.uint32)
+        ids = self._ids[: self._size]
+
+        # Preselect using the 64 most significant bits of the distance, keeping
+        # every node tied with the limit-th one, then sort those exactly
+        keys = ((ids[:, 0] ^ target[0]).astype(np.uint64) << np.uint64(32)) | (
+            ids[:, 1] ^ target[1]
+        )
+        if self._size > limit:
+            threshold = keys[np.argpartition(keys, limit - 1)[:limit]].max()
+            candidates = np.flatnonzero(keys <= threshold)
+        else:
+            candidates = np.arange(self._size)
+
+        distances = ids[candidates] ^ target
+        order = np.lexsort(distances.T[::-1])
+        return candidates[order[:limit]]
+
+    def get_closest_nodes(self, nid: Union[bytes, int, str], limit=8) -> List[Node]:
+        """Get closest nodes to the id provided, sorted by distance."""
+        return [self._node(i) for i in self._closest_indexes(nid, limit)]
+
+    def get_closest_compact(self, nid: Union[bytes, int, str], limit=8) -> bytes:
+        """Same as get_closest_nodes but returns the nodes already joined in
+        their compact form, ready to be sent in a reply."""
+        return self._compact(self._closest_indexes(nid, limit))
+
+    def remove_expired(self, max_age: float) -> int:
+        """Removes the nodes without contact in the last max_age seconds,
+        returns the number of nodes removed."""
+        size = self._size
+        keep = self._last_contact[:size] >= time.monotonic() - max_age
+        kept = int(np.count_nonzero(keep))
+        if kept == size:
+            return 0
+
+        self._ids[:kept] = self._ids[:size][keep]
+        self._ips[:kept] = self._ips[:size][keep]
+        self._ports[:kept] = self._ports[:size][keep]
+        self._last_contact[:kept] = self._last_contact[:size][keep]
+        self._size = kept
+        keys = self._id_keys(self._ids[:kept])
+        self._key_rows = np.argsort(keys)
+        self._keys = keys[self._key_rows]
+        self._recent_keys.clear()
+        return size - kept
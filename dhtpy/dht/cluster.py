@@ -0,0 +1,239 @@
+"""
+Runs one DHT node per core.
+
+Every worker process runs its own Server, with its own routing table, on the
+same UDP port bound with SO_REUSEPORT. The kernel spreads incoming datagrams
+across the workers by source address, so a remote node always talks to the
+same worker. Each worker owns a node id in its own slice of the keyspace,
+which keeps their routing tables and the infohashes they see apart.
+
+The kernel would spread the responses to the queries of a worker across all
+of them too, so every worker sends its queries out of a port of its own, see
+dhtpy.dht.rpc.RPC.
+
+Workers report the infohashes they discovered and their stats to the
+coordinator in the parent process over a multiprocessing queue.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import signal
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from dhtpy.dht.constants import CLUSTER_MAX_INFOHASHES
+from dhtpy.dht.routing import MAX_NID
+
+logger = logging.getLogger(__name__)
+
+# (worker index, infohashes discovered since the last report, server stats)
+WorkerReport = Tuple[int, List[bytes], Dict[str, float]]
+
+
+def partition_nid(index: int, workers: int) -> int:
+    """Random node id within the index-th of workers equal slices of the
+    keyspace."""
+    size = (MAX_NID + 1) // workers
+    return index * size + random.randrange(size)
+
+
+class Coordinator:
+    """Merges the reports of the workers.
+
+    Args:
+        on_infohash: called once for every infohash discovered by any worker,
+        as long as it is among the max_infohashes most recently reported
+        max_infohashes: infohashes remembered, the least recently reported
+        are forgotten first
+    """
+
+    def __init__(
+        self,
+        on_infohash: Optional[Callable[[bytes], None]] = None,
+        max_infohashes: int = CLUSTER_MAX_INFOHASHES,
+    ):
+        self.on_infohash = on_infohash
+        self.max_infohashes = max_infohashes
+        self.infohashes: OrderedDict[bytes, None] = OrderedDict()
+        self.worker_stats: Dict[int, Dict[str, float]] = dict()
+        self.discovered = 0
+
+    def handle(self, report: WorkerReport) -> None:
+        index, infohashes, stats = report
+        self.worker_stats[index] = stats
+        for infohash in infohashes:
+            if infohash in self.infohashes:
+                self.infohashes.move_to_end(infohash)
+                continue
+
+            self.infohashes[infohash] = None
+            if len(self.infohashes) > self.max_infohashes:
+                self.infohashes.popitem(last=False)
+            self.discovered += 1
+            if self.on_infohash:
+                self.on_infohash(infohash)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Stats of the workers summed up, ratios are averaged."""
+        stats: Dict[str, float] = {
+            "workers": len(self.worker_stats),
+            "infohashes": self.discovered,
+        }
+        for worker_stats in self.worker_stats.values():
+            for key, value in worker_stats.items():
+                stats[key] = stats.get(key, 0) + value
+        if self.worker_stats:
+            for key in stats:
+                if key.endswith(("_rate", "_factor")):
+                    stats[key] /= len(self.worker_stats)
+        return stats
+
+
+async def _serve(
+    index: int,
+    workers: int,
+    address: str,
+    port: int,
+    reports: Any,
+    report_interval: float,
+    server_kwargs: Dict[str, Any],
+) -> None:
+    # Imported here so the parent process does not need a Server
+    from dhtpy.dht.server import Server
+
+    if server_kwargs.get("snapshot_path"):
+        server_kwargs["snapshot_path"] = f"{server_kwargs['snapshot_path']}.{index}"
+
+    server = Server(nid=partition_nid(index, workers), **server_kwargs)
+    infohashes: Set[bytes] = set()
+    server.on_infohash = infohashes.add
+    await server.start(address, port, run_forever=False, reuse_port=True)
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopped.set)
+
+    while not stopped.is_set():
+        try:
+            await asyncio.wait_for(stopped.wait(), report_interval)
+        except asyncio.TimeoutError:
+            pass
+        reports.put((index, list(infohashes), server.stats))
+        infohashes.clear()
+
+    await server.stop()
+
+
+def _run_worker(*args) -> None:
+    asyncio.run(_serve(*args))
+
+
+class Cluster:
+    """Starts and supervises the worker processes.
+
+    Args:
+        workers: number of worker processes, one per core by default
+        address: address the workers bind
+        port: port the workers share
+        report_interval: seconds between the reports of every worker
+        on_infohash: called in the parent process for every new infohash
+        server_kwargs: passed to the Server of every worker, a snapshot_path
+        gets the index of the worker appended
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        address: str = "0.0.0.0",
+        port: int = 6881,
+        report_interval: float = 1.0,
+        on_infohash: Optional[Callable[[bytes], None]] = None,
+        **server_kwargs,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.address = address
+        self.port = port
+        self.report_interval = report_interval
+        self.server_kwargs = server_kwargs
+        self.coordinator = Coordinator(on_infohash)
+
+        # Spawned, not forked, so workers never inherit a running event loop
+        self._context = multiprocessing.get_context("spawn")
+        self._reports = self._context.Queue()
+        self._processes: List[multiprocessing.process.BaseProcess] = []
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return self.coordinator.stats
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            process = self._context.Process(
+                target=_run_worker,
+                args=(
+                    index,
+                    self.workers,
+                    self.address,
+                    self.port,
+                    self._reports,
+                    self.report_interval,
+                    self.server_kwargs,
+                ),
+                name=f"dhtpy-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+    def poll(self, timeout: float = 1.0) -> int:
+        """Handles the reports that arrive within timeout, returns how many."""
+        handled = 0
+        try:
+            report = self._reports.get(timeout=timeout)
+            while True:
+                self.coordinator.handle(report)
+                handled += 1
+                report = self._reports.get_nowait()
+        except queue.Empty:
+            pass
+        return handled
+
+    @property
+    def is_alive(self) -> bool:
+        return any(process.is_alive() for process in self._processes)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Asks the workers to stop, saving their snapshots, and waits for
+        them."""
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.error(f"{process.name} did not stop, killing it")
+                process.kill()
+        self._processes = []
+
+    def run(self) -> None:
+        """Starts the workers and merges their reports until they exit."""
+        self.start()
+        try:
+            while self.is_alive:
+                self.poll(self.report_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+if __name__ == "__main__":
+    Cluster().run()
@@ -1 +1,60 @@
-protected_networks = [""]
+from typing import List
+
+# Networks, in CIDR notation, whose datagrams are dropped before decoding
+protected_networks: List[str] = []
+
+# Seconds without contact after which a node is considered questionable
+NODE_UNHEARD_TIMEOUT = 15 * 60
+# Seconds without contact after which a node is considered offline
+NODE_OFFLINE_TIMEOUT = 20 * 60
+# Seconds an announced peer is kept after its last announce
+PEER_TTL = 30 * 60
+# Seconds between two secrets announce tokens are made from, and their size
+TOKEN_SECRET_INTERVAL = 5 * 60
+TOKEN_SIZE = 8
+
+# Iterative lookups: queries in flight, closest nodes converged on and
+# seconds a whole lookup may take
+LOOKUP_ALPHA = 3
+LOOKUP_K = 8
+LOOKUP_TIMEOUT = 30
+
+# Outgoing traffic limits and number of datagrams waiting to be sent
+SEND_PACKETS_PER_SECOND = 5000
+SEND_BYTES_PER_SECOND = 2 * 1024 * 1024
+SEND_QUEUE_SIZE = 10000
+
+# Shortest and longest KRPC message accepted, in bytes
+MIN_MESSAGE_SIZE = 12
+MAX_MESSAGE_SIZE = 2048
+
+# Incoming packets per second accepted from a single address, packets it can
+# send at once and number of addresses tracked
+SOURCE_PACKETS_PER_SECOND = 20
+SOURCE_BURST = 100
+SOURCE_TABLE_SIZE = 100_000
+
+# BEP 51, infohashes in a sample_infohashes reply and seconds between samples
+SAMPLE_INFOHASHES_COUNT = 20
+SAMPLE_INFOHASHES_INTERVAL = 300
+
+# sample_infohashes crawls: queries in flight, queries per second, nodes
+# tracked, infohashes remembered to yield each once and bounds of the seconds
+# between two visits of a node
+CRAWL_CONCURRENCY = 64
+CRAWL_QUERIES_PER_SECOND = 200
+CRAWL_MAX_NODES = 100_000
+CRAWL_MAX_INFOHASHES = 1_000_000
+CRAWL_MIN_INTERVAL = 60
+CRAWL_MAX_INTERVAL = 6 * 60 * 60
+
+# Neighbor crawls: nodes kept to send find_node to, find_node queries per
+# second, infohashes remembered to report each once and seconds between
+# reports
+NEIGHBOR_MAX_NODES = 10000
+NEIGHBOR_QUERIES_PER_SECOND = 1000
+NEIGHBOR_MAX_INFOHASHES = 100_000
+NEIGHBOR_REPORT_INTERVAL = 10
+
+# Infohashes the coordinator of a cluster remembers to report each only once
+CLUSTER_MAX_INFOHASHES = 1_000_000
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from typing import (
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+)
+
+from dhtpy.dht.constants import (
+    CRAWL_CONCURRENCY,
+    CRAWL_MAX_INFOHASHES,
+    CRAWL_MAX_INTERVAL,
+    CRAWL_MAX_NODES,
+    CRAWL_MIN_INTERVAL,
+    CRAWL_QUERIES_PER_SECOND,
+)
+from dhtpy.dht.exceptions import DHTException
+from dhtpy.dht.ratelimit import TokenBucket
+from dhtpy.dht.structures import Node
+from dhtpy.dht.timers import DeadlineQueue
+from dhtpy.dht.utils import decode_nodes, split_samples
+
+
+class SampleCrawler:
+    """Discovers infohashes with BEP 51 sample_infohashes queries.
+
+    Every node known is asked for a sample of its infohashes with a random
+    target, so the nodes it returns along with the samples spread the crawl
+    over the whole keyspace. Nodes are visited again once the interval they
+    give has passed, bound by min_interval and max_interval, and nodes that
+    store no infohash (num is 0) only every max_interval. Nodes that do not
+    answer, or answer without samples as they do not support the extension,
+    are forgotten once the nodes they return are added. When max_nodes are
+    tracked the least recently useful one, the one that last returned
+    samples the longest ago, is forgotten to make room for a new one.
+
+    Iterating over a crawler runs it and yields the infohashes not seen
+    among the max_infohashes most recently sampled, awaiting ``run`` runs it
+    and only calls ``on_infohash``. It runs until ``stop`` is called or no
+    node is left to visit.
+
+    Args:
+        seeds: nodes to start from, usually the routing table
+        query: sends sample_infohashes to a node with a target and returns
+        the future of its response, i.e. ``Server.sample_infohashes``
+        concurrency: number of queries in flight
+        rate: queries per second
+        max_nodes: nodes tracked, the least recently useful are forgotten first
+        max_infohashes: infohashes remembered, the least recently sampled are
+        forgotten first
+        min_interval: minimum seconds between two visits of a node
+        max_interval: maximum seconds between two visits of a node
+    """
+
+    def __init__(
+        self,
+        seeds: Iterable[Node],
+        query: Callable[[Node, bytes], asyncio.Future],
+        concurrency: int = CRAWL_CONCURRENCY,
+        rate: float = CRAWL_QUERIES_PER_SECOND,
+        max_nodes: int = CRAWL_MAX_NODES,
+        max_infohashes: int = CRAWL_MAX_INFOHASHES,
+        min_interval: float = CRAWL_MIN_INTERVAL,
+        max_interval: float = CRAWL_MAX_INTERVAL,
+    ):
+        self._query = query
+        self.concurrency = concurrency
+        self.max_nodes = max_nodes
+        self.max_infohashes = max_infohashes
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._bucket = TokenBucket(rate, max(1.0, rate / 10))
+
+        # Nodes tracked, the least recently useful first. Entries of the
+        # nodes forgotten are skipped when they are due
+        self._nodes: OrderedDict[Node, None] = OrderedDict()
+        self._schedule: DeadlineQueue[Node] = DeadlineQueue()
+        self._ready: Deque[Node] = deque()
+        self.infohashes: OrderedDict[bytes, None] = OrderedDict()
+        self._started = False
+        self._stopped = False
+        self._wakeup: Optional[asyncio.Future] = None
+
+        # Callbacks
+        self.on_infohash: Optional[Callable[[bytes], None]] = None
+
+        self.queries = 0
+        self.responses = 0
+        self.failures = 0
+        self.unsupported = 0
+        self.samples = 0
+        self.discovered = 0
+        self.started_at: Optional[float] = None
+        self.elapsed = 0.0
+
+        for node in seeds:
+            self.add(node)
+
+    def add(self, node: Node) -> None:
+        """Visits the node as soon as possible, unless it is already tracked.
+        Forgets the least recently useful node when max_nodes are tracked."""
+        if node in self._nodes or not node.is_valid_port:
+            return
+        if len(self._nodes) >= self.max_nodes:
+            self._nodes.popitem(last=False)
+        self._nodes[node] = None
+        self._ready.append(node)
+
+    def stop(self) -> None:
+        self._stopped = True
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._run()
+
+    async def run(self) -> None:
+        async for _ in self:
+            pass
+
+    def _next_delay(self, now: float, in_flight: int) -> Optional[float]:
+        """Seconds until another query can be sent, None if nothing is left
+        to visit."""
+        if in_flight >= self.concurrency:
+            return None
+        if self._ready:
+            return self._bucket.delay(1)
+        deadline = self._schedule.next_deadline
+        return None if deadline is None else max(0.0, deadline - now)
+
+    async def _run(self) -> AsyncIterator[bytes]:
+        if self._started:
+            raise RuntimeError("A crawler can only run once")
+        self._started = True
+
+        loop = asyncio.get_running_loop()
+        self.started_at = time.monotonic()
+        in_flight: Dict[asyncio.Future, Node] = dict()
+        try:
+            while not self._stopped:
+                now = time.monotonic()
+                self._ready.extend(node for _, node in self._schedule.pop_expired(now))
+                while self._ready and len(in_flight) < self.concurrency:
+                    if self._ready[0] not in self._nodes:
+                        self._ready.popleft()
+                        continue
+                    if not self._bucket.consume(1, now):
+                        break
+                    node = self._ready.popleft()
+                    self.queries += 1
+                    in_flight[self._query(node, os.urandom(20))] = node
+
+                delay = self._next_delay(now, len(in_flight))
+                if not in_flight and delay is None:
+                    break
+
+                self._wakeup = loop.create_future()
+                done, _ = await asyncio.wait(
+                    {self._wakeup, *in_flight},
+                    timeout=delay,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for future in done:
+                    if future is self._wakeup:
+                        continue
+                    node = in_flight.pop(future)
+                    for infohash in self._on_response(node, future):
+                        yield infohash
+        finally:
+            self.elapsed = time.monotonic() - self.started_at
+            for future in in_flight:
+                future.cancel()
+
+    def _on_response(self, node: Node, future: asyncio.Future) -> List[bytes]:
+        response = None
+        if not future.cancelled():
+            try:
+                response = future.result().get(b"r")
+            except DHTException:
+                pass
+
+        if not isinstance(response, Mapping):
+            self.failures += 1
+            self._nodes.pop(node, None)
+            return []
+
+        self.responses += 1
+        nodes = response.get(b"nodes")
+        if isinstance(nodes, bytes):
+            for found in decode_nodes(nodes):
+                self.add(found)
+
+        samples = response.get(b"samples")
+        if not isinstance(samples, bytes):
+            self.unsupported += 1
+            self._nodes.pop(node, None)
+            return []
+
+        # Unless it was forgotten to make room while it was queried
+        if node in self._nodes:
+            self._nodes.move_to_end(node)
+            interval = response.get(b"interval")
+            if not isinstance(interval, int) or response.get(b"num") == 0:
+                interval = self.max_interval
+            interval = min(self.max_interval, max(self.min_interval, interval))
+            self._schedule.push(time.monotonic() + interval, node)
+
+        infohashes = []
+        for infohash in split_samples(samples):
+            self.samples += 1
+            if infohash in self.infohashes:
+                self.infohashes.move_to_end(infohash)
+                continue
+
+            self.infohashes[infohash] = None
+            if len(self.infohashes) > self.max_infohashes:
+                self.infohashes.popitem(last=False)
+            self.discovered += 1
+            infohashes.append(infohash)
+            if self.on_infohash:
+                self.on_infohash(infohash)
+        return infohashes
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        elapsed = self.elapsed
+        if self.started_at is not None and not elapsed:
+            elapsed = time.monotonic() - self.started_at
+        return {
+            "queries": self.queries,
+            "responses": self.responses,
+            "failures": self.failures,
+            "unsupported": self.unsupported,
+            "samples": self.samples,
+            "infohashes": self.discovered,
+            "nodes": len(self._nodes),
+            "scheduled": len(self._schedule),
+            "elapsed": elapsed,
+            "queries_per_second": self.queries / elapsed if elapsed else 0.0,
+            "samples_per_second": self.samples / elapsed if elapsed else 0.0,
+            "infohashes_per_minute": (
+                self.discovered * 60 / elapsed if elapsed else 0.0
+            ),
+        }
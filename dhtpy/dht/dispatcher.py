@@ -1,116 +1,125 @@
 import logging
 from abc import abstractmethod
-from typing import List, Tuple, cast
+from collections.abc import Mapping
+from typing import Callable, Dict, List, Optional, Tuple
 
 from dhtpy.dht import utils as dht_utils
+from dhtpy.dht.krpc import KRPCMessage
 from dhtpy.dht.rpc import RPC
 from dhtpy.dht.structures import Node
 
 logger = logging.getLogger(__name__)
 
+Handler = Callable[[Node, Mapping], None]
+
 
-# TODO handle sample_infohashes
 class DHTDispatcher:
+    """Calls the handler of every message received by the RPC.
+
+    Handlers are looked up by the message type and the query name: the one
+    in the message for queries, the one of the query the response answers
+    for responses, as the transaction it belongs to remembers it.
+    """
+
     def __init__(self, rpc: RPC):
         self._running = True
 
         rpc.on_response = self.on_response
-        self._handlers = {
-            "get_peers_query": self.on_get_peers_query,
-            "get_peers_response": self._get_peers_response,
-            "find_node_query": self.on_find_node_query,
-            "find_node_response": self._find_node_response,
-            "ping_query": self.on_ping_query,
-            "ping_response": self._ping_response,
-            "announce_peer_response": None,
-            "announce_peer_query": self.on_announce_peer_query,
+        self._handlers: Dict[Tuple[bytes, Optional[bytes]], Handler] = {
+            (b"q", b"ping"): self.on_ping_query,
+            (b"q", b"find_node"): self.on_find_node_query,
+            (b"q", b"get_peers"): self.on_get_peers_query,
+            (b"q", b"announce_peer"): self._announce_peer_query,
+            (b"q", b"sample_infohashes"): self.on_sample_infohashes_query,
+            (b"r", b"ping"): self._ping_response,
+            (b"r", b"find_node"): self._find_node_response,
+            (b"r", b"get_peers"): self._get_peers_response,
+            (b"r", b"announce_peer"): self._announce_peer_response,
+            (b"r", b"sample_infohashes"): self._sample_infohashes_response,
         }
 
-    def _get_node_from_data(self, address: Tuple[str, int], data: dict):
-        port = address[1]
+    def _get_node_from_data(self, address: Tuple[str, int], data: Mapping) -> Node:
+        """The node that sent the message, always at the address it was sent
+        from."""
+        arguments = data.get(b"a")
+        if arguments is not None:
+            node_id = arguments[b"id"]
+        else:
+            node_id = data[b"r"][b"id"]
+        return Node(id=node_id, address=address[0], port=address[1])
 
-        node_id = "0000000000000000000000000000000000000000"
-        if b"a" in data:
-            node_id = data[b"a"][b"id"].hex()
+    # Handlers
+    # Queries
+    def _announce_peer_query(self, node: Node, data: Mapping):
+        # The peer listens on the port of the query unless implied_port is
+        # 0, then on the port given, with the one of the query as fallback
+        # in case of a malformed query
+        arguments = data[b"a"]
+        port = node.port
+        if not arguments.get(b"implied_port", 0):
+            port = arguments.get(b"port", port)
+        if isinstance(port, int) and 0 < port < 65536:
+            self.on_announce_peer_query(node, data, port)
 
-        if b"r" in data:
-            node_id = data[b"r"][b"id"].hex()
+    # Responses
+    def _ping_response(self, node: Node, data: Mapping):
+        self.on_ping_response(tid=data[b"t"], node=node)
 
-        # For queries, if implied_port == 0 then use the port of the data, with the
-        # port of the node as fallback in case of a malformed response
-        if data.get(b"a") and not data[b"a"].get(b"implied_port", 0):
-            port = data[b"a"].get(b"port", address[1])
-        return Node(id=node_id, address=address[0], port=port)
+    def _find_node_response(self, node: Node, data: Mapping):
+        self.on_find_node_response(data[b"t"], _nodes(data[b"r"]))
 
-    # Handlers
-    # Responses
-    def _get_peers_response(self, node: Node, data: dict):
-        response = data.get(b"r", {})
+    def _get_peers_response(self, node: Node, data: Mapping):
+        response = data[b"r"]
+        values = response.get(b"values")
         self.on_get_peers_response(
-            tid=cast(bytes, data.get(b"t")),
+            tid=data[b"t"],
             token=response.get(b"token"),
-            nodes=response.get(b"nodes"),
-            values=response.get(b"values"),
+            nodes=_nodes(response),
+            values=values if isinstance(values, list) else [],
         )
 
-    def _find_node_response(self, node: Node, data: dict):
-        decoded_nodes = dht_utils.decode_nodes(data[b"r"][b"nodes"])
-        self.on_find_node_response(cast(bytes, data.get(b"t")), decoded_nodes)
-
-    def _ping_response(self, node: Node, data: dict):
-        self.on_ping_response(
-            tid=cast(bytes, data.get(b"t")),
-            node=Node(id=node.id, address=node.address, port=node.port),
+    def _announce_peer_response(self, node: Node, data: Mapping):
+        self.on_announce_peer_response(tid=data[b"t"], node=node)
+
+    def _sample_infohashes_response(self, node: Node, data: Mapping):
+        response = data[b"r"]
+        samples = response.get(b"samples")
+        if not isinstance(samples, bytes):
+            samples = b""
+        num = response.get(b"num")
+        interval = response.get(b"interval")
+        self.on_sample_infohashes_response(
+            tid=data[b"t"],
+            node=node,
+            samples=dht_utils.split_samples(samples),
+            nodes=_nodes(response),
+            num=num if isinstance(num, int) else 0,
+            interval=interval if isinstance(interval, int) else 0,
         )
 
-    def _detect_packet_type_handler(self, data: dict):
-        method_name = None
-        if data.get(b"y") == b"q":
-            query = data.get(b"b")
-            if query == b"announce_peer":
-                method_name = "announce_peer_query"
-            elif query == b"find_node":
-                method_name = "find_node_query"
-            elif query == b"get_peers":
-                method_name = "get_peers_query"
-            elif query == b"sample_infohashes":
-                method_name = "sample_infohashes_query"
-            elif query == b"ping":
-                method_name = "ping_query"
-
-        if data.get(b"y") == b"r":
-            response = data.get(b"r", {})
-            if b"values" in response:
-                method_name = "get_peers_response"
-            elif (
-                b"nodes" in response and len(response[b"nodes"]) % 26 == 0
-            ):  # Validate nodes format
-                method_name = "find_node_response"
-            elif set(response.keys()) <= {b"id", b"ip", b"p"}:
-                method_name = "ping_response"
-
-        try:
-            return self._handlers[method_name]  # type: ignore
-        except KeyError:
-            return None
-
     # Callbacks
 
     # Queries
     @abstractmethod
-    def on_ping_query(self, node: Node, data: dict):
+    def on_ping_query(self, node: Node, data: Mapping):
+        pass
+
+    @abstractmethod
+    def on_find_node_query(self, node: Node, data: Mapping):
         pass
 
     @abstractmethod
-    def on_find_node_query(self, node: Node, data: dict):
+    def on_announce_peer_query(self, node: Node, data: Mapping, port: int):
+        """The node announced itself as a peer listening on port, a valid
+        one."""
         pass
 
     @abstractmethod
-    def on_announce_peer_query(self, node: Node, data: dict):
+    def on_get_peers_query(self, node: Node, data: Mapping):
         pass
 
     @abstractmethod
-    def on_get_peers_query(self, node: Node, data: dict):
+    def on_sample_infohashes_query(self, node: Node, data: Mapping):
         pass
 
     # Responses
@@ -126,24 +135,51 @@ class DHTDispatcher:
     def on_get_peers_response(
         self,
         tid: bytes,
-        token: bytes,
+        token: Optional[bytes],
         nodes: List[Node],
         values: List[bytes],
     ) -> None:
         pass
 
     @abstractmethod
-    def on_announce_peer_response(
-        self, tid: bytes, nid: bytes, infohash: bytes, node: Node
+    def on_announce_peer_response(self, tid: bytes, node: Node) -> None:
+        pass
+
+    @abstractmethod
+    def on_sample_infohashes_response(
+        self,
+        tid: bytes,
+        node: Node,
+        samples: List[bytes],
+        nodes: List[Node],
+        num: int,
+        interval: int,
     ) -> None:
         pass
 
-    def on_response(self, data: dict, address: Tuple[str, int]) -> None:
+    def on_response(
+        self, data: Mapping, address: Tuple[str, int], query: Optional[bytes] = None
+    ) -> None:
         if not self._running:
             return
 
-        packet_type_handler = self._detect_packet_type_handler(data)
+        if isinstance(data, KRPCMessage):
+            y = data.y
+            handler = self._handlers.get((y, query if y == b"r" else data.q))
+        else:
+            y = data.get(b"y", b"")
+            handler = self._handlers.get((y, query if y == b"r" else data.get(b"q")))
+        if handler is None:
+            return
+
+        try:
+            handler(self._get_node_from_data(address, data), data)
+        except (KeyError, TypeError, ValueError):
+            logger.debug(f"Malformed {query or data.get(b'q')!r} from {address}")
+
 
-        if packet_type_handler:
-            node = self._get_node_from_data(address, data)
-            packet_type_handler(node=node, data=data)
+def _nodes(response: Mapping) -> List[Node]:
+    nodes = response.get(b"nodes")
+    if not isinstance(nodes, bytes):
+        return []
+    return dht_utils.decode_nodes(nodes)
@@ -0,0 +1,26 @@
+from typing import Optional
+
+
+class DHTException(Exception):
+    def __init__(self, message: Optional[str] = None):
+        self.message = message
+
+
+class QueryTimeout(DHTException):
+    pass
+
+
+class QueryDropped(DHTException):
+    """The query was dropped by the send scheduler and never sent."""
+
+
+class QueryError(DHTException):
+    """The queried node answered with a KRPC error."""
+
+    def __init__(self, code: Optional[int] = None, message: Optional[str] = None):
+        super().__init__(message)
+        self.code = code
+
+
+class TooManyPendingQueries(DHTException):
+    pass
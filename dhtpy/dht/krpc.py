@@ -0,0 +1,376 @@
+"""
+KRPC message decoding.
+
+``parse`` turns a datagram into a KRPCMessage, a read only mapping with the
+same keys and values a full bencode decode gives, plus the fields every
+handler needs (``t``, ``y``, ``q`` and the sender ``id``) as attributes.
+Packets that are oversized, not valid bencode or missing those fields are
+rejected before they reach the dispatcher.
+
+When better_bencode runs its C extension the message is decoded by it,
+nothing written in Python gets close. Otherwise ``scan`` is used: the
+datagram is scanned once to find where the value of every key of the message
+and of its ``a`` or ``r`` dictionary starts and ends, and values are only
+sliced out and decoded when they are accessed, so ``nodes``, ``values`` or
+``samples`` are never copied for messages that end up being dropped.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from dhtpy.bittorrent.bencoding import ACCELERATED, BencoderError, decode
+from dhtpy.dht.constants import MAX_MESSAGE_SIZE
+
+_DICT = ord("d")
+_LIST = ord("l")
+_INT = ord("i")
+_END = ord("e")
+_COLON = ord(":")
+_ZERO = ord("0")
+_DIGITS = frozenset(b"0123456789")
+# Nesting deeper than any KRPC message, left to the full decoder
+_MAX_DEPTH = 8
+# Digits of a string length, KRPC strings are shorter than a datagram
+_MAX_LENGTH_DIGITS = 5
+
+# Key to (value start, value end, string payload start or -1)
+Spans = Dict[bytes, Tuple[int, int, int]]
+
+
+class _Malformed(Exception):
+    pass
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _string(data: bytes, i: int) -> Tuple[int, int]:
+    """Returns where the payload of the string starting at i starts and
+    ends."""
+    colon = data.find(b":", i, i + _MAX_LENGTH_DIGITS + 1)
+    length = data[i:colon]
+    if colon < 0 or not length.isdigit():
+        raise _Malformed
+    end = colon + 1 + int(length)
+    if end > len(data):
+        raise _Malformed
+    return colon + 1, end
+
+
+def _skip(data: bytes, i: int, depth: int) -> int:
+    """Returns the end of the value starting at i."""
+    c = data[i]
+    if c in _DIGITS:
+        return _string(data, i)[1]
+    if c == _INT:
+        end = data.index(b"e", i)
+        int(data[i + 1 : end])
+        return end + 1
+    if depth == _MAX_DEPTH:
+        raise _Unsupported
+    i += 1
+    if c == _LIST:
+        c = data[i]
+        while c != _END:
+            c -= _ZERO
+            if 0 <= c <= 9 and data[i + 1] == _COLON:
+                i += 2 + c
+            else:
+                i = _skip(data, i, depth + 1)
+            c = data[i]
+        return i + 1
+    if c == _DICT:
+        while data[i] != _END:
+            if data[i] not in _DIGITS:
+                raise _Malformed
+            i = _skip(data, _string(data, i)[1], depth + 1)
+        return i + 1
+    raise _Malformed
+
+
+def _spans(
+    data: bytes, i: int, body: bool = False
+) -> Tuple[Spans, int, Optional[Tuple[bytes, Spans]]]:
+    """
+    Scans the dictionary starting at i. Returns the spans of its values, where
+    it ends and, with body set, the key and the spans of its ``a`` or ``r``
+    dictionary.
+
+    Keys and most values are strings shorter than 100 bytes, their lengths are
+    parsed inline without going through int().
+    """
+    spans: Spans = {}
+    found_body = None
+    size = len(data)
+    i += 1
+    c = data[i]
+    while c != _END:
+        # Key
+        c -= _ZERO
+        if 0 <= c <= 9 and data[i + 1] == _COLON:
+            start = i + 2
+        else:
+            start, _ = _string(data, i)
+            c = int(data[i : start - 1])
+        i = start + c
+        key = data[start:i]
+
+        # Value
+        c = data[i] - _ZERO
+        if 0 <= c <= 9:
+            if data[i + 1] == _COLON:
+                start = i + 2
+            elif data[i + 2] == _COLON and 0 <= data[i + 1] - _ZERO <= 9:
+                start = i + 3
+                c = c * 10 + data[i + 1] - _ZERO
+            else:
+                start, _ = _string(data, i)
+                c = int(data[i : start - 1])
+            end = start + c
+            if end > size:
+                raise _Malformed
+            spans[key] = (i, end, start)
+        elif body and c == _DICT - _ZERO and (key == b"a" or key == b"r"):
+            body_spans, end, _ = _spans(data, i)
+            found_body = (key, body_spans)
+            spans[key] = (i, end, -1)
+        else:
+            end = _skip(data, i, 1)
+            spans[key] = (i, end, -1)
+        i = end
+        c = data[i]
+    return spans, i + 1, found_body
+
+
+def _value(data: bytes, span: Tuple[int, int, int]) -> Any:
+    start, end, payload = span
+    if payload >= 0:
+        return data[payload:end]
+    c = data[start]
+    if c in _DIGITS:
+        return data[_string(data, start)[0] : end]
+    if c == _INT:
+        return int(data[start + 1 : end - 1])
+    if c == _DICT:
+        return LazyDict(data, _spans(data, start)[0])
+    items = []
+    i = start + 1
+    end -= 1
+    while i < end:
+        # Lists of short strings, like peers in values, are parsed inline
+        c = data[i] - _ZERO
+        if 0 <= c <= 9 and data[i + 1] == _COLON:
+            i += 2 + c
+            items.append(data[i - c : i])
+        else:
+            item_end = _skip(data, i, 1)
+            items.append(_value(data, (i, item_end, -1)))
+            i = item_end
+    return items
+
+
+class LazyDict(Mapping):
+    """Bencoded dictionary whose values are decoded on first access."""
+
+    __slots__ = ("_data", "_spans", "_values")
+
+    def __init__(self, data: bytes, spans: Spans):
+        self._data = data
+        self._spans = spans
+        self._values: Dict[bytes, Any] = {}
+
+    def __getitem__(self, key: bytes) -> Any:
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = _value(self._data, self._spans[key])
+            return value
+
+    def get(self, key: bytes, default: Any = None) -> Any:
+        if key in self._values:
+            return self._values[key]
+        if key not in self._spans:
+            return default
+        return self[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._spans
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self._spans)
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self)!r})"
+
+
+def _string_value(data: bytes, spans: Spans, key: bytes) -> Optional[bytes]:
+    span = spans.get(key)
+    if span is None or span[2] < 0:
+        return None
+    return data[span[2] : span[1]]
+
+
+def scan(data: bytes) -> Optional[Mapping]:
+    """
+    Decodes a bencoded dictionary lazily. Returns None if the data is not a
+    valid bencoded dictionary, nesting deeper than any KRPC message is left to
+    the full decoder.
+    """
+    try:
+        spans, end, body = _spans(data, 0, body=True)
+    except (_Malformed, IndexError, ValueError):
+        return None
+    except _Unsupported:
+        try:
+            return decode(data)
+        except BencoderError:
+            return None
+    if end != len(data):
+        return None
+
+    fields = LazyDict(data, spans)
+    if body is not None:
+        # Every handler reads the body, keep the spans already found
+        fields._values[body[0]] = LazyDict(data, body[1])
+    return fields
+
+
+class KRPCMessage(Mapping):
+    """A KRPC query, response or error.
+
+    Attributes:
+        t: transaction id
+        y: message type, ``q``, ``r`` or ``e``
+        q: query name, None for responses and errors
+        id: id of the sender, None for errors
+    """
+
+    __slots__ = ("t", "y", "q", "id", "_fields")
+
+    def __init__(
+        self,
+        fields: Mapping,
+        t: bytes,
+        y: bytes,
+        q: Optional[bytes] = None,
+        id: Optional[bytes] = None,
+    ):
+        self._fields = fields
+        self.t = t
+        self.y = y
+        self.q = q
+        self.id = id
+
+    def __getitem__(self, key: bytes) -> Any:
+        return self._fields[key]
+
+    def get(self, key: bytes, default: Any = None) -> Any:
+        return self._fields.get(key, default)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._fields
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self._fields)
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self._fields)!r})"
+
+    @classmethod
+    def from_fields(cls, fields: Mapping) -> Optional[KRPCMessage]:
+        """Returns None unless the fields make an error, or a query or a
+        response with a 20 bytes sender id."""
+        t = fields.get(b"t")
+        y = fields.get(b"y")
+        if not isinstance(t, bytes):
+            return None
+
+        if y == b"e":
+            if not isinstance(fields.get(b"e"), list):
+                return None
+            return cls(fields, t, y)
+
+        if y == b"q":
+            q = fields.get(b"q")
+            if not isinstance(q, bytes):
+                return None
+            body = fields.get(b"a")
+        elif y == b"r":
+            q = None
+            body = fields.get(b"r")
+        else:
+            return None
+
+        if not isinstance(body, Mapping):
+            return None
+        nid = body.get(b"id")
+        if not isinstance(nid, bytes) or len(nid) != 20:
+            return None
+        return cls(fields, t, y, q, nid)
+
+
+def _parse_spans(data: bytes) -> Optional[KRPCMessage]:
+    """Scanner path of parse, checks the fields of the message right on the
+    spans rather than through the mapping."""
+    try:
+        spans, end, body = _spans(data, 0, body=True)
+    except (_Malformed, IndexError, ValueError):
+        return None
+    except _Unsupported:
+        fields = scan(data)
+        return None if fields is None else KRPCMessage.from_fields(fields)
+    if end != len(data):
+        return None
+
+    fields = LazyDict(data, spans)
+    t = _string_value(data, spans, b"t")
+    y = _string_value(data, spans, b"y")
+    if t is None:
+        return None
+    if y == b"e":
+        return KRPCMessage.from_fields(fields)
+
+    if body is None:
+        return None
+    key, body_spans = body
+    if y == b"q" and key == b"a":
+        q = _string_value(data, spans, b"q")
+        if q is None:
+            return None
+    elif y == b"r" and key == b"r":
+        q = None
+    else:
+        return None
+
+    nid = _string_value(data, body_spans, b"id")
+    if nid is None or len(nid) != 20:
+        return None
+    fields._values[key] = LazyDict(data, body_spans)
+    return KRPCMessage(fields, t, y, q, nid)
+
+
+def parse(data: bytes) -> Optional[KRPCMessage]:
+    """Decodes a KRPC message, returns None for oversized, malformed or non
+    KRPC packets."""
+    if len(data) > MAX_MESSAGE_SIZE or not data or data[0] != _DICT:
+        return None
+
+    if not ACCELERATED:
+        return _parse_spans(data)
+
+    try:
+        fields = decode(data)
+    except BencoderError:
+        return None
+    if not isinstance(fields, dict):
+        return None
+    return KRPCMessage.from_fields(fields)
@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import time
+from collections.abc import Mapping
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Set
+
+from dhtpy.dht.constants import LOOKUP_ALPHA, LOOKUP_K, LOOKUP_TIMEOUT
+from dhtpy.dht.structures import Node, nid_to_int
+from dhtpy.dht.utils import decode_nodes
+
+# Candidate states
+NEW, IN_FLIGHT, RESPONDED, FAILED = range(4)
+
+
+class _Candidate:
+    __slots__ = ("node", "distance", "hops", "state")
+
+    def __init__(self, node: Node, distance: int, hops: int):
+        self.node = node
+        self.distance = distance
+        # Round trips needed to get this node's response
+        self.hops = hops
+        self.state = NEW
+
+
+class Lookup:
+    """Iterative Kademlia lookup of the nodes closest to a target.
+
+    Starting from the seed nodes, alpha queries are kept in flight against the
+    closest candidates not asked yet, and every response adds the nodes it
+    returns as candidates. The lookup ends once the k closest candidates that
+    did not fail have all responded, or when its deadline passes.
+
+    Iterating over a lookup runs it and yields the peers found in ``values``,
+    as soon as they arrive and only once each. Awaiting ``run`` runs it
+    without collecting peers and returns the closest nodes.
+
+    Args:
+        target: id the lookup converges on, an infohash for get_peers
+        seeds: nodes to start from, usually the closest in the routing table
+        query: sends the query to a node and returns the future of its
+        response, i.e. a partial of ``RPC.get_peers`` or ``RPC.find_node``
+        alpha: number of queries in flight
+        k: number of closest nodes the lookup converges on
+        timeout: seconds the whole lookup may take
+    """
+
+    def __init__(
+        self,
+        target: bytes,
+        seeds: Iterable[Node],
+        query: Callable[[Node], asyncio.Future],
+        alpha: int = LOOKUP_ALPHA,
+        k: int = LOOKUP_K,
+        timeout: float = LOOKUP_TIMEOUT,
+    ):
+        self.target = target
+        self.alpha = alpha
+        self.k = k
+        self.timeout = timeout
+        self._query = query
+        self._target_int = nid_to_int(target)
+
+        self._candidates: Dict[Node, _Candidate] = dict()
+        # Candidates sorted by distance to the target
+        self._sorted: List[_Candidate] = []
+        self._distances: List[int] = []
+        self._peers: Set[bytes] = set()
+        self._started = False
+
+        # Tokens of the nodes that answered a get_peers, needed to announce
+        self.tokens: Dict[Node, bytes] = dict()
+
+        self.queries = 0
+        self.responses = 0
+        self.failures = 0
+        self.round_trips = 0
+        self.round_trips_to_first_peer: Optional[int] = None
+        self.time_to_first_peer: Optional[float] = None
+        self.elapsed: Optional[float] = None
+        self.timed_out = False
+
+        for node in seeds:
+            self._add_candidate(node, hops=1)
+
+    def _add_candidate(self, node: Node, hops: int) -> None:
+        if node in self._candidates or not node.is_valid_port:
+            return
+
+        candidate = _Candidate(node, node.nid ^ self._target_int, hops)
+        self._candidates[node] = candidate
+        index = bisect.bisect_right(self._distances, candidate.distance)
+        self._distances.insert(index, candidate.distance)
+        self._sorted.insert(index, candidate)
+
+    def _next_candidates(self, count: int) -> List[_Candidate]:
+        """Closest candidates not asked yet among the k closest that did not
+        fail."""
+        selected: List[_Candidate] = []
+        considered = 0
+        for candidate in self._sorted:
+            if considered == self.k or len(selected) == count:
+                break
+            if candidate.state == FAILED:
+                continue
+            considered += 1
+            if candidate.state == NEW:
+                selected.append(candidate)
+        return selected
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._run()
+
+    async def run(self) -> List[Node]:
+        async for _ in self:
+            pass
+        return self.closest_nodes
+
+    async def _run(self) -> AsyncIterator[bytes]:
+        if self._started:
+            raise RuntimeError("A lookup can only run once")
+        self._started = True
+
+        started = time.monotonic()
+        deadline = started + self.timeout
+        in_flight: Dict[asyncio.Future, _Candidate] = dict()
+        try:
+            while True:
+                for candidate in self._next_candidates(self.alpha - len(in_flight)):
+                    candidate.state = IN_FLIGHT
+                    self.queries += 1
+                    in_flight[self._query(candidate.node)] = candidate
+
+                if not in_flight:
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timed_out = True
+                    break
+
+                done, _ = await asyncio.wait(
+                    set(in_flight),
+                    timeout=remaining,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for future in done:
+                    candidate = in_flight.pop(future)
+                    for peer in self._on_response(candidate, future):
+                        if self.time_to_first_peer is None:
+                            self.time_to_first_peer = time.monotonic() - started
+                            self.round_trips_to_first_peer = candidate.hops
+                        yield peer
+        finally:
+            self.elapsed = time.monotonic() - started
+
+    def _on_response(
+        self, candidate: _Candidate, future: asyncio.Future
+    ) -> List[bytes]:
+        response = None
+        if not future.cancelled() and future.exception() is None:
+            response = future.result().get(b"r")
+
+        if not isinstance(response, Mapping):
+            candidate.state = FAILED
+            self.failures += 1
+            return []
+
+        candidate.state = RESPONDED
+        self.responses += 1
+        self.round_trips = max(self.round_trips, candidate.hops)
+
+        token = response.get(b"token")
+        if isinstance(token, bytes):
+            self.tokens[candidate.node] = token
+
+        nodes = response.get(b"nodes")
+        if isinstance(nodes, bytes):
+            for node in decode_nodes(nodes):
+                self._add_candidate(node, candidate.hops + 1)
+
+        peers = []
+        values = response.get(b"values")
+        if isinstance(values, list):
+            for peer in values:
+                if isinstance(peer, bytes) and len(peer) == 6:
+                    if peer not in self._peers:
+                        self._peers.add(peer)
+                        peers.append(peer)
+        return peers
+
+    @property
+    def closest_nodes(self) -> List[Node]:
+        """Up to k closest nodes that responded, sorted by distance."""
+        return [c.node for c in self._sorted if c.state == RESPONDED][: self.k]
+
+    @property
+    def stats(self) -> Dict[str, Optional[float]]:
+        return {
+            "queries": self.queries,
+            "responses": self.responses,
+            "failures": self.failures,
+            "round_trips": self.round_trips,
+            "peers": len(self._peers),
+            "round_trips_to_first_peer": self.round_trips_to_first_peer,
+            "time_to_first_peer": self.time_to_first_peer,
+            "elapsed": self.elapsed,
+            "timed_out": self.timed_out,
+        }
@@ -0,0 +1,335 @@
+"""
+Neighbor crawl mode.
+
+Instead of keeping a Kademlia routing table and answering with our own id,
+the crawler introduces itself to every node as one of its closest neighbors:
+the id of every reply and query shares its first 15 bytes with the id of the
+other node (see generate_neighbor_nid). Nodes keep it in their routing
+tables and route get_peers and announce_peer traffic for a large part of the
+keyspace to it, which is what the crawler captures.
+
+find_node queries are sent at a fixed rate to a bounded set of recently seen
+nodes, every node once, and the nodes in the replies refill the set. When
+the set runs dry the bootstrap nodes are asked again, within the same rate
+and at most every BOOTSTRAP_INTERVAL seconds. Memory is bounded by
+max_nodes, max_infohashes and the pending transactions, at most the query
+rate times the query timeout.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from itertools import islice
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from dhtpy.config import ADDRESS, DHT_BOOTSTRAP_NODES, PORT
+from dhtpy.dht.constants import (
+    NEIGHBOR_MAX_INFOHASHES,
+    NEIGHBOR_MAX_NODES,
+    NEIGHBOR_QUERIES_PER_SECOND,
+    NEIGHBOR_REPORT_INTERVAL,
+)
+from dhtpy.dht.dispatcher import DHTDispatcher
+from dhtpy.dht.exceptions import TooManyPendingQueries
+from dhtpy.dht.responses import ResponseBuilder
+from dhtpy.dht.rpc import RPC
+from dhtpy.dht.structures import Node, nid_to_int
+from dhtpy.dht.utils import generate_neighbor_nid
+
+logger = logging.getLogger(__name__)
+
+
+class NeighborCrawler(DHTDispatcher):
+    """Captures the infohashes of get_peers and announce_peer queries.
+
+    Args:
+        max_nodes: nodes kept to send find_node to, the oldest are dropped
+        queries_per_second: find_node queries sent per second
+        max_infohashes: infohashes remembered to report each only once, the
+        least recently seen are forgotten
+        report_interval: seconds between two reports of the capture rates
+        batched_udp: move datagrams in batches with recvmmsg/sendmmsg
+        nid: id the neighbor ids are made from, random by default
+    """
+
+    # Seconds between two batches of find_node queries
+    TICK = 0.1
+    # Nodes returned to find_node and get_peers queries
+    REPLY_NODES = 8
+    # Minimum seconds between two find_node to the bootstrap nodes
+    BOOTSTRAP_INTERVAL = 5.0
+
+    def __init__(
+        self,
+        max_nodes: int = NEIGHBOR_MAX_NODES,
+        queries_per_second: float = NEIGHBOR_QUERIES_PER_SECOND,
+        max_infohashes: int = NEIGHBOR_MAX_INFOHASHES,
+        report_interval: float = NEIGHBOR_REPORT_INTERVAL,
+        batched_udp: bool = False,
+        nid: Optional[Union[bytes, int]] = None,
+    ):
+        self.rpc = RPC(batched_udp=batched_udp)
+        self.nid = (
+            os.urandom(20) if nid is None else nid_to_int(nid).to_bytes(20, "big")
+        )
+        self.max_nodes = max_nodes
+        self.queries_per_second = queries_per_second
+        self.max_infohashes = max_infohashes
+        self.report_interval = report_interval
+        # Tokens are not checked, any announce is welcome
+        self._token = os.urandom(4)
+
+        # Compact info of the nodes seen and not queried yet, oldest first
+        self._nodes: OrderedDict[bytes, None] = OrderedDict()
+        # Infohashes reported, least recently seen first
+        self._infohashes: OrderedDict[bytes, None] = OrderedDict()
+        self._budget = 0.0
+        self._bootstrapped_at: Optional[float] = None
+        self._tick_timer: Optional[asyncio.TimerHandle] = None
+        self._report_timer: Optional[asyncio.TimerHandle] = None
+
+        # Callbacks
+        self.on_infohash: Optional[Callable[[bytes], None]] = None
+        self.on_announce: Optional[Callable[[bytes, str, int], None]] = None
+        self.on_report: Optional[Callable[[Dict[str, float]], None]] = None
+
+        self.get_peers = 0
+        self.announces = 0
+        self.infohashes = 0
+        self.queries = 0
+        self.nodes_seen = 0
+        self._last_report = (time.monotonic(), 0, 0, 0)
+        self.rates: Dict[str, float] = {
+            "get_peers_per_second": 0.0,
+            "announces_per_second": 0.0,
+            "infohashes_per_second": 0.0,
+        }
+
+        super().__init__(self.rpc)
+
+    def _neighbor_id(self, node: Node) -> bytes:
+        return generate_neighbor_nid(self.nid, node.id_bytes)
+
+    def _reply_nodes(self) -> bytes:
+        return b"".join(islice(reversed(self._nodes), self.REPLY_NODES))
+
+    def _capture(self, infohash: bytes) -> None:
+        if infohash in self._infohashes:
+            self._infohashes.move_to_end(infohash)
+            return
+
+        self._infohashes[infohash] = None
+        if len(self._infohashes) > self.max_infohashes:
+            self._infohashes.popitem(last=False)
+        self.infohashes += 1
+        if self.on_infohash:
+            self.on_infohash(infohash)
+
+    # Queries
+    def on_ping_query(self, node: Node, data: Mapping):
+        responses = ResponseBuilder(self._neighbor_id(node))
+        self.rpc.send_encoded(node, responses.ping(data[b"t"]))
+
+    def on_find_node_query(self, node: Node, data: Mapping):
+        responses = ResponseBuilder(self._neighbor_id(node))
+        self.rpc.send_encoded(
+            node, responses.find_node(data[b"t"], self._reply_nodes())
+        )
+
+    def on_get_peers_query(self, node: Node, data: Mapping):
+        infohash = data[b"a"].get(b"info_hash", b"")
+        if len(infohash) != 20:
+            return
+        self.get_peers += 1
+        self._capture(infohash)
+
+        responses = ResponseBuilder(self._neighbor_id(node))
+        self.rpc.send_encoded(
+            node,
+            responses.find_node(data[b"t"], self._reply_nodes(), self._token),
+        )
+
+    def on_announce_peer_query(self, node: Node, data: Mapping, port: int):
+        infohash = data[b"a"].get(b"info_hash", b"")
+        if len(infohash) != 20:
+            return
+        self.announces += 1
+        self._capture(infohash)
+        if self.on_announce:
+            self.on_announce(infohash, node.address, port)
+
+        responses = ResponseBuilder(self._neighbor_id(node))
+        self.rpc.send_encoded(node, responses.ping(data[b"t"]))
+
+    def on_sample_infohashes_query(self, node: Node, data: Mapping):
+        pass
+
+    # Responses
+    def on_ping_response(self, tid: bytes, node: Node):
+        pass
+
+    def on_find_node_response(self, tid: bytes, nodes: List[Node]):
+        for node in nodes:
+            info = node.compact_info
+            if info in self._nodes or not node.is_valid:
+                continue
+            self._nodes[info] = None
+            self.nodes_seen += 1
+            if len(self._nodes) > self.max_nodes:
+                self._nodes.popitem(last=False)
+
+    def on_get_peers_response(
+        self,
+        tid: bytes,
+        token: Optional[bytes],
+        nodes: List[Node],
+        values: List[bytes],
+    ):
+        pass
+
+    def on_announce_peer_response(self, tid: bytes, node: Node):
+        pass
+
+    def on_sample_infohashes_response(
+        self,
+        tid: bytes,
+        node: Node,
+        samples: List[bytes],
+        nodes: List[Node],
+        num: int,
+        interval: int,
+    ):
+        pass
+
+    # Crawl
+    def _find_node(self, node: Union[Node, Tuple[str, int]], nid: bytes) -> bool:
+        try:
+            self.rpc.find_node(nid, node, os.urandom(20))
+        except TooManyPendingQueries:
+            return False
+        self.queries += 1
+        return True
+
+    def _tick(self):
+        """Sends the find_node queries due since the last tick, to the oldest
+        nodes first."""
+        self._tick_timer = asyncio.get_event_loop().call_later(self.TICK, self._tick)
+        self._budget = min(
+            self._budget + self.queries_per_second * self.TICK,
+            self.queries_per_second,
+        )
+
+        if not self._nodes:
+            self._bootstrap()
+            return
+
+        while self._budget >= 1 and self._nodes:
+            info, _ = self._nodes.popitem(last=False)
+            node = Node.from_compact(info)
+            if not self._find_node(node, self._neighbor_id(node)):
+                break
+            self._budget -= 1
+
+    def _bootstrap(self):
+        """Asks the bootstrap nodes for nodes, unless they were asked less
+        than BOOTSTRAP_INTERVAL seconds ago."""
+        now = time.monotonic()
+        if (
+            self._bootstrapped_at is not None
+            and now - self._bootstrapped_at < self.BOOTSTRAP_INTERVAL
+        ):
+            return
+        self._bootstrapped_at = now
+
+        for node in DHT_BOOTSTRAP_NODES:
+            if self._budget < 1 or not self._find_node(node, self.nid):
+                break
+            self._budget -= 1
+
+    def _report(self):
+        self._report_timer = asyncio.get_event_loop().call_later(
+            self.report_interval, self._report
+        )
+        now = time.monotonic()
+        reported_at, get_peers, announces, infohashes = self._last_report
+        elapsed = now - reported_at
+        self.rates = {
+            "get_peers_per_second": (self.get_peers - get_peers) / elapsed,
+            "announces_per_second": (self.announces - announces) / elapsed,
+            "infohashes_per_second": (self.infohashes - infohashes) / elapsed,
+        }
+        self._last_report = (now, self.get_peers, self.announces, self.infohashes)
+
+        stats = self.stats
+        logger.info(
+            f"{stats['get_peers_per_second']:.0f} get_peers/s, "
+            f"{stats['announces_per_second']:.0f} announces/s, "
+            f"{stats['infohashes_per_second']:.0f} new infohashes/s, "
+            f"{stats['nodes']} nodes"
+        )
+        if self.on_report:
+            self.on_report(stats)
+
+    async def start(
+        self,
+        address: str = ADDRESS,
+        port: int = PORT,
+        run_forever: bool = True,
+        reuse_port: bool = False,
+    ):
+        await self.rpc.start(address, port, reuse_port)
+        self._last_report = (
+            time.monotonic(),
+            self.get_peers,
+            self.announces,
+            self.infohashes,
+        )
+        self._tick()
+        loop = asyncio.get_running_loop()
+        self._report_timer = loop.call_later(self.report_interval, self._report)
+
+        if run_forever:
+            loop.run_forever()
+
+    async def stop(self):
+        self._running = False
+        for timer in (self._tick_timer, self._report_timer):
+            if timer is not None:
+                timer.cancel()
+        self._tick_timer = self._report_timer = None
+        self.rpc.close()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Counters, capture rates over the last report interval and the
+        counters of the transactions, send scheduler and admission filter."""
+        stats: Dict[str, float] = {
+            "get_peers": self.get_peers,
+            "announces": self.announces,
+            "infohashes": self.infohashes,
+            "queries": self.queries,
+            "nodes_seen": self.nodes_seen,
+            "nodes": len(self._nodes),
+            **self.rates,
+        }
+        for prefix, component in (
+            ("transactions", self.rpc.transactions.stats),
+            ("send", self.rpc.scheduler.stats),
+            ("admission", self.rpc.admission.stats),
+        ):
+            for key, value in component.items():
+                stats[f"{prefix}_{key}"] = value
+        return stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    crawler = NeighborCrawler()
+    loop.run_until_complete(crawler.start(run_forever=False))
+    loop.run_forever()
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import random
+import sys
+import time
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, List, Optional
+
+from dhtpy.dht.constants import PEER_TTL
+
+
+class PeerStore:
+    """Peers announced to us, indexed by infohash.
+
+    Peers are kept in their 6 bytes compact form with the time they expire.
+    Within an infohash they are ordered by announce time and infohashes are
+    ordered by their last announce, so with a single ttl both expired entries
+    and eviction candidates are always at the front.
+
+    Args:
+        max_entries: maximum number of peers across all infohashes, the oldest
+        peers of the least recently announced infohashes are evicted first
+        ttl: seconds a peer is kept after its last announce
+    """
+
+    def __init__(self, max_entries: int = 1_000_000, ttl: float = PEER_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._peers: OrderedDict[bytes, OrderedDict[bytes, float]] = OrderedDict()
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def infohashes(self) -> int:
+        """Number of infohashes with peers."""
+        return len(self._peers)
+
+    def __contains__(self, infohash: bytes) -> bool:
+        return infohash in self._peers
+
+    def add(self, infohash: bytes, compact_peer: bytes) -> None:
+        """Stores or refreshes a peer announced for the infohash."""
+        peers = self._peers.get(infohash)
+        if peers is None:
+            peers = self._peers[infohash] = OrderedDict()
+        else:
+            self._peers.move_to_end(infohash)
+
+        if compact_peer in peers:
+            peers.move_to_end(compact_peer)
+        else:
+            self._size += 1
+        peers[compact_peer] = time.monotonic() + self.ttl
+
+        while self._size > self.max_entries:
+            self._evict()
+
+    def get(self, infohash: bytes, limit: int = 50) -> List[bytes]:
+        """Returns up to limit peers of the infohash, the most recent first."""
+        peers = self._expire(infohash)
+        if not peers:
+            self.misses += 1
+            return []
+
+        self.hits += 1
+        return list(islice(reversed(peers), limit))
+
+    def sample(self, count: int) -> List[bytes]:
+        """Returns up to count random infohashes, for sample_infohashes
+        replies."""
+        return random.sample(list(self._peers), min(count, len(self._peers)))
+
+    def _expire(self, infohash: bytes) -> Optional[OrderedDict[bytes, float]]:
+        peers = self._peers.get(infohash)
+        if peers is None:
+            return None
+
+        now = time.monotonic()
+        while peers:
+            compact_peer, expires = next(iter(peers.items()))
+            if expires > now:
+                break
+            del peers[compact_peer]
+            self._size -= 1
+
+        if not peers:
+            del self._peers[infohash]
+            return None
+        return peers
+
+    def _evict(self) -> None:
+        infohash, peers = next(iter(self._peers.items()))
+        peers.popitem(last=False)
+        self._size -= 1
+        self.evictions += 1
+        if not peers:
+            del self._peers[infohash]
+
+    def remove_expired(self) -> int:
+        """Drops the infohashes whose peers all expired, returns the number of
+        peers removed. Expired peers of infohashes that are still announced are
+        dropped when the infohash is looked up."""
+        now = time.monotonic()
+        removed = 0
+        while self._peers:
+            infohash, peers = next(iter(self._peers.items()))
+            if next(reversed(peers.values())) > now:
+                break
+            del self._peers[infohash]
+            removed += len(peers)
+        self._size -= removed
+        return removed
+
+    @property
+    def memory_usage(self) -> int:
+        """Approximate bytes used by the stored infohashes and peers."""
+        usage = sys.getsizeof(self._peers)
+        for infohash, peers in self._peers.items():
+            usage += sys.getsizeof(infohash) + sys.getsizeof(peers)
+        # Every peer is a 6 bytes string and its expiry time
+        usage += self._size * (sys.getsizeof(bytes(6)) + sys.getsizeof(0.0))
+        return usage
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "peers": self._size,
+            "infohashes": self.infohashes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "memory_usage": self.memory_usage,
+        }
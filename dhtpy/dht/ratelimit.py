@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from dhtpy.dht.constants import (
+    SEND_BYTES_PER_SECOND,
+    SEND_PACKETS_PER_SECOND,
+    SEND_QUEUE_SIZE,
+)
+
+Address = Tuple[str, int]
+
+# Send priorities, replies to other nodes go before our own queries
+PRIORITY_RESPONSE = 0
+PRIORITY_QUERY = 1
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second up to capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def consume(self, amount: float = 1, now: Optional[float] = None) -> bool:
+        """Takes amount tokens if available, returns whether it did."""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def delay(self, amount: float = 1) -> float:
+        """Seconds until amount tokens are available."""
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate) if self.rate > 0 else float("inf")
+
+
+class SendScheduler:
+    """Rate limits and prioritizes the datagrams sent by a node.
+
+    Datagrams go out right away while the packets and bytes per second
+    budgets allow it, otherwise they wait in a queue per priority and are
+    flushed from a timer, responses first. When the queues are full the
+    oldest query is dropped to make room for a response, and new queries are
+    dropped.
+
+    A datagram can carry a context, handed to ``on_sent`` when it goes out
+    and to ``on_dropped`` when it is dropped from the queue, so the sender
+    can tell when its query actually left and fail the ones that never will.
+
+    When the kernel reports it cannot keep up (ENOBUFS, EPERM) the rates are
+    halved and sending pauses for a moment. Rates recover additively every
+    second without errors.
+
+    Args:
+        send: callback putting a datagram on the wire
+        send_query: callback putting queries on the wire when they go out of
+        another socket than responses, send by default
+        packets_per_second: sustained packets rate
+        bytes_per_second: sustained bytes rate
+        max_queued: maximum number of datagrams waiting across priorities
+        burst: seconds of traffic the buckets can send at once
+    """
+
+    MIN_RATE_FACTOR = 1 / 64
+    RECOVERY_STEP = 1 / 16
+    RECOVERY_INTERVAL = 1.0
+    BACKOFF = 0.01
+    MAX_BACKOFF = 1.0
+
+    def __init__(
+        self,
+        send: Callable[[bytes, Address], None],
+        packets_per_second: float = SEND_PACKETS_PER_SECOND,
+        bytes_per_second: float = SEND_BYTES_PER_SECOND,
+        max_queued: int = SEND_QUEUE_SIZE,
+        burst: float = 0.1,
+        send_query: Optional[Callable[[bytes, Address], None]] = None,
+    ):
+        self._send = send
+        self.send_query = send_query
+        self.packets_per_second = packets_per_second
+        self.bytes_per_second = bytes_per_second
+        self.max_queued = max_queued
+        self._packets = TokenBucket(
+            packets_per_second, max(1.0, packets_per_second * burst)
+        )
+        # A bucket must hold at least a full datagram
+        self._bytes = TokenBucket(
+            bytes_per_second, max(65536.0, bytes_per_second * burst)
+        )
+        self._queues: Tuple[Deque[Tuple[bytes, Address, Any]], ...] = (
+            deque(),
+            deque(),
+        )
+
+        self.rate_factor = 1.0
+        self._backoff = 0.0
+        self._paused_until = 0.0
+        self._rate_changed = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = [0, 0]
+        self.backoffs = 0
+
+        # Callbacks
+        self.on_sent: Optional[Callable[[Any], None]] = None
+        self.on_dropped: Optional[Callable[[Any], None]] = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._queues[PRIORITY_RESPONSE]) + len(self._queues[PRIORITY_QUERY])
+
+    def send(
+        self,
+        data: bytes,
+        address: Address,
+        priority: int = PRIORITY_QUERY,
+        context: Any = None,
+    ) -> bool:
+        """Sends or queues the datagram, returns False if it was dropped."""
+        if not self.queued and self._try_send(
+            data, address, priority, context, time.monotonic()
+        ):
+            return True
+
+        if self.queued >= self.max_queued:
+            queries = self._queues[PRIORITY_QUERY]
+            if priority == PRIORITY_RESPONSE and queries:
+                _, _, dropped = queries.popleft()
+                self.dropped[PRIORITY_QUERY] += 1
+                if dropped is not None and self.on_dropped:
+                    self.on_dropped(dropped)
+            else:
+                self.dropped[priority] += 1
+                return False
+
+        self._queues[priority].append((data, address, context))
+        self._schedule_flush()
+        return True
+
+    def _try_send(
+        self, data: bytes, address: Address, priority: int, context: Any, now: float
+    ) -> bool:
+        if now < self._paused_until:
+            return False
+        self._recover(now)
+        if not self._packets.consume(1, now):
+            return False
+        if not self._bytes.consume(len(data), now):
+            # Give the packet back, the datagram is not sent
+            self._packets.tokens += 1
+            return False
+
+        if priority == PRIORITY_QUERY and self.send_query:
+            self.send_query(data, address)
+        else:
+            self._send(data, address)
+        self.sent += 1
+        self.sent_bytes += len(data)
+        if context is not None and self.on_sent:
+            self.on_sent(context)
+        return True
+
+    def flush(self) -> None:
+        """Sends the queued datagrams the budgets allow, responses first."""
+        self._timer = None
+        now = time.monotonic()
+        for priority, queue in enumerate(self._queues):
+            while queue:
+                data, address, context = queue[0]
+                if not self._try_send(data, address, priority, context, now):
+                    self._schedule_flush()
+                    return
+                queue.popleft()
+
+    def _schedule_flush(self) -> None:
+        if self._timer is not None or not self.queued:
+            return
+
+        now = time.monotonic()
+        data, _, _ = next(queue[0] for queue in self._queues if queue)
+        delay = max(
+            self._paused_until - now,
+            self._packets.delay(1),
+            self._bytes.delay(len(data)),
+            # Do not spin on the loop for very high rates
+            0.001,
+        )
+        self._timer = asyncio.get_event_loop().call_later(delay, self.flush)
+
+    def _set_rate_factor(self, factor: float) -> None:
+        self.rate_factor = factor
+        self._packets.rate = self.packets_per_second * factor
+        self._bytes.rate = self.bytes_per_second * factor
+
+    def _recover(self, now: float) -> None:
+        if self.rate_factor < 1 and now - self._rate_changed > self.RECOVERY_INTERVAL:
+            self._rate_changed = now
+            self._backoff = 0.0
+            self._set_rate_factor(min(1.0, self.rate_factor + self.RECOVERY_STEP))
+
+    def on_bandwidth_exhausted(self) -> None:
+        """Backs off after the socket reported ENOBUFS or EPERM."""
+        now = time.monotonic()
+        self.backoffs += 1
+        self._rate_changed = now
+        self._set_rate_factor(max(self.MIN_RATE_FACTOR, self.rate_factor / 2))
+        self._backoff = min(self.MAX_BACKOFF, max(self.BACKOFF, self._backoff * 2))
+        self._paused_until = now + self._backoff
+        # Whatever the buckets held was too much for the kernel
+        self._packets.tokens = min(self._packets.tokens, 0)
+        self._bytes.tokens = min(self._bytes.tokens, 0)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queued_responses": len(self._queues[PRIORITY_RESPONSE]),
+            "queued_queries": len(self._queues[PRIORITY_QUERY]),
+            "sent": self.sent,
+            "sent_bytes": self.sent_bytes,
+            "dropped_responses": self.dropped[PRIORITY_RESPONSE],
+            "dropped_queries": self.dropped[PRIORITY_QUERY],
+            "backoffs": self.backoffs,
+            "rate_factor": self.rate_factor,
+        }
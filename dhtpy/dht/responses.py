@@ -0,0 +1,95 @@
+"""
+Pre-encoded replies to the queries a node answers most.
+
+Replies only differ from one another by the transaction id, the token and
+the compact nodes or peers, everything else, including our id, is encoded
+once. The bytes are the same ``encode`` gives for the equivalent dict, keys
+in sorted order.
+"""
+
+from __future__ import annotations
+
+from typing import List, Optional
+
+
+def _string(value: bytes) -> bytes:
+    return b"%d:%s" % (len(value), value)
+
+
+class ResponseBuilder:
+    """Builds the bencoded replies of a node.
+
+    Args:
+        nid: id of the node, in bytes
+    """
+
+    def __init__(self, nid: bytes):
+        self.nid = nid
+        # Body keys sort before t and y, every reply starts the same way
+        self._prefix = b"d1:rd2:id" + _string(nid)
+        self._suffix = b"1:y1:re"
+
+    def ping(self, tid: bytes) -> bytes:
+        """Reply to ping and announce_peer queries."""
+        return b"%se1:t%d:%s%s" % (self._prefix, len(tid), tid, self._suffix)
+
+    def find_node(
+        self, tid: bytes, nodes: bytes, token: Optional[bytes] = None
+    ) -> bytes:
+        """Reply to find_node, and get_peers queries without peers, nodes is
+        the compact info of the closest nodes. A get_peers reply needs a token
+        for the querying node to announce."""
+        if token is None:
+            return b"%s5:nodes%d:%se1:t%d:%s%s" % (
+                self._prefix,
+                len(nodes),
+                nodes,
+                len(tid),
+                tid,
+                self._suffix,
+            )
+        return b"%s5:nodes%d:%s5:token%d:%se1:t%d:%s%s" % (
+            self._prefix,
+            len(nodes),
+            nodes,
+            len(token),
+            token,
+            len(tid),
+            tid,
+            self._suffix,
+        )
+
+    def get_peers(self, tid: bytes, token: bytes, values: List[bytes]) -> bytes:
+        """Reply to get_peers queries with the compact info of the peers."""
+        if values and all(len(value) == 6 for value in values):
+            # IPv4 peers, all the lengths are the same
+            encoded_values = b"6:" + b"6:".join(values)
+        else:
+            encoded_values = b"".join([_string(value) for value in values])
+        return b"%s5:token%d:%s6:valuesl%see1:t%d:%s%s" % (
+            self._prefix,
+            len(token),
+            token,
+            encoded_values,
+            len(tid),
+            tid,
+            self._suffix,
+        )
+
+    def sample_infohashes(
+        self, tid: bytes, interval: int, nodes: bytes, num: int, samples: bytes
+    ) -> bytes:
+        """Reply to BEP 51 sample_infohashes queries, samples are the
+        infohashes concatenated."""
+        return b"%s8:intervali%de5:nodes%d:%s3:numi%de7:samples%d:%se1:t%d:%s%s" % (
+            self._prefix,
+            interval,
+            len(nodes),
+            nodes,
+            num,
+            len(samples),
+            samples,
+            len(tid),
+            tid,
+            self._suffix,
+        )
@@ -1,8 +1,21 @@
 from __future__ import annotations
 
-from typing import List, Set
+import asyncio
+import bisect
+import gc
+import heapq
+import itertools
+import random
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Union
 
-from dhtpy.dht.structures import Bucket, Node, Peer
+from dhtpy.dht import snapshot
+from dhtpy.dht.constants import NODE_OFFLINE_TIMEOUT, NODE_UNHEARD_TIMEOUT
+from dhtpy.dht.structures import Bucket, Node, nid_to_int
+from dhtpy.dht.timers import DeadlineQueue
+
+# Highest possible node id, ffff...
+MAX_NID = (1 << 160) - 1
 
 
 class SimpleRoutingTable:
@@ -28,27 +41,134 @@ class SimpleRoutingTable:
 
 
 class RoutingTable:
-    """Routing table of the DHT using buckets."""
+    """Routing table of the DHT using buckets.
+
+    ``buckets[i]`` holds the nodes sharing exactly ``i`` leading bits with our
+    own id, except for the last bucket, which holds every node sharing at
+    least that many bits (our own id falls in it). Only the last bucket is
+    ever split.
+
+    Liveness is tracked with one deadline per node in a heap: ``expire`` only
+    looks at the nodes whose deadline passed, reporting the ones that just
+    became questionable and evicting the ones that went offline.
+
+    Buckets restored from a snapshot keep its entries and only build their
+    nodes the first time they are needed, or when their least recently seen
+    node becomes questionable.
 
-    def __init__(self):
+    Args:
+        nid: our own node id. Defaults to ffff..., which is the layout the
+        table used before it knew about our own id.
+        bucket_size: capacity of each bucket, K in the Kademlia specification.
+        replacement_cache_size: number of replacement candidates kept per bucket.
+    """
+
+    def __init__(
+        self,
+        nid: Union[bytes, int, str] = MAX_NID,
+        bucket_size: int = 8,
+        replacement_cache_size: int = 8,
+    ):
+        self.nid = nid_to_int(nid)
+        self.bucket_size = bucket_size
+        self.replacement_cache_size = replacement_cache_size
         self.buckets: List[Bucket] = [
-            Bucket(),
+            self._create_bucket(),
         ]
+        self._deadlines: DeadlineQueue[Node] = DeadlineQueue()
+        # Restored buckets whose nodes are not built yet, and the monotonic
+        # time the ages of their entries are relative to
+        self._restored: DeadlineQueue[Bucket] = DeadlineQueue()
+        self._restored_at = 0.0
+
+        # Removals that could and could not be filled from a replacement cache
+        self.replacement_hits = 0
+        self.replacement_misses = 0
 
     def __contains__(self, item):
         if isinstance(item, Node):
-            for bucket in self.buckets:
-                if bucket.in_range(item.id):
-                    return item in bucket
+            return item in self._bucket(self.bucket_index(item.nid))
         return False
 
+    def __len__(self) -> int:
+        return sum(self._bucket_size(bucket) for bucket in self.buckets)
+
+    @property
+    def is_empty(self) -> bool:
+        return all(not bucket.nodes and not bucket.restored for bucket in self.buckets)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "nodes": len(self),
+            "buckets": len(self.buckets),
+            "replacements": sum(len(bucket.replacements) for bucket in self.buckets),
+            "replacement_hits": self.replacement_hits,
+            "replacement_misses": self.replacement_misses,
+        }
+
+    @property
+    def next_deadline(self) -> Optional[float]:
+        """Monotonic time at which ``expire`` has work to do next."""
+        deadlines = [self._deadlines.next_deadline, self._restored.next_deadline]
+        return min((d for d in deadlines if d is not None), default=None)
+
+    def _create_bucket(self, **kwargs) -> Bucket:
+        return Bucket(
+            capacity=self.bucket_size,
+            replacement_capacity=self.replacement_cache_size,
+            **kwargs,
+        )
+
+    def _track(self, node: Node) -> None:
+        self._deadlines.push(node.last_contact + NODE_UNHEARD_TIMEOUT, node)
+
+    @staticmethod
+    def _bucket_size(bucket: Bucket) -> int:
+        return len(bucket.nodes) + len(bucket.restored) // snapshot.NODE.size
+
+    def _bucket(self, index: int) -> Bucket:
+        """The bucket at index, with its restored nodes built."""
+        bucket = self.buckets[index]
+        if bucket.restored:
+            self._build(bucket)
+        return bucket
+
+    def _build(self, bucket: Bucket) -> None:
+        """Builds the nodes of the snapshot entries of the bucket."""
+        entries, bucket.restored = bucket.restored, b""
+        restored_at = self._restored_at
+        from_compact = Node.from_compact
+        nodes = bucket.nodes
+        deadlines = []
+
+        # None of the objects created here can form cycles, collecting while
+        # allocating a large bucket worth of them would only slow it down
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for compact_info, age in snapshot.NODE.iter_unpack(entries):
+                node = from_compact(compact_info, restored_at - age)
+                nodes[node] = node
+                deadlines.append((node.last_contact + NODE_UNHEARD_TIMEOUT, node))
+            self._deadlines.extend(deadlines)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def bucket_index(self, nid: int) -> int:
+        """Index of the bucket the id belongs to, given by the length of the
+        prefix it shares with our own id."""
+        prefix_length = 160 - (self.nid ^ nid).bit_length()
+        return min(prefix_length, len(self.buckets) - 1)
+
     @property
     def nodes(self) -> Set[Node]:
         # TODO revisit this
         """Returns all nodes of the routing table in a set."""
         nodes = set()
-        for bucket in self.buckets:
-            for node in bucket.nodes:
+        for index in range(len(self.buckets)):
+            for node in self._bucket(index).nodes:
                 nodes.add(node)
         return nodes
 
@@ -67,63 +187,227 @@ class RoutingTable:
     def add(self, node: Node) -> bool:
         """Add a node to the routing table, returns if the node has been added.
         If the node belongs to a node that is full this method will attempt to
-        split the bucket and add it.
+        split the bucket and add it, otherwise it is kept as a replacement.
         """
-        for bucket in self.buckets:
-            if bucket.in_range(node.id):
-                added = bucket.add(node)
+        bucket = self._bucket(self.bucket_index(node.nid))
+        if not bucket.in_range(node.nid):
+            return False
 
-                if added:
-                    return True
+        is_new = node not in bucket.nodes
+        if bucket.add(node):
+            if is_new:
+                self._track(node)
+            return True
 
-                # Node not added, if we can split the bucket, split it and
-                # try again to add the node
-                if not added and self.split(bucket):
-                    return self.add(node)
+        # Node not added, if we can split the bucket, split it and
+        # try again to add the node
+        if self.split(bucket):
+            return self.add(node)
 
+        bucket.add_replacement(node)
         return False
 
-    def add_peer(self, peer: Peer, node: Node):
-        # TODO: fix
-        # self.nodes[node.id].peers[peer.infohash] = peer
-        pass
-
-    def get_closest_nodes(self, nid: str, limit=8):
-        """Get closest nodes to the id provided"""
-        return sorted(
-            self.nodes,
-            key=lambda node: Node.calculate_distance(nid, node.id),
-        )[:limit]
-
-    def get_peers(self, infohash: bytes) -> List[Peer]:
-        # TODO: revisit this
-        peers = []
-        for node in self.nodes:
-            if node.peers.get(infohash):
-                peers.append(node.peers.get(infohash))
-        return peers
+    def remove(self, node: Node) -> bool:
+        """Remove a node from the routing table, returns if it was present.
+        The most recently seen replacement of the bucket takes its place."""
+        bucket = self._bucket(self.bucket_index(node.nid))
+        if not bucket.remove(node):
+            return False
+
+        promoted = bucket.promote()
+        if promoted:
+            self.replacement_hits += 1
+            self._track(promoted)
+        else:
+            self.replacement_misses += 1
+        return True
+
+    def expire(self, now: Optional[float] = None) -> List[Node]:
+        """Processes the nodes whose liveness deadline passed.
+
+        Nodes past the offline threshold are removed. Returns the nodes that
+        became questionable, which should be pinged; a reply refreshes their
+        last contact before they go offline.
+        """
+        now = time.monotonic() if now is None else now
+        for _, bucket in self._restored.pop_expired(now):
+            if bucket.restored:
+                self._build(bucket)
+
+        questionable = []
+        for deadline, node in self._deadlines.pop_expired(now):
+            # Skip entries of nodes removed from the table since
+            bucket = self.buckets[self.bucket_index(node.nid)]
+            if bucket.nodes.get(node) is not node:
+                continue
+
+            unheard_at = node.last_contact + NODE_UNHEARD_TIMEOUT
+            offline_at = node.last_contact + NODE_OFFLINE_TIMEOUT
+            if now >= offline_at:
+                self.remove(node)
+            elif now >= unheard_at:
+                questionable.append(node)
+                self._deadlines.push(offline_at, node)
+            else:
+                # Heard from it after the deadline was set
+                self._deadlines.push(unheard_at, node)
+        return questionable
+
+    def _snapshot_buckets(self) -> List[snapshot.BucketState]:
+        return [
+            # The exclusive end of the last bucket is stored as ffff...
+            (
+                bucket.start_int,
+                min(bucket.end_int, MAX_NID),
+                list(bucket.nodes),
+                bucket.restored,
+            )
+            for bucket in self.buckets
+        ]
+
+    def dump(self) -> bytes:
+        """Binary snapshot of the table, see dhtpy.dht.snapshot."""
+        return snapshot.pack(self.nid, self._snapshot_buckets(), self._restored_at)
+
+    async def save(self, path: str) -> None:
+        """Writes a snapshot of the table to path atomically. Only copying the
+        lists of nodes happens in the event loop, packing and writing them run
+        in the default executor."""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            None,
+            snapshot.write,
+            path,
+            self.nid,
+            self._snapshot_buckets(),
+            self._restored_at,
+        )
+
+    @classmethod
+    def load(cls, buffer: snapshot.Buffer, **kwargs) -> RoutingTable:
+        """Restores a table from a snapshot, keyword arguments are passed to
+        the constructor.
+
+        Each bucket only copies its snapshot entries, its nodes are built when
+        it is first used or when its least recently seen node, the first
+        entry, becomes questionable.
+        """
+        nid, buckets = snapshot.unpack(buffer)
+        routing_table = cls(nid, **kwargs)
+        routing_table.buckets = []
+        now = routing_table._restored_at = time.monotonic()
+
+        for start, end, entries in buckets:
+            bucket = routing_table._create_bucket(
+                start=start.to_bytes(20, "big").hex(),
+                end=end.to_bytes(20, "big").hex(),
+                restored=bytes(entries),
+            )
+            if entries:
+                _, age = snapshot.NODE.unpack_from(entries)
+                routing_table._restored.push(now - age + NODE_UNHEARD_TIMEOUT, bucket)
+            routing_table.buckets.append(bucket)
+        return routing_table
+
+    @classmethod
+    def load_file(cls, path: str, **kwargs) -> RoutingTable:
+        """Restores a table from a snapshot file, reading it memory mapped."""
+        with snapshot.map_file(path) as buffer:
+            return cls.load(buffer, **kwargs)
+
+    def get_closest_nodes(
+        self, nid: Union[bytes, int, str], limit: int = 8
+    ) -> List[Node]:
+        """Get closest nodes to the id provided, sorted by distance.
+
+        Buckets are visited from the one the id falls in outwards, every bucket
+        visited only holds nodes farther than the ones already collected, so
+        the walk stops as soon as ``limit`` nodes are found.
+        """
+        target = nid_to_int(nid)
+        index = self.bucket_index(target)
+
+        closest: List[Node] = []
+        for group in self._groups_by_distance(index):
+            closest.extend(
+                heapq.nsmallest(
+                    limit - len(closest), group, key=lambda node: node.nid ^ target
+                )
+            )
+            if len(closest) >= limit:
+                break
+        return closest
+
+    def _groups_by_distance(self, index: int) -> Iterator[Iterable[Node]]:
+        """Groups of nodes walked from the bucket at index outwards, generated
+        as the walk goes so restored buckets are only built when reached."""
+        # Nodes in the target's bucket are the closest ones. Nodes in the
+        # buckets after it are all at the same distance order among themselves,
+        # and then each bucket before it is farther than the previous one.
+        yield self._bucket(index).nodes
+        if index + 1 < len(self.buckets):
+            yield [
+                node
+                for i in range(index + 1, len(self.buckets))
+                for node in self._bucket(i).nodes
+            ]
+        for i in range(index - 1, -1, -1):
+            yield self._bucket(i).nodes
+
+    def sample(self, count: int) -> List[Node]:
+        """Up to count distinct random nodes of the table. Nodes of restored
+        buckets are read from their entries without building the bucket."""
+        sizes = [self._bucket_size(bucket) for bucket in self.buckets]
+        ends = list(itertools.accumulate(sizes))
+        total = ends[-1] if ends else 0
+
+        nodes = []
+        for position in random.sample(range(total), min(count, total)):
+            index = bisect.bisect_right(ends, position)
+            offset = position - ends[index] + sizes[index]
+            bucket = self.buckets[index]
+            if bucket.restored:
+                compact_info, age = snapshot.NODE.unpack_from(
+                    bucket.restored, offset * snapshot.NODE.size
+                )
+                nodes.append(Node.from_compact(compact_info, self._restored_at - age))
+            else:
+                nodes.append(next(itertools.islice(bucket.nodes, offset, None)))
+        return nodes
 
     def split(self, bucket: Bucket) -> bool:
         # Maximum number of buckets is 160 per the specification
-        if len(self.nodes) == 160:
+        if len(self.buckets) >= 160:
             return False
 
-        # Cannot split the bucket if there is other bucket bigger than this
-        if list(self.buckets).index(bucket) + 1 < len(self.buckets):
+        # Only the last bucket, the one holding our own id, can be split
+        if self.buckets[-1] is not bucket:
             return False
+        if bucket.restored:
+            self._build(bucket)
 
         # Create the new buckets and move nodes between the two
-        buckets = [
-            Bucket(start=bucket.start, end=bucket.half),
-            Bucket(start=bucket.half, end=bucket.end),
-        ]
-        for new_bucket in buckets:
-            for node in bucket.nodes:
-                if new_bucket.in_range(node.id):
-                    new_bucket.add(node)
-
-        # Replace old bucket and add new one
-        old_bucket_index = self.buckets.index(bucket)
-        self.buckets[old_bucket_index] = buckets[0]
-        self.buckets.append(buckets[1])
+        half = bucket.half
+        lower = self._create_bucket(start=bucket.start, end=half)
+        upper = self._create_bucket(start=half, end=bucket.end)
+        for node in bucket.nodes:
+            (lower if node.nid < lower.end_int else upper).nodes[node] = node
+
+        # Replacements keep their order and fill the room left in each half
+        for node in bucket.replacements:
+            (lower if node.nid < lower.end_int else upper).add_replacement(node)
+        for new_bucket in (lower, upper):
+            while True:
+                promoted = new_bucket.promote()
+                if not promoted:
+                    break
+                self._track(promoted)
+
+        # The half sharing one more bit with our id becomes the last bucket
+        if self.nid < lower.end_int:
+            far, near = upper, lower
+        else:
+            far, near = lower, upper
+        self.buckets[-1] = far
+        self.buckets.append(near)
         return True
@@ -1,111 +1,417 @@
 from __future__ import annotations
 
+import asyncio
 import logging
-from typing import Callable, Optional, Tuple, Union
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from socket import AF_INET, inet_pton
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
-from black import os
-
-from dhtpy.bittorrent.bencoding import BencoderError, decode, encode
-from dhtpy.config import DEBUG_LEVEL
+from dhtpy.bittorrent.bencoding import BencoderError, encode
+from dhtpy.config import ADDRESS, DEBUG_LEVEL, PORT
+from dhtpy.dht import krpc
+from dhtpy.dht.admission import AdmissionFilter
+from dhtpy.dht.exceptions import (
+    QueryDropped,
+    QueryError,
+    QueryTimeout,
+    TooManyPendingQueries,
+)
+from dhtpy.dht.ratelimit import PRIORITY_QUERY, PRIORITY_RESPONSE, SendScheduler
 from dhtpy.dht.structures import Node
-from dhtpy.dht.udp import UDPNode
+from dhtpy.dht.timers import DeadlineQueue
+from dhtpy.dht.udp import BatchedUDPNode, UDPNode, create_udp_node
 
 logging.basicConfig(level=DEBUG_LEVEL)
 logger = logging.getLogger(__name__)
 
+Address = Tuple[str, int]
+
+
+class Transaction:
+    """A query waiting for its response."""
+
+    __slots__ = ("tid", "query", "address", "future", "sent_at", "verify_address")
+
+    def __init__(self, tid: bytes, query: bytes, address: Address, future):
+        self.tid = tid
+        self.query = query
+        self.address = address
+        self.future: asyncio.Future = future
+        # Set when the query leaves the send scheduler
+        self.sent_at = 0.0
+
+        # Queries sent to a hostname (bootstrap nodes) are answered from an
+        # address we do not know, only the ones sent to an ip are checked
+        try:
+            inet_pton(AF_INET, address[0])
+        except OSError:
+            self.verify_address = False
+        else:
+            self.verify_address = True
+
+
+def _retrieve_exception(future: asyncio.Future) -> None:
+    # Most queries are fire and forget and timeouts are routine in the DHT,
+    # mark the exception as retrieved so unawaited futures do not log it. Code
+    # awaiting the future still gets it raised.
+    if not future.cancelled():
+        future.exception()
+
+
+class TransactionManager:
+    """Allocates transaction ids and matches responses with their queries.
+
+    Pending transactions are timed out from a single deadline queue and timer,
+    and the round trip time of every answered query is recorded per address.
+    Both clocks start when the query is sent, not when it is queued, and
+    transactions whose query is dropped before being sent fail right away.
+
+    Args:
+        timeout: seconds to wait for a response
+        max_rtts: number of addresses the round trip time is kept for
+    """
+
+    # Transaction ids are 2 bytes long
+    MAX_PENDING = 1 << 16
+
+    def __init__(self, timeout: float = 5.0, max_rtts: int = 100_000):
+        self.timeout = timeout
+        self.max_rtts = max_rtts
+        self.pending: Dict[bytes, Transaction] = dict()
+        self.rtts: OrderedDict[Address, float] = OrderedDict()
+
+        self._next_tid = int.from_bytes(os.urandom(2), "big")
+        self._deadlines: DeadlineQueue[Transaction] = DeadlineQueue()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        self.sent = 0
+        self.answered = 0
+        self.timed_out = 0
+        self.unmatched = 0
+        self.dropped = 0
+
+    def _allocate_tid(self) -> bytes:
+        if len(self.pending) >= self.MAX_PENDING:
+            raise TooManyPendingQueries(message="No transaction ids left")
+
+        while True:
+            tid = self._next_tid.to_bytes(2, "big")
+            self._next_tid = (self._next_tid + 1) % self.MAX_PENDING
+            if tid not in self.pending:
+                return tid
+
+    def create(self, query: bytes, address: Address) -> Transaction:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        future.add_done_callback(_retrieve_exception)
+
+        transaction = Transaction(self._allocate_tid(), query, address, future)
+        self.pending[transaction.tid] = transaction
+        return transaction
+
+    def start(self, transaction: Transaction) -> None:
+        """Starts the clock of a transaction, its query was just sent."""
+        if self.pending.get(transaction.tid) is not transaction:
+            return
+
+        transaction.sent_at = time.monotonic()
+        self._deadlines.push(transaction.sent_at + self.timeout, transaction)
+        if self._timer is None:
+            loop = asyncio.get_event_loop()
+            self._timer = loop.call_later(self.timeout, self._on_timeout)
+        self.sent += 1
+
+    def drop(self, transaction: Transaction) -> None:
+        """Fails a transaction whose query will not be sent, freeing its id."""
+        if self.pending.get(transaction.tid) is not transaction:
+            return
+
+        del self.pending[transaction.tid]
+        self.dropped += 1
+        if not transaction.future.done():
+            transaction.future.set_exception(
+                QueryDropped(message=f"{transaction.query!r} to {transaction.address}")
+            )
+
+    def resolve(self, message: Mapping, address: Address) -> Optional[Transaction]:
+        """Completes the transaction the response or error belongs to. Returns
+        None for responses we did not ask for or that come from another
+        address than the one queried."""
+        tid = message.get(b"t")
+        transaction = self.pending.get(tid) if isinstance(tid, bytes) else None
+        if transaction is None or (
+            transaction.verify_address and transaction.address != address
+        ):
+            self.unmatched += 1
+            return None
+
+        del self.pending[transaction.tid]
+        self.answered += 1
+        self._record_rtt(address, time.monotonic() - transaction.sent_at)
+
+        if transaction.future.done():
+            return transaction
+
+        if message.get(b"y") == b"e":
+            code, error_message = None, None
+            error = message.get(b"e")
+            if isinstance(error, list) and len(error) == 2:
+                code = error[0]
+                if isinstance(error[1], bytes):
+                    error_message = error[1].decode("utf-8", "replace")
+            transaction.future.set_exception(
+                QueryError(code=code, message=error_message)
+            )
+        else:
+            transaction.future.set_result(message)
+        return transaction
+
+    def _record_rtt(self, address: Address, rtt: float) -> None:
+        # Smoothed the same way TCP does
+        previous = self.rtts.pop(address, None)
+        self.rtts[address] = (
+            rtt if previous is None else previous + (rtt - previous) / 8
+        )
+        if len(self.rtts) > self.max_rtts:
+            self.rtts.popitem(last=False)
+
+    def rtt(self, address: Address) -> Optional[float]:
+        """Smoothed round trip time of the address, None if never measured."""
+        return self.rtts.get(address)
+
+    def _on_timeout(self) -> None:
+        self._timer = None
+        for _, transaction in self._deadlines.pop_expired(time.monotonic()):
+            # Already answered
+            if self.pending.get(transaction.tid) is not transaction:
+                continue
+
+            del self.pending[transaction.tid]
+            self.timed_out += 1
+            if not transaction.future.done():
+                transaction.future.set_exception(
+                    QueryTimeout(
+                        message=f"{transaction.query!r} to {transaction.address}"
+                    )
+                )
+
+        deadline = self._deadlines.next_deadline
+        if deadline is not None:
+            loop = asyncio.get_event_loop()
+            self._timer = loop.call_later(
+                max(0.0, deadline - time.monotonic()), self._on_timeout
+            )
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self.pending),
+            "sent": self.sent,
+            "answered": self.answered,
+            "timed_out": self.timed_out,
+            "unmatched": self.unmatched,
+            "dropped": self.dropped,
+        }
+
 
 class RPC:
-    def __init__(self):
-        self.udp_node = UDPNode()
-        self.udp_node.on_data_received = self._on_data_received
-        self.udp_node.on_bandwidth_exhausted = self._on_bandwidth_exhausted
+    """KRPC over UDP: sends queries, matches their responses and hands every
+    incoming message to on_response.
+
+    When the port is shared with other processes (reuse_port) the kernel
+    could deliver the response to a query to any of them. Queries then go
+    out of a socket of our own bound to an ephemeral port, which every
+    response to them comes back to, while responses to other nodes still go
+    out of the shared port.
+
+    Args:
+        query_timeout: seconds to wait for a response
+        batched_udp: receive and send datagrams in batches when available
+    """
+
+    def __init__(self, query_timeout: float = 5.0, batched_udp: bool = False):
+        self._batched_udp = batched_udp
+        self.udp_node = self._create_udp_node()
+        # Socket queries go out of when the port of udp_node is shared
+        self.query_node: Optional[Union[UDPNode, BatchedUDPNode]] = None
+
+        self.transactions = TransactionManager(timeout=query_timeout)
+        self.scheduler = SendScheduler(self.udp_node.send_message)
+        self.scheduler.on_sent = self.transactions.start
+        self.scheduler.on_dropped = self.transactions.drop
+        self.admission = AdmissionFilter()
+        # Datagrams dropped for not being KRPC messages
+        self.malformed = 0
 
         # Callbacks
-        self.on_response: Optional[Callable[[dict, Tuple[str, int]], None]] = None
+        # Called with every query and every response or error to a pending
+        # query, along with the name of that query
+        self.on_response: Optional[
+            Callable[[Mapping, Tuple[str, int], Optional[bytes]], None]
+        ] = None
         self.on_bandwidth_exhausted: Optional[Callable[[], None]] = None
 
+    def _create_udp_node(self) -> Union[UDPNode, BatchedUDPNode]:
+        udp_node = create_udp_node(self._batched_udp)
+        udp_node.on_data_received = self._on_data_received
+        if isinstance(udp_node, BatchedUDPNode):
+            udp_node.on_batch_received = self._on_batch_received
+        udp_node.on_bandwidth_exhausted = self._on_bandwidth_exhausted
+        return udp_node
+
     def _on_data_received(self, data: bytes, address: Tuple[str, int]):
         # If port is 0 skip since it cannot be reached
-        if address[1] == 0:
+        if address[1] == 0 or not self.admission.admit(data, address):
             return
 
-        try:
-            message = decode(data)
-        except BencoderError:
-            logging.debug("Error decoding data in RPC._on_data_received")
-        else:
-            if self.on_response:
-                self.on_response(message, address)
+        message = krpc.parse(data)
+        if message is None:
+            self.malformed += 1
+            return
+
+        self._on_message(message, address)
+
+    def _on_batch_received(self, datagrams: List[Tuple[bytes, Tuple[str, int]]]):
+        on_data_received = self._on_data_received
+        for data, address in datagrams:
+            on_data_received(data, address)
+
+    def _on_message(self, message: Mapping, address: Tuple[str, int]):
+        if not isinstance(message, Mapping):
+            return
+
+        # Drop responses to queries we did not send before dispatching them,
+        # the others are dispatched with the name of the query they answer
+        query = None
+        if message.get(b"y") in (b"r", b"e"):
+            transaction = self.transactions.resolve(message, address)
+            if not transaction:
+                return
+            query = transaction.query
+
+        if self.on_response:
+            self.on_response(message, address, query)
 
     def _on_bandwidth_exhausted(self):
+        self.scheduler.on_bandwidth_exhausted()
         if self.on_bandwidth_exhausted:
             self.on_bandwidth_exhausted()
 
-    def ping_node(self, nid: str, node: Union[Node, Tuple[str, int]]):
+    def query(
+        self,
+        node: Union[Node, Tuple[str, int]],
+        query: bytes,
+        arguments: Dict[bytes, Any],
+    ) -> asyncio.Future:
+        """
+        Sends a query and returns a future resolved with the response message,
+        or failed with QueryTimeout, QueryError or QueryDropped.
+        """
+        address = (node.address, node.port) if isinstance(node, Node) else node
+        transaction = self.transactions.create(query, address)
         data = {
+            b"t": transaction.tid,
             b"y": b"q",
-            b"q": b"ping",
-            b"t": b"aa",
-            b"a": {b"id": nid},
+            b"q": query,
+            b"a": arguments,
         }
-        self.send_message(node, data)
+        if not self.send_message(address, data, PRIORITY_QUERY, transaction):
+            self.transactions.drop(transaction)
+        return transaction.future
 
-    def find_node(self, nid: str, node: Node):
-        data = {
-            b"y": b"q",
-            b"q": b"find_node",
-            b"t": b"aa",
-            b"a": {b"id": nid, b"target": node.id},
+    def ping_node(
+        self, nid: bytes, node: Union[Node, Tuple[str, int]]
+    ) -> asyncio.Future:
+        return self.query(node, b"ping", {b"id": nid})
+
+    def find_node(
+        self, nid: bytes, node: Union[Node, Tuple[str, int]], target: bytes
+    ) -> asyncio.Future:
+        return self.query(node, b"find_node", {b"id": nid, b"target": target})
+
+    def get_peers(
+        self,
+        infohash: bytes,
+        node: Union[Node, Tuple[str, int]],
+        nid: bytes,
+        no_seed=False,
+        scrape=False,
+    ) -> asyncio.Future:
+        arguments: Dict[bytes, Any] = {b"id": nid, b"info_hash": infohash}
+        if no_seed:
+            arguments[b"noseed"] = 1
+        if scrape:
+            arguments[b"scrape"] = 1
+        return self.query(node, b"get_peers", arguments)
+
+    def announce_peer(
+        self,
+        infohash: bytes,
+        node: Union[Node, Tuple[str, int]],
+        nid: bytes,
+        token: bytes,
+        port: Optional[int] = None,
+    ) -> asyncio.Future:
+        """Announces us as a peer of the infohash, with port None the node uses
+        the source port of the query (implied_port)."""
+        arguments = {
+            b"id": nid,
+            b"info_hash": infohash,
+            b"token": token,
+            b"port": port or 0,
+            b"implied_port": 1 if port is None else 0,
         }
-        self.send_message(node, data)
+        return self.query(node, b"announce_peer", arguments)
+
+    def sample_infohashes(
+        self, nid: bytes, node: Union[Node, Tuple[str, int]], target: bytes
+    ) -> asyncio.Future:
+        """BEP 51, asks the node for a sample of the infohashes it stores."""
+        return self.query(node, b"sample_infohashes", {b"id": nid, b"target": target})
 
     def send_message(
         self,
         node: Union[Node, Tuple[str, int]],
         data: dict,
-    ):
-        address = (node.address, node.port) if isinstance(node, Node) else node
+        priority: int = PRIORITY_RESPONSE,
+        transaction: Optional[Transaction] = None,
+    ) -> bool:
+        """Encodes and sends a message, returns False if it was dropped."""
         try:
             message = encode(data)
         except BencoderError:
             logging.debug("Error encoding data in RPC.send_message")
-        else:
-            self.udp_node.send_message(message, address)
-
-    async def start(self):
-        await self.udp_node.start()
+            return False
+        return self.send_encoded(node, message, priority, transaction)
 
-    def announce_peer(self, tid: bytes, nid: str, node: Union[Node, Tuple[str, int]]):
-        data = {b"t": tid, b"y": b"r", b"r": {b"id": nid}}
-        self.send_message(node, data)
-
-    def get_peers(
+    def send_encoded(
         self,
-        infohash: bytes,
-        node: Node,
-        nid: str,
-        no_seed=False,
-        scrape=False,
-    ):
-        # TODO transactions id
-        data = {
-            b"t": os.urandom(2),
-            b"y": b"q",
-            b"a": {
-                b"id": nid,
-                b"infohash": infohash,
-            },
-        }
+        node: Union[Node, Tuple[str, int]],
+        message: bytes,
+        priority: int = PRIORITY_RESPONSE,
+        transaction: Optional[Transaction] = None,
+    ) -> bool:
+        """Sends a message already bencoded, the transaction of a query is
+        started when it goes out. Returns False if it was dropped."""
+        address = (node.address, node.port) if isinstance(node, Node) else node
+        return self.scheduler.send(message, address, priority, transaction)
 
-        if no_seed or scrape:
-            a = {}
-            if no_seed:
-                a["noseed"] = 1
-            if scrape:
-                a["scrape"] = 1
-            data[b"a"] = a
+    async def start(
+        self, address: str = ADDRESS, port: int = PORT, reuse_port: bool = False
+    ):
+        await self.udp_node.start(address, port, reuse_port)
+        if reuse_port:
+            self.query_node = self._create_udp_node()
+            await self.query_node.start(address, 0)
+            self.scheduler.send_query = self.query_node.send_message
 
-        self.send_message(node, data)
+    def close(self) -> None:
+        self.udp_node.close()
+        if self.query_node is not None:
+            self.query_node.close()
 
     def send_raw_message(self, node: Union[Node, Tuple[str, int]], data: dict):
         self.send_message(node, data)
@@ -1,14 +1,28 @@
 import asyncio
 import logging
 import os
-from typing import List, Tuple, Union
+import time
+from collections.abc import Mapping
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from dhtpy.config import ADDRESS, DHT_BOOTSTRAP_NODES, PORT
+from dhtpy.dht.constants import (
+    LOOKUP_K,
+    SAMPLE_INFOHASHES_COUNT,
+    SAMPLE_INFOHASHES_INTERVAL,
+)
+from dhtpy.dht.crawl import SampleCrawler
 from dhtpy.dht.dispatcher import DHTDispatcher
+from dhtpy.dht.lookup import Lookup
+from dhtpy.dht.peers import PeerStore
+from dhtpy.dht.responses import ResponseBuilder
 from dhtpy.dht.routing import RoutingTable
 from dhtpy.dht.rpc import RPC
-from dhtpy.dht.structures import Node, Peer
+from dhtpy.dht.snapshot import SnapshotError
+from dhtpy.dht.structures import Node
+from dhtpy.dht.tokens import TokenIssuer
 from dhtpy.dht.utils import join_nodes_compact_info
+from dhtpy.utils import StoringError
 
 logger = logging.getLogger(__name__)
 
@@ -17,37 +31,122 @@ class Server(DHTDispatcher):
     def __init__(
         self,
         max_neighbors: int = 10000,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval: int = 600,
+        max_peers: int = 1_000_000,
+        batched_udp: bool = False,
+        nid: Optional[Union[bytes, int]] = None,
     ):
         """Args:
 
         max_neighbors: maximum number of neighbors in the crawling service
+        snapshot_path: file the routing table is restored from on start and
+        periodically saved to, so restarts do not need to bootstrap again
+        snapshot_interval: seconds between routing table snapshots
+        max_peers: maximum number of announced peers kept across all infohashes
+        batched_udp: move datagrams in batches with recvmmsg/sendmmsg, falls
+        back to the asyncio protocol where they are not available
+        nid: id of the node, random by default. Ignored when the routing table
+        is restored from a snapshot, which keeps the id it was built for
         """
-        self.node = Node.create_random(ADDRESS, PORT)
-        # Transaction id used for all queries
-        self.tid = os.urandom(2)
+        self.rpc: RPC = RPC(batched_udp=batched_udp)
 
-        self.rpc: RPC = RPC()
+        self.snapshot_path = snapshot_path
+        self._snapshot_interval = snapshot_interval
+        restored_routing_table = self._load_routing_table()
+        if restored_routing_table:
+            self.routing_table: RoutingTable = restored_routing_table
+            self.node = Node(restored_routing_table.nid, ADDRESS, PORT)
+        elif nid is not None:
+            self.node = Node(nid, ADDRESS, PORT)
+            self.routing_table = RoutingTable(self.node.nid)
+        else:
+            self.node = Node.create_random(ADDRESS, PORT)
+            self.routing_table = RoutingTable(self.node.nid)
+        self.responses = ResponseBuilder(self.node.id_bytes)
+        # Number of restored nodes pinged in the first maintenance
+        self._restored_sample_size = 32 if restored_routing_table else 0
+
+        self.peer_store = PeerStore(max_entries=max_peers)
+        self.tokens = TokenIssuer()
+        # Infohashes returned to sample_infohashes queries, and how many we
+        # had when they were sampled, until the samples expire
+        self._samples = b""
+        self._samples_num = 0
+        self._samples_expire = 0.0
 
-        self.routing_table: RoutingTable = RoutingTable()
         self._maintain_routing_table_interval = 300  # in seconds
+        self._liveness_timer: Optional[asyncio.TimerHandle] = None
+        self._liveness_deadline: Optional[float] = None
+
+        # Callbacks
+        self.on_infohash: Optional[Callable[[bytes], None]] = None
 
         super().__init__(self.rpc)
 
+    def _load_routing_table(self) -> Optional[RoutingTable]:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
+
+        try:
+            return RoutingTable.load_file(self.snapshot_path)
+        except (OSError, ValueError, SnapshotError):
+            logger.exception("Could not restore the routing table from snapshot.")
+            return None
+
+    async def _save_routing_table(self):
+        try:
+            await self.routing_table.save(self.snapshot_path)  # type: ignore
+        except StoringError as e:
+            logger.error(e.message)
+
+    def schedule_save_routing_table(self):
+        asyncio.ensure_future(self._save_routing_table())
+        loop = asyncio.get_event_loop()
+        loop.call_later(self._snapshot_interval, self.schedule_save_routing_table)
+
     async def _maintain_routing_table(self):
+        # Confirm a sample of the nodes restored from the snapshot, the rest
+        # are pinged when their liveness deadline comes
+        if self._restored_sample_size:
+            for node in self.routing_table.sample(self._restored_sample_size):
+                self.ping_node(node)
+            self._restored_sample_size = 0
+            self._schedule_liveness()
+
+        self.peer_store.remove_expired()
+
         # Bootstrap
         if self.routing_table.is_empty:
             for node in DHT_BOOTSTRAP_NODES:
                 self.routing_table.add(node)
                 for _ in range(5):
                     self.find_node(node)
+            self._schedule_liveness()
 
-        # Maintain
-        self._ping_unheard_nodes()
-        self.routing_table.remove_offline_nodes()
-
-    def _ping_unheard_nodes(self):
-        for node in self.routing_table.unheard_nodes:
+    def _on_liveness_deadline(self):
+        self._liveness_timer = self._liveness_deadline = None
+        for node in self.routing_table.expire():
             self.ping_node(node)
+        self._schedule_liveness()
+
+    def _schedule_liveness(self):
+        """Arms the timer for the next liveness deadline of the routing table,
+        unless it is already armed for an earlier one."""
+        deadline = self.routing_table.next_deadline
+        if deadline is None:
+            return
+
+        if self._liveness_deadline is not None:
+            if self._liveness_deadline <= deadline:
+                return
+            self._liveness_timer.cancel()  # type: ignore
+
+        loop = asyncio.get_event_loop()
+        self._liveness_deadline = deadline
+        self._liveness_timer = loop.call_later(
+            max(0.0, deadline - time.monotonic()), self._on_liveness_deadline
+        )
 
     def schedule_maintain_routing_table(self):
         asyncio.ensure_future(self._maintain_routing_table())
@@ -57,130 +156,230 @@ class Server(DHTDispatcher):
         )
 
     # Queries
-    def on_ping_query(self, node: Node, data: dict):
-        self.send_message(
-            node,
-            {
-                b"t": data[b"t"],
-                b"y": b"r",
-                b"r": {b"id": self.node.id},
-            },
-        )
+    def on_ping_query(self, node: Node, data: Mapping):
+        self.send_encoded(node, self.responses.ping(data[b"t"]))
 
-    def on_find_node_query(self, node: Node, data: dict):
-        closest_nodes = self.routing_table.get_closest_nodes(data[b"a"][b"target"])
-        self.send_message(
+    def on_find_node_query(self, node: Node, data: Mapping):
+        target = data[b"a"][b"target"]
+        if len(target) != 20:
+            return
+        closest_nodes = self.routing_table.get_closest_nodes(target)
+        self.send_encoded(
             node,
-            {
-                b"t": data[b"t"],
-                b"y": b"r",
-                b"r": {
-                    b"id": self.node.id,
-                    b"nodes": join_nodes_compact_info(closest_nodes),
-                },
-            },
-        )
-
-    def on_announce_peer_query(self, node: Node, data: dict):
-        self.routing_table.add_peer(
-            Peer(
-                infohash=data[b"a"][b"infohash"],
-                address=node.address,
-                port=node.port,
+            self.responses.find_node(
+                data[b"t"], join_nodes_compact_info(closest_nodes)
             ),
-            node,
         )
 
-        self.send_message(
-            node,
-            {
-                b"t": data[b"t"],
-                b"y": b"r",
-                b"r": {b"id": node.id},
-            },
+    def on_announce_peer_query(self, node: Node, data: Mapping, port: int):
+        infohash = data[b"a"].get(b"info_hash", b"")
+        if len(infohash) != 20:
+            return
+        # Only the address a get_peers reply was sent to can announce
+        if not self.tokens.check(
+            data[b"a"].get(b"token", b""), node.compact_info[20:24]
+        ):
+            return
+        if self.on_infohash:
+            self.on_infohash(infohash)
+
+        # The peer is at the address of the node, on the port it announced
+        self.peer_store.add(
+            infohash, node.compact_info[20:24] + port.to_bytes(2, "big")
         )
 
-    def on_get_peers_query(self, node: Node, data: dict):
-        peers = self.routing_table.get_peers(data[b"a"][b"infohash"])
+        self.send_encoded(node, self.responses.ping(data[b"t"]))
+
+    def on_get_peers_query(self, node: Node, data: Mapping):
+        infohash = data[b"a"].get(b"info_hash", b"")
+        if len(infohash) != 20:
+            return
+        if self.on_infohash:
+            self.on_infohash(infohash)
+        # Nodes that get no peers still need a token to announce themselves
+        token = self.tokens.issue(node.compact_info[20:24])
+        peers = self.peer_store.get(infohash)
         if peers:
-            self.send_message(
-                node,
-                {
-                    b"t": data[b"t"],
-                    b"y": b"r",
-                    b"r": {
-                        b"id": self.node.id,
-                        b"token": os.urandom(2),
-                        b"values": [peer.compact_info for peer in peers],
-                    },
-                },
-            )
+            self.send_encoded(node, self.responses.get_peers(data[b"t"], token, peers))
         else:
-            closest_nodes = self.routing_table.get_closest_nodes(
-                data[b"a"][b"infohash"]
-            )
-            self.send_message(
+            closest_nodes = self.routing_table.get_closest_nodes(infohash)
+            self.send_encoded(
                 node,
-                {
-                    b"t": data[b"t"],
-                    b"y": b"r",
-                    b"r": {
-                        b"id": self.node.id,
-                        b"nodes": join_nodes_compact_info(closest_nodes),
-                    },
-                },
+                self.responses.find_node(
+                    data[b"t"], join_nodes_compact_info(closest_nodes), token
+                ),
             )
 
+    def on_sample_infohashes_query(self, node: Node, data: Mapping):
+        now = time.monotonic()
+        if now >= self._samples_expire:
+            samples = self.peer_store.sample(SAMPLE_INFOHASHES_COUNT)
+            self._samples = b"".join(samples)
+            self._samples_num = self.peer_store.infohashes
+            self._samples_expire = now + SAMPLE_INFOHASHES_INTERVAL
+
+        target = data[b"a"].get(b"target", self.node.id_bytes)
+        if len(target) != 20:
+            return
+        closest_nodes = self.routing_table.get_closest_nodes(target)
+        self.send_encoded(
+            node,
+            self.responses.sample_infohashes(
+                data[b"t"],
+                int(self._samples_expire - now),
+                join_nodes_compact_info(closest_nodes),
+                self._samples_num,
+                self._samples,
+            ),
+        )
+
     # Responses
     def on_ping_response(self, tid: bytes, node: Node):
-        # TODO fix, not needed
-        return super().on_ping_response(tid, node)
+        """The node is alive, refresh its last contact"""
+        self.routing_table.add(node)
+        self._schedule_liveness()
 
     def on_find_node_response(self, tid: bytes, nodes: List[Node]):
         """Found a node, if the table is not full and the node is valid, add it"""
         nodes = [node for node in nodes if self.node != node and node.is_valid]
         for node in nodes:
             self.routing_table.add(node)
+        self._schedule_liveness()
 
-    def on_announce_peer_response(
-        self, tid: bytes, nid: bytes, infohash: bytes, node: Node
-    ):
-        logger.debug(f"On announce peer, infohash {infohash.hex()}")
+    def on_announce_peer_response(self, tid: bytes, node: Node):
+        logger.debug(f"On announce peer, node {node.address}:{node.port}")
 
     def on_get_peers_response(
-        self, tid: bytes, token: bytes, node: List[Node], values: List[bytes]
+        self,
+        tid: bytes,
+        token: Optional[bytes],
+        nodes: List[Node],
+        values: List[bytes],
     ):
         logger.debug(f"On get peers")
 
+    def on_sample_infohashes_response(
+        self,
+        tid: bytes,
+        node: Node,
+        samples: List[bytes],
+        nodes: List[Node],
+        num: int,
+        interval: int,
+    ):
+        if self.on_infohash:
+            for infohash in samples:
+                self.on_infohash(infohash)
+        self.on_find_node_response(tid, nodes)
+
     # Messages
-    def ping_node(self, node: Union[Node, Tuple[str, int]]):
-        self.rpc.ping_node(self.node.id, node)
+    def ping_node(self, node: Union[Node, Tuple[str, int]]) -> asyncio.Future:
+        return self.rpc.ping_node(self.node.id_bytes, node)
 
-    def find_node(self, node: Node):
-        self.rpc.find_node(self.node.id, node)
+    def find_node(
+        self, node: Union[Node, Tuple[str, int]], target: Optional[bytes] = None
+    ) -> asyncio.Future:
+        """Asks the node for the nodes closest to target, our own id by
+        default."""
+        return self.rpc.find_node(
+            self.node.id_bytes, node, target or self.node.id_bytes
+        )
+
+    def sample_infohashes(
+        self, node: Union[Node, Tuple[str, int]], target: Optional[bytes] = None
+    ) -> asyncio.Future:
+        """BEP 51, asks the node for a sample of the infohashes it stores and
+        the nodes closest to target, our own id by default."""
+        return self.rpc.sample_infohashes(
+            self.node.id_bytes, node, target or self.node.id_bytes
+        )
 
-    def announce_peer(self, node: Union[Node, Tuple[str, int]]):
-        self.rpc.announce_peer(self.tid, self.node.id, node)
+    def announce_peer(
+        self,
+        node: Union[Node, Tuple[str, int]],
+        infohash: bytes,
+        token: bytes,
+        port: Optional[int] = None,
+    ) -> asyncio.Future:
+        return self.rpc.announce_peer(infohash, node, self.node.id_bytes, token, port)
 
     def get_peers(
         self,
         infohash: bytes,
         no_seed: bool = False,
         scrape: bool = False,
-    ) -> None:
-        # TODO: fix None, should be a node to contact, using closest in routing table
-        self.rpc.get_peers(self.tid, infohash, None, self.node.id, no_seed, scrape)  # type: ignore
+        **kwargs,
+    ) -> Lookup:
+        """Iterative get_peers lookup seeded from the routing table, iterate
+        over it to get the peers as they are found. Keyword arguments are
+        passed to Lookup."""
+        return Lookup(
+            infohash,
+            self.routing_table.get_closest_nodes(infohash, LOOKUP_K),
+            lambda node: self.rpc.get_peers(
+                infohash, node, self.node.id_bytes, no_seed, scrape
+            ),
+            **kwargs,
+        )
+
+    def crawl(self, **kwargs) -> SampleCrawler:
+        """Crawl of the infohashes stored by other nodes with
+        sample_infohashes, seeded from the routing table. Iterate over it to
+        get the infohashes as they are discovered, every one of them also goes
+        to on_infohash. Keyword arguments are passed to SampleCrawler."""
+        return SampleCrawler(self.routing_table.nodes, self.sample_infohashes, **kwargs)
 
-    async def start(self, address: str = "0.0.0.0", port: int = 6881, run_forever=True):
-        await self.rpc.start()
+    def lookup(self, target: bytes, **kwargs) -> Lookup:
+        """Iterative find_node lookup seeded from the routing table, await its
+        run method to get the closest nodes to target."""
+        return Lookup(
+            target,
+            self.routing_table.get_closest_nodes(target, LOOKUP_K),
+            lambda node: self.rpc.find_node(self.node.id_bytes, node, target),
+            **kwargs,
+        )
+
+    async def start(
+        self,
+        address: str = "0.0.0.0",
+        port: int = 6881,
+        run_forever=True,
+        reuse_port: bool = False,
+    ):
+        """Binds the socket and starts the maintenance timers. With reuse_port
+        several processes can bind the same address, see dhtpy.dht.cluster."""
+        await self.rpc.start(address, port, reuse_port)
         self.schedule_maintain_routing_table()
+        if self.snapshot_path:
+            loop = asyncio.get_running_loop()
+            loop.call_later(self._snapshot_interval, self.schedule_save_routing_table)
 
         if run_forever:
             loop = asyncio.get_running_loop()
             loop.run_forever()
 
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Counters of the routing table, peer store, announce tokens,
+        transactions, send scheduler and admission filter, prefixed with the
+        component they come from."""
+        stats: Dict[str, float] = {}
+        for prefix, component in (
+            ("routing", self.routing_table.stats),
+            ("peers", self.peer_store.stats),
+            ("tokens", self.tokens.stats),
+            ("transactions", self.rpc.transactions.stats),
+            ("send", self.rpc.scheduler.stats),
+            ("admission", self.rpc.admission.stats),
+        ):
+            for key, value in component.items():
+                stats[f"{prefix}_{key}"] = value
+        stats["received_malformed"] = self.rpc.malformed
+        return stats
+
     async def stop(self):
-        pass
+        if self.snapshot_path:
+            await self._save_routing_table()
 
     def send_message(
         self,
@@ -189,6 +388,9 @@ class Server(DHTDispatcher):
     ):
         self.rpc.send_raw_message(node, data)
 
+    def send_encoded(self, node: Union[Node, Tuple[str, int]], message: bytes):
+        self.rpc.send_encoded(node, message)
+
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
@@ -0,0 +1,124 @@
+"""
+Binary snapshot of a routing table, used to warm restart a Server without
+bootstrapping again.
+
+Layout, all integers big endian:
+
+    header   magic (8 bytes) | own id (20) | buckets (u16) | nodes (u32)
+    buckets  start (20) | end (20) | nodes (u32), once per bucket
+    nodes    compact info (26) | seconds since last contact (u32), grouped
+             by bucket in the same order, the least recently seen node of
+             each bucket first
+
+Every record has a fixed size so a snapshot can be read straight from a
+memory mapped file, and the entries of a bucket kept as they are until its
+nodes are needed.
+"""
+
+from __future__ import annotations
+
+import mmap
+import struct
+import time
+from typing import List, Tuple, Union
+
+from dhtpy.dht.structures import Node
+from dhtpy.utils import PersistenceError, write_atomically
+
+MAGIC = b"DHTPYRT\x01"
+HEADER = struct.Struct("!8s20sHI")
+BUCKET = struct.Struct("!20s20sI")
+NODE = struct.Struct("!26sI")
+
+# (start, end, nodes, entries) of each bucket, entries being the snapshot
+# entries of the nodes restored into it and not built yet
+BucketState = Tuple[int, int, List[Node], bytes]
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+class SnapshotError(PersistenceError):
+    pass
+
+
+def pack(nid: int, buckets: List[BucketState], restored: float = 0.0) -> bytes:
+    """
+    Packs the buckets, ``restored`` is the monotonic time the ages of their
+    entries are relative to.
+
+    Nodes known by a hostname, like the bootstrap ones, are left out: their
+    compact form holds 0.0.0.0 and they could not be restored from it.
+    """
+    now = time.monotonic()
+    shift = max(int(now - restored), 0)
+
+    counts = []
+    node_chunks = []
+    for _, _, nodes, entries in buckets:
+        if shift and entries:
+            entries = b"".join(
+                NODE.pack(compact_info, min(age + shift, 0xFFFFFFFF))
+                for compact_info, age in NODE.iter_unpack(entries)
+            )
+        nodes = [node for node in nodes if node.ip]
+        ages = [min(max(int(now - node.last_contact), 0), 0xFFFFFFFF) for node in nodes]
+        packed = list(map(NODE.pack, [node.compact_info for node in nodes], ages))
+        if packed and not entries:
+            oldest = ages.index(max(ages))
+            packed[0], packed[oldest] = packed[oldest], packed[0]
+
+        counts.append(len(entries) // NODE.size + len(packed))
+        node_chunks.append(entries)
+        node_chunks.extend(packed)
+
+    chunks = [HEADER.pack(MAGIC, nid.to_bytes(20, "big"), len(buckets), sum(counts))]
+    for (start, end, _, _), count in zip(buckets, counts):
+        chunks.append(
+            BUCKET.pack(start.to_bytes(20, "big"), end.to_bytes(20, "big"), count)
+        )
+    return b"".join(chunks + node_chunks)
+
+
+def unpack(buffer: Buffer) -> Tuple[int, List[Tuple[int, int, memoryview]]]:
+    """
+    Parses a snapshot, returns our own id and the buckets with a view of their
+    entries, to be read with ``NODE``.
+    """
+    view = memoryview(buffer)
+    try:
+        magic, nid, bucket_count, node_count = HEADER.unpack_from(view)
+    except struct.error:
+        raise SnapshotError(message="Truncated snapshot header")
+
+    if magic != MAGIC:
+        raise SnapshotError(message="Not a routing table snapshot")
+
+    nodes_offset = HEADER.size + bucket_count * BUCKET.size
+    if len(view) != nodes_offset + node_count * NODE.size:
+        raise SnapshotError(message="Snapshot size does not match its header")
+
+    buckets = []
+    for i in range(bucket_count):
+        start, end, count = BUCKET.unpack_from(view, HEADER.size + i * BUCKET.size)
+        nodes_end = nodes_offset + count * NODE.size
+        buckets.append(
+            (
+                int.from_bytes(start, "big"),
+                int.from_bytes(end, "big"),
+                view[nodes_offset:nodes_end],
+            )
+        )
+        nodes_offset = nodes_end
+    return int.from_bytes(nid, "big"), buckets
+
+
+def write(
+    path: str, nid: int, buckets: List[BucketState], restored: float = 0.0
+) -> None:
+    """Packs and atomically writes a snapshot. Safe to run in an executor as
+    long as the node lists are copies, nodes themselves are only read."""
+    write_atomically(path, pack(nid, buckets, restored))
+
+
+def map_file(path: str) -> mmap.mmap:
+    with open(path, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
@@ -1,43 +1,121 @@
 from __future__ import annotations
 
+import os
 import struct
+import time
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from datetime import datetime, timedelta
 from ipaddress import ip_address
-from typing import Union
+from socket import AF_INET, inet_aton, inet_ntoa, inet_pton
+from typing import Optional, Union
 
-from black import os
-from expiringdict import ExpiringDict  # type: ignore
+from dhtpy.dht.constants import NODE_OFFLINE_TIMEOUT, NODE_UNHEARD_TIMEOUT
+
+# Compact node info: 20 bytes id, 4 bytes ip and 2 bytes port
+COMPACT_NODE = struct.Struct("!20sIH")
 
 
-@dataclass
 class Node:
-    id: str
-    address: str
-    port: int
-    peers = ExpiringDict(max_len=1000, max_age_seconds=3600 * 24)
-    added: datetime = datetime.now()
-    last_contact: datetime = datetime.now()
+    """A DHT node.
 
-    def __hash__(self) -> int:
-        return hash(self.id + self.address + str(self.port))
+    The node id is kept as a 160 bit integer (``nid``) together with its raw
+    20 bytes (``id_bytes``), the IPv4 address as a packed integer (``ip``) and
+    the 26 bytes compact form used in ``find_node``/``get_peers`` replies is
+    built once. Timestamps come from the monotonic clock.
+
+    Addresses that are not IPv4 literals (i.e. the bootstrap hostnames) are
+    kept as they are and packed as ``0.0.0.0`` in the compact form.
+    """
+
+    __slots__ = (
+        "nid",
+        "ip",
+        "_port",
+        "_host",
+        "compact_info",
+        "added",
+        "last_contact",
+    )
+
+    def __init__(self, id: Union[bytes, int, str], address: str, port: int):
+        self._set(nid_to_int(id), address, port)
+        self.added: float = time.monotonic()
+        self.last_contact: float = self.added
+
+    def _set(self, nid: int, address: str, port: int) -> None:
+        try:
+            packed_ip = inet_pton(AF_INET, address)
+        except OSError:
+            packed_ip = bytes(4)
+            self._host: Optional[str] = address
+        else:
+            self._host = None
+
+        self.nid: int = nid
+        self.ip: int = int.from_bytes(packed_ip, "big")
+        self._port: int = int(port)
+        self.compact_info: bytes = COMPACT_NODE.pack(
+            nid.to_bytes(20, "big"), self.ip, self._port & 0xFFFF
+        )
+
+    @classmethod
+    def from_compact(
+        cls, compact_info: bytes, last_contact: Optional[float] = None
+    ) -> Node:
+        """
+        Creates a node from its 26 bytes compact form without going through
+        the hex and dotted quad representations.
+        """
+        id_bytes, ip, port = COMPACT_NODE.unpack(compact_info)
+        node = cls.__new__(cls)
+        node.nid = int.from_bytes(id_bytes, "big")
+        node.ip = ip
+        node._port = port
+        node._host = None
+        node.compact_info = bytes(compact_info)
+        node.added = node.last_contact = (
+            time.monotonic() if last_contact is None else last_contact
+        )
+        return node
 
     @property
     def id_bytes(self) -> bytes:
-        return bytes.fromhex(self.id)
+        return self.compact_info[:20]
 
     @property
-    def compact_info(self) -> bytes:
-        return struct.pack(
-            "!20s4sH",
-            self.id_bytes,
-            bytes(self.address.encode("ascii")),
-            int(self.port),
-        )
+    def id(self) -> str:
+        """Hex representation of the node id."""
+        return self.id_bytes.hex()
+
+    @id.setter
+    def id(self, value: Union[bytes, int, str]) -> None:
+        self._set(nid_to_int(value), self.address, self._port)
+
+    @property
+    def address(self) -> str:
+        if self._host is not None:
+            return self._host
+        return inet_ntoa(self.compact_info[20:24])
+
+    @address.setter
+    def address(self, value: str) -> None:
+        self._set(self.nid, value, self._port)
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    @port.setter
+    def port(self, value: int) -> None:
+        self._set(self.nid, self.address, value)
+
+    def __hash__(self) -> int:
+        return hash((self.nid, self.ip, self._port, self._host))
 
     @property
     def is_address_public(self) -> bool:
-        return not ip_address(self.address).is_private
+        host = self._host if self._host is not None else self.ip
+        return not ip_address(host).is_private
 
     @property
     def is_valid(self) -> bool:
@@ -45,22 +123,23 @@ class Node:
 
     @property
     def is_valid_port(self) -> bool:
-        return 0 < self.port < 65536
+        return 0 < self._port < 65536
 
     @property
     def is_unheard(self) -> bool:
-        return datetime.now() > (self.last_contact + timedelta(minutes=15))
+        return time.monotonic() > self.last_contact + NODE_UNHEARD_TIMEOUT
 
     @property
     def is_offline(self) -> bool:
-        return datetime.now() > (self.last_contact + timedelta(minutes=20))
+        return time.monotonic() > self.last_contact + NODE_OFFLINE_TIMEOUT
 
     def __eq__(self, other: object) -> bool:
         if isinstance(other, Node):
             return (
-                self.id == other.id
-                and self.address == other.address
-                and self.port == other.port
+                self.nid == other.nid
+                and self.ip == other.ip
+                and self._port == other._port
+                and self._host == other._host
             )
         return False
 
@@ -75,17 +154,26 @@ class Node:
         """
         Creates a random node with the desired address and port.
         """
-        nid = os.urandom(20).hex()
-        return cls(nid, address, port)
+        return cls(os.urandom(20), address, port)
 
     @staticmethod
-    def calculate_distance(nid: str, another_nid: str) -> int:
-        xor_ids = "".join([str(ord(a) ^ ord(b)) for a, b in zip(nid, another_nid)])
-        hex_bytes = bytes.fromhex(xor_ids)
-        return int.from_bytes(hex_bytes, "big")
+    def calculate_distance(
+        nid: Union[bytes, int, str], another_nid: Union[bytes, int, str]
+    ) -> int:
+        """XOR distance between two node ids."""
+        return nid_to_int(nid) ^ nid_to_int(another_nid)
 
     def update_last_contact(self):
-        self.last_contact = datetime.now()
+        self.last_contact = time.monotonic()
+
+
+def nid_to_int(nid: Union[bytes, int, str]) -> int:
+    """Converts a node id given as raw bytes, hex string or int into an int."""
+    if isinstance(nid, int):
+        return nid
+    if isinstance(nid, str):
+        return int(nid, 16)
+    return int.from_bytes(nid, "big")
 
 
 @dataclass
@@ -95,8 +183,8 @@ class Peer:
     port: int
 
     @property
-    def compact_info(self):
-        return struct.pack("!4sH", self.ip.encode("ascii"), self.port)
+    def compact_info(self) -> bytes:
+        return struct.pack("!4sH", inet_aton(self.address), self.port)
 
 
 @dataclass
@@ -108,14 +196,34 @@ class Bucket:
         end (str): represents the hex end of the bucket
         capcity (int): capacity of the bucket, this value is also known as K per the
         Kademlia specification
+        replacement_capacity (int): maximum number of nodes kept as replacements
+        for when a node is removed from the full bucket
     """
 
-    # TODO keep a cache of good nodes in case a node is removed from a bucket
-
     start: str = (0).to_bytes(20, "big").hex()
     end: str = ((2 ** 160) - 1).to_bytes(20, "big").hex()  # this equals to ffff...
     capacity: int = 8
-    nodes: set[Node] = field(default_factory=set)
+    # Maps each node to itself so the stored instance can be retrieved
+    nodes: dict[Node, Node] = field(default_factory=dict)
+    replacement_capacity: int = 8
+    # Candidates that did not fit in the bucket, the most recently seen last
+    replacements: OrderedDict[Node, Node] = field(
+        default_factory=OrderedDict, repr=False
+    )
+    # Snapshot entries of the nodes restored into the bucket and not built
+    # yet, see RoutingTable.load
+    restored: bytes = field(default=b"", repr=False)
+    start_int: int = field(init=False, repr=False)
+    end_int: int = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # Boundaries are compared on every lookup, parse them only once
+        self.start_int = int(self.start, 16)
+        self.end_int = int(self.end, 16)
+        # The end is exclusive, the one of the last bucket is 2 ** 160 so it
+        # holds the id ffff... and its halves fall on the bits of the ids
+        if self.end_int == 2 ** 160 - 1:
+            self.end_int = 2 ** 160
 
     def __eq__(self, other: object) -> bool:
         if isinstance(other, Bucket):
@@ -145,16 +253,6 @@ class Bucket:
         """Returns end as bytes"""
         return bytes.fromhex(self.end)
 
-    @property
-    def start_int(self) -> int:
-        """Returns start as int"""
-        return int.from_bytes(self.start_bytes, "big")
-
-    @property
-    def end_int(self) -> int:
-        """Returns end as int"""
-        return int.from_bytes(self.end_bytes, "big")
-
     @property
     def half(self) -> str:
         """Returns the half of the bucket.
@@ -168,22 +266,47 @@ class Bucket:
     def add(self, node: Node) -> bool:
         """Given a node, add it to the bucket"""
 
-        # Node is not in range and max capacity of the bucket reached
-        if not self.in_range(node.id) or len(self.nodes) >= self.capacity:
-            return False
-
         # Node already exists in the bucket, update last contact
-        if node in self.nodes:
-            node.update_last_contact()
+        stored = self.nodes.get(node)
+        if stored is not None:
+            stored.update_last_contact()
             return True
 
-        self.nodes.add(node)
+        # Node is not in range and max capacity of the bucket reached
+        if not self.in_range(node.nid) or len(self.nodes) >= self.capacity:
+            return False
+
+        self.nodes[node] = node
+        self.replacements.pop(node, None)
         return True
 
+    def add_replacement(self, node: Node) -> None:
+        """Keeps a node that did not fit in the bucket as a replacement
+        candidate, dropping the least recently seen one when over capacity."""
+        stored = self.replacements.get(node)
+        if stored is not None:
+            stored.update_last_contact()
+            self.replacements.move_to_end(node)
+            return
+
+        self.replacements[node] = node
+        if len(self.replacements) > self.replacement_capacity:
+            self.replacements.popitem(last=False)
+
+    def promote(self) -> Optional[Node]:
+        """Moves the most recently seen replacement into the bucket if there is
+        room for it, returns the promoted node."""
+        if not self.replacements or len(self.nodes) >= self.capacity:
+            return None
+
+        _, node = self.replacements.popitem()
+        self.nodes[node] = node
+        return node
+
     def remove(self, node: Node) -> bool:
         """Given a node, remove it from the bucket"""
         try:
-            self.nodes.remove(node)
+            del self.nodes[node]
         except KeyError:
             return False
         else:
@@ -191,10 +314,7 @@ class Bucket:
 
     def in_range(self, nid: Union[bytes, int, str]) -> bool:
         """Checks if the node id is in range of this node."""
-        if isinstance(nid, str):
-            nid = bytes.fromhex(nid)
-
-        if isinstance(nid, int):
-            return self.start_int <= nid < self.end_int
+        if not isinstance(nid, int):
+            nid = nid_to_int(nid)
 
-        return self.start_bytes <= nid < self.end_bytes
+        return self.start_int <= nid < self.end_int
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+from typing import Generic, Iterable, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class DeadlineQueue(Generic[T]):
+    """Min-heap of items keyed by a deadline in monotonic time.
+
+    Entries cannot be removed, owners are expected to check whether an item
+    is still relevant when it is popped and ignore it otherwise. That keeps
+    rescheduling and cancelling O(1) and the cost of draining the queue
+    proportional to the number of expired entries.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, T]] = []
+        # Breaks ties between equal deadlines so items are never compared
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @property
+    def next_deadline(self) -> Optional[float]:
+        """Earliest deadline in the queue, None if it is empty."""
+        return self._heap[0][0] if self._heap else None
+
+    def push(self, deadline: float, item: T) -> None:
+        heapq.heappush(self._heap, (deadline, next(self._counter), item))
+
+    def extend(self, entries: Iterable[Tuple[float, T]]) -> None:
+        """Pushes many (deadline, item) entries with a single heapify."""
+        counter = self._counter
+        self._heap.extend((deadline, next(counter), item) for deadline, item in entries)
+        heapq.heapify(self._heap)
+
+    def pop_expired(self, now: float) -> List[Tuple[float, T]]:
+        """Removes and returns the (deadline, item) entries due at now."""
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, item = heapq.heappop(self._heap)
+            expired.append((deadline, item))
+        return expired
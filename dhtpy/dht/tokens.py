@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import hashlib
+import hmac
+import os
+import time
+from typing import Dict
+
+from dhtpy.dht.constants import TOKEN_SECRET_INTERVAL, TOKEN_SIZE
+
+SECRET_SIZE = 16
+
+
+class TokenIssuer:
+    """Tokens handed out in get_peers replies and required by announce_peer,
+    as described in BEP 5.
+
+    A token is a hash of the IP address of the querier and a secret, so only
+    the address that asked for it can announce with it. The secret is
+    replaced every interval and tokens made with the previous one are still
+    accepted: a token stays valid between one and two intervals.
+
+    Args:
+        interval: seconds between two secrets
+    """
+
+    def __init__(self, interval: float = TOKEN_SECRET_INTERVAL):
+        self.interval = interval
+        self._secret = os.urandom(SECRET_SIZE)
+        self._previous_secret = os.urandom(SECRET_SIZE)
+        self._rotated = time.monotonic()
+
+        self.issued = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "issued": self.issued,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+        }
+
+    def _rotate(self) -> None:
+        now = time.monotonic()
+        if now - self._rotated < self.interval:
+            return
+        # Tokens of the current secret are valid for one more interval, unless
+        # that one is over too
+        if now - self._rotated < 2 * self.interval:
+            self._previous_secret = self._secret
+        else:
+            self._previous_secret = os.urandom(SECRET_SIZE)
+        self._secret = os.urandom(SECRET_SIZE)
+        self._rotated = now
+
+    @staticmethod
+    def _token(secret: bytes, ip: bytes) -> bytes:
+        return hashlib.sha1(ip + secret).digest()[:TOKEN_SIZE]
+
+    def issue(self, ip: bytes) -> bytes:
+        """Token for the 4 bytes packed IP address of a querier."""
+        self._rotate()
+        self.issued += 1
+        return self._token(self._secret, ip)
+
+    def check(self, token: bytes, ip: bytes) -> bool:
+        """Whether the token was issued to the IP address and is still valid."""
+        self._rotate()
+        valid = isinstance(token, bytes) and (
+            hmac.compare_digest(token, self._token(self._secret, ip))
+            or hmac.compare_digest(token, self._token(self._previous_secret, ip))
+        )
+        if valid:
+            self.accepted += 1
+        else:
+            self.rejected += 1
+        return valid
@@ -1,8 +1,13 @@
 import asyncio
+import ctypes
 import errno
 import logging
+import os
+import socket
+import struct
+import sys
 from asyncio.transports import DatagramTransport
-from typing import Callable, Optional, Tuple
+from typing import Callable, List, Optional, Tuple, Union
 
 from dhtpy.config import ADDRESS, DEBUG_LEVEL, PORT
 
@@ -35,11 +40,334 @@ class UDPNode(asyncio.DatagramProtocol):
         if self.on_data_received:
             self.on_data_received(data, address)
 
-    async def start(self):
+    async def start(
+        self, address: str = ADDRESS, port: int = PORT, reuse_port: bool = False
+    ):
         self.loop = asyncio.get_running_loop()
         await self.loop.create_datagram_endpoint(
-            lambda: self, local_addr=(ADDRESS, PORT)
+            lambda: self, local_addr=(address, port), reuse_port=reuse_port or None
         )
 
+    def close(self) -> None:
+        self.transport.close()
+
     def send_message(self, data: bytes, address: Tuple[str, int]) -> None:
         self.transport.sendto(data, address)
+
+
+# Batched transport
+# --------------------------------------------------------
+MSG_DONTWAIT = 0x40
+# in_addr as a native integer holding the address in network byte order
+_IN_ADDR = struct.Struct("=I")
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    # Port and address are kept in network byte order
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),
+        ("sin_addr", ctypes.c_uint32),
+        ("sin_zero", ctypes.c_char * 8),
+    ]
+
+
+def _load_libc() -> Optional[ctypes.CDLL]:
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, "recvmmsg") or not hasattr(libc, "sendmmsg"):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def _byte_view(array) -> memoryview:
+    view = memoryview((ctypes.c_ubyte * ctypes.sizeof(array)).from_buffer(array))
+    # ctypes exports "<B", slice assignment only takes the native "B"
+    return view.cast("B")
+
+
+# sockaddr_in with the port and address in network byte order. The family is
+# native, packing htons(AF_INET) in network order writes its native bytes.
+_SOCKADDR = struct.Struct("!HH4s8x")
+_FAMILY = socket.htons(socket.AF_INET)
+_MMSG_SIZE = ctypes.sizeof(_MMsgHdr)
+_MSG_LEN = struct.Struct("I")
+_MSG_LEN_OFFSET = _MMsgHdr.msg_len.offset
+_MSG_FLAGS = struct.Struct("i")
+_MSG_FLAGS_OFFSET = _MsgHdr.msg_flags.offset
+_IOV_SIZE = ctypes.sizeof(_IOVec)
+_IOV_LEN = struct.Struct("N")
+_IOV_LEN_OFFSET = _IOVec.iov_len.offset
+
+
+class _MessageVector:
+    """Preallocated mmsghdr array with a buffer and an address per message.
+
+    The arrays are read and written through byte views with struct, which is
+    much cheaper than going through the ctypes fields of every message.
+    """
+
+    def __init__(self, size: int, buffer_size: int):
+        self.size = size
+        self.buffer_size = buffer_size
+        self.buffers = ctypes.create_string_buffer(size * buffer_size)
+        self.addresses = (_SockAddrIn * size)()
+        self.iovecs = (_IOVec * size)()
+        self.messages = (_MMsgHdr * size)()
+
+        base = ctypes.addressof(self.buffers)
+        for i in range(size):
+            self.iovecs[i].iov_base = base + i * buffer_size
+            self.iovecs[i].iov_len = buffer_size
+            header = self.messages[i].msg_hdr
+            header.msg_name = ctypes.addressof(self.addresses[i])
+            # The socket is IPv4 only, so the kernel always writes back the
+            # same length and it does not need a reset between calls
+            header.msg_namelen = ctypes.sizeof(_SockAddrIn)
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+
+        self.buffer_view = _byte_view(self.buffers)
+        self.address_view = _byte_view(self.addresses)
+        self.iovec_view = _byte_view(self.iovecs)
+        self.message_view = _byte_view(self.messages)
+
+
+class BatchedUDPNode:
+    """UDP transport moving datagrams in batches with recvmmsg and sendmmsg.
+
+    Same interface as UDPNode, Linux only. When the socket becomes readable it
+    is drained batch_size datagrams per syscall, and datagrams sent during a
+    loop iteration are flushed together at the end of it. Received batches
+    are handed to on_batch_received when set, otherwise to on_data_received
+    one by one.
+
+    Args:
+        batch_size: datagrams moved per syscall
+        buffer_size: bytes reserved per datagram, longer received datagrams
+        are dropped and longer sent ones go out with a plain sendto
+    """
+
+    def __init__(self, batch_size: int = 64, buffer_size: int = 2048):
+        if _libc is None:
+            raise OSError("recvmmsg/sendmmsg are not available")
+
+        self.batch_size = batch_size
+        self._recv = _MessageVector(batch_size, buffer_size)
+        self._send = _MessageVector(batch_size, buffer_size)
+        # Datagrams with their packed ip and port
+        self._outgoing: List[Tuple[bytes, bytes, int]] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._waiting_writable = False
+        self.socket: Optional[socket.socket] = None
+
+        self.received = 0
+        self.sent = 0
+        self.truncated = 0
+        self.receive_calls = 0
+        self.send_calls = 0
+
+        # Callbacks
+        self.on_bandwidth_exhausted: Optional[Callable[[], None]] = None
+        self.on_data_received: Optional[Callable[[bytes, Tuple[str, int]], None]] = None
+        self.on_batch_received: Optional[
+            Callable[[List[Tuple[bytes, Tuple[str, int]]]], None]
+        ] = None
+
+    @staticmethod
+    def is_available() -> bool:
+        return _libc is not None
+
+    async def start(
+        self, address: str = ADDRESS, port: int = PORT, reuse_port: bool = False
+    ):
+        self.loop = asyncio.get_running_loop()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind((address, port))
+        self.loop.add_reader(self.socket.fileno(), self._on_readable)
+
+    def close(self) -> None:
+        if self.socket is None:
+            return
+        self.loop.remove_reader(self.socket.fileno())
+        if self._waiting_writable:
+            self.loop.remove_writer(self.socket.fileno())
+        if self._flush_handle:
+            self._flush_handle.cancel()
+        self.socket.close()
+        self.socket = None
+
+    def _on_readable(self) -> None:
+        vector = self._recv
+        fd = self.socket.fileno()  # type: ignore
+
+        # Bounded so a flood does not starve the rest of the loop
+        for _ in range(16):
+            count = _libc.recvmmsg(  # type: ignore
+                fd, vector.messages, vector.size, MSG_DONTWAIT, None
+            )
+            self.receive_calls += 1
+            if count < 0:
+                code = ctypes.get_errno()
+                if code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                # i.e. ECONNREFUSED from an ICMP error, the datagram is gone
+                continue
+
+            self._dispatch(count)
+            if count < vector.size:
+                return
+
+    def _dispatch(self, count: int) -> None:
+        vector = self._recv
+        messages = vector.message_view
+        addresses = vector.address_view
+        buffers = vector.buffer_view
+        buffer_size = vector.buffer_size
+        datagrams = []
+        for i in range(count):
+            offset = i * _MMSG_SIZE
+            if (
+                _MSG_FLAGS.unpack_from(messages, offset + _MSG_FLAGS_OFFSET)[0]
+                & socket.MSG_TRUNC
+            ):
+                self.truncated += 1
+                continue
+
+            (length,) = _MSG_LEN.unpack_from(messages, offset + _MSG_LEN_OFFSET)
+            _, port, packed_ip = _SOCKADDR.unpack_from(addresses, i * _SOCKADDR.size)
+            start = i * buffer_size
+            datagrams.append(
+                (
+                    bytes(buffers[start : start + length]),
+                    (socket.inet_ntoa(packed_ip), port),
+                )
+            )
+
+        self.received += len(datagrams)
+        if self.on_batch_received:
+            self.on_batch_received(datagrams)
+        elif self.on_data_received:
+            on_data_received = self.on_data_received
+            for data, address in datagrams:
+                on_data_received(data, address)
+
+    def send_message(self, data: bytes, address: Tuple[str, int]) -> None:
+        try:
+            packed_ip = socket.inet_aton(address[0])
+        except OSError:
+            # Hostnames (bootstrap nodes) are resolved by the kernel call
+            self._send_one(data, address)
+            return
+
+        if len(data) > self._send.buffer_size:
+            self._send_one(data, address)
+            return
+
+        self._outgoing.append((data, packed_ip, address[1]))
+        if self._flush_handle is None and not self._waiting_writable:
+            self._flush_handle = self.loop.call_soon(self._flush)
+
+    def _send_one(self, data: bytes, address: Tuple[str, int]) -> None:
+        try:
+            self.socket.sendto(data, address)  # type: ignore
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self.error_received(e)
+        else:
+            self.sent += 1
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        vector = self._send
+        addresses = vector.address_view
+        iovecs = vector.iovec_view
+        buffers = vector.buffer_view
+        buffer_size = vector.buffer_size
+        fd = self.socket.fileno()  # type: ignore
+        outgoing = self._outgoing
+        done = 0
+        while done < len(outgoing):
+            batch = outgoing[done : done + vector.size]
+            for i, (data, packed_ip, port) in enumerate(batch):
+                _SOCKADDR.pack_into(
+                    addresses, i * _SOCKADDR.size, _FAMILY, port, packed_ip
+                )
+                _IOV_LEN.pack_into(iovecs, i * _IOV_SIZE + _IOV_LEN_OFFSET, len(data))
+                start = i * buffer_size
+                buffers[start : start + len(data)] = data
+
+            count = _libc.sendmmsg(fd, vector.messages, len(batch), 0)  # type: ignore
+            self.send_calls += 1
+            if count >= 0:
+                done += count
+                self.sent += count
+                continue
+
+            code = ctypes.get_errno()
+            if code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # Resume once the socket buffer drains
+                self._waiting_writable = True
+                self.loop.add_writer(fd, self._on_writable)
+                break
+            # The first datagram of the batch failed, drop it like the
+            # protocol based transport does
+            done += 1
+            self.error_received(OSError(code, os.strerror(code)))
+
+        del outgoing[:done]
+
+    def _on_writable(self) -> None:
+        self.loop.remove_writer(self.socket.fileno())  # type: ignore
+        self._waiting_writable = False
+        self._flush()
+
+    def error_received(self, e: Exception) -> None:
+        if isinstance(e, PermissionError) or (
+            isinstance(e, OSError) and e.errno == errno.ENOBUFS
+        ):
+            if self.on_bandwidth_exhausted:
+                self.on_bandwidth_exhausted()
+        else:
+            logging.error(f"BatchedUDPNode error: {e}")
+
+
+def create_udp_node(batched: bool = False) -> Union[UDPNode, BatchedUDPNode]:
+    """Creates the batched transport when asked for and available, the
+    protocol based one otherwise."""
+    if batched:
+        if BatchedUDPNode.is_available():
+            return BatchedUDPNode()
+        logger.warning("recvmmsg/sendmmsg not available, using UDPNode")
+    return UDPNode()
@@ -1,5 +1,4 @@
 import logging
-from socket import inet_ntoa
 from typing import Iterable, List
 
 from dhtpy.config import DEBUG_LEVEL
@@ -17,23 +16,17 @@ def decode_nodes(encoded_nodes: bytes) -> List[Node]:
     """
     Converts a List[bytes] into List[Node].
     """
-    decoded_nodes = []
-    for i in range(0, len(encoded_nodes), 26):
-        bytes_node = encoded_nodes[i : i + 26]
+    return [
+        Node.from_compact(encoded_nodes[i : i + 26])
+        for i in range(0, len(encoded_nodes) - 25, 26)
+    ]
 
-        nid = bytes_node[:20].hex()
 
-        try:
-            address = inet_ntoa(bytes_node[20:24])
-        except OSError:
-            logger.debug("Error parsing a node, continuing...")
-            continue
-
-        port = int.from_bytes(bytes_node[24:], "big")
-
-        node = Node(id=nid, address=address, port=port)
-        decoded_nodes.append(node)
-    return decoded_nodes
+def split_samples(samples: bytes) -> List[bytes]:
+    """
+    Splits the samples of a sample_infohashes response into infohashes.
+    """
+    return [samples[i : i + 20] for i in range(0, len(samples) - 19, 20)]
 
 
 def generate_neighbor_nid(local_nid: bytes, neighbor_nid: bytes) -> bytes:
@@ -1,3 +1,5 @@
+import os
+import tempfile
 from typing import Optional
 
 
@@ -10,6 +12,28 @@ class StoringError(PersistenceError):
     pass
 
 
+def write_atomically(path: str, data: bytes) -> None:
+    """
+    Writes data to path through a temporary file in the same directory, so
+    readers find either the previous content or the new one.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise StoringError(message=f"Could not write {path}: {e}")
+
+
 class FileSystem:
     def __init__(self, file_path=None, root=False):
         self.children = []
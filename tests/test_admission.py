@@ -0,0 +1,74 @@
+import pytest
+
+from dhtpy.dht import admission
+from dhtpy.dht.admission import AdmissionFilter, Blocklist
+
+PING = b"d1:ad2:id20:" + b"n" * 20 + b"e1:q4:ping1:t2:aa1:y1:qe"
+ADDRESS = ("1.2.3.4", 6881)
+
+
+class TestBlocklist:
+    def test_contains(self):
+        blocklist = Blocklist(["10.0.0.0/8", "192.168.1.0/24", "1.2.3.4/32"])
+        assert "10.200.0.1" in blocklist
+        assert "192.168.1.255" in blocklist
+        assert "1.2.3.4" in blocklist
+        assert "1.2.3.5" not in blocklist
+        assert "192.168.2.0" not in blocklist
+        assert "9.255.255.255" not in blocklist
+        assert "0.0.0.0" not in blocklist
+
+    def test_merges_overlapping_and_adjacent_networks(self):
+        blocklist = Blocklist(["10.0.0.0/9", "10.128.0.0/9", "10.1.0.0/16", ""])
+        assert len(blocklist) == 1
+        assert "10.255.255.255" in blocklist
+
+    def test_hostnames_are_not_blocked(self):
+        assert "router.bittorrent.com" not in Blocklist(["0.0.0.0/0"])
+
+
+class TestAdmissionFilter:
+    def setup_method(self):
+        self.now = 0.0
+        self.filter = AdmissionFilter(rate=10, burst=5, max_sources=3)
+
+    @pytest.fixture(autouse=True)
+    def clock(self, monkeypatch):
+        monkeypatch.setattr(admission.time, "monotonic", lambda: self.now)
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            b"",
+            b"de",
+            PING[:-1],
+            b"l" + PING[1:],
+            b"dx" + PING[2:],
+            PING[:-1] + b"x" * 2048 + b"e",
+        ],
+    )
+    def test_malformed(self, data):
+        assert not self.filter.admit(data, ADDRESS)
+        assert self.filter.malformed == 1
+
+    def test_blocked(self):
+        self.filter = AdmissionFilter(blocklist=["1.2.0.0/16"])
+        assert not self.filter.admit(PING, ADDRESS)
+        assert self.filter.admit(PING, ("1.3.0.1", 6881))
+        assert self.filter.blocked == 1
+
+    def test_throttles_a_flooding_source(self):
+        assert all(self.filter.admit(PING, ADDRESS) for _ in range(5))
+        assert not self.filter.admit(PING, ADDRESS)
+        # Other sources have their own bucket
+        assert self.filter.admit(PING, ("5.6.7.8", 6881))
+
+        self.now += 0.1
+        assert self.filter.admit(PING, ADDRESS)
+        assert not self.filter.admit(PING, ADDRESS)
+        assert self.filter.throttled == 2
+
+    def test_sources_are_bounded(self):
+        for i in range(10):
+            self.filter.admit(PING, (f"1.1.1.{i}", 6881))
+        assert self.filter.stats["sources"] == 3
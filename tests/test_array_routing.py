@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+from dhtpy.dht.structures import Node
+from dhtpy.dht.utils import join_nodes_compact_info
+
+pytest.importorskip("numpy")
+
+from dhtpy.dht import array_routing  # noqa: E402
+from dhtpy.dht.array_routing import KEYED_NODE, ArrayRoutingTable  # noqa: E402
+
+
+class TestArrayRoutingTable:
+    def setup_method(self):
+        self.routing_table = ArrayRoutingTable(max_size=100, initial_capacity=4)
+        self.nodes = [Node.create_random("1.2.3.4", 1000 + i) for i in range(50)]
+
+    def test_add_compact(self):
+        added = self.routing_table.add_compact(join_nodes_compact_info(self.nodes))
+        assert added == 50
+        assert list(self.routing_table) == self.nodes
+
+    def test_add_compact_skips_port_zero(self):
+        node = Node.create_random("1.2.3.4", 0)
+        assert self.routing_table.add_compact(node.compact_info) == 0
+        assert self.routing_table.is_empty
+
+    def test_max_size(self):
+        for _ in range(3):
+            nodes = [Node.create_random("1.2.3.4", 1000 + i) for i in range(50)]
+            self.routing_table.add_compact(join_nodes_compact_info(nodes))
+        assert len(self.routing_table) == 100
+        assert self.routing_table.is_full
+        assert not self.routing_table.add(Node.create_random("1.2.3.4", 1000))
+
+    def test_duplicates_are_rejected(self):
+        self.routing_table.MERGE_SIZE = 20
+        for node in self.nodes[:30]:
+            assert self.routing_table.add(node)
+        assert not self.routing_table.add(self.nodes[0])
+        assert not self.routing_table.add(self.nodes[29])
+
+        compact = join_nodes_compact_info(self.nodes[20:] + self.nodes[40:])
+        assert self.routing_table.add_compact(compact) == 20
+        assert list(self.routing_table) == self.nodes
+
+        self.routing_table._last_contact[:10] = time.monotonic() - 100
+        self.routing_table.remove_expired(50)
+        assert self.routing_table.add(self.nodes[0])
+        assert not self.routing_table.add(self.nodes[10])
+
+    def test_duplicates_refresh_their_node(self):
+        self.routing_table.MERGE_SIZE = 20
+        self.routing_table.add_compact(join_nodes_compact_info(self.nodes))
+        self.routing_table._last_contact[:50] = time.monotonic() - 100
+
+        # Once merged and still recent, with a new address
+        moved = [Node(node.nid, "5.6.7.8", 6881) for node in self.nodes[:40:2]]
+        moved += [Node(node.nid, "5.6.7.8", 6881) for node in self.nodes[45:]]
+        assert self.routing_table.add_compact(join_nodes_compact_info(moved)) == 0
+
+        assert self.routing_table.remove_expired(50) == len(moved)
+        assert {node.nid for node in self.routing_table} == {node.nid for node in moved}
+        assert all(node.address == "5.6.7.8" for node in self.routing_table)
+
+    def test_ids_with_swapped_halves_are_distinct(self):
+        high, low = 0x0123456789ABCDEF, 0xFEDCBA9876543210
+        nodes = [
+            Node((high << 96) | (low << 32) | 7, "1.2.3.4", 1234),
+            Node((low << 96) | (high << 32) | 7, "1.2.3.4", 1234),
+        ]
+        assert self.routing_table.add_compact(join_nodes_compact_info(nodes)) == 2
+        assert list(self.routing_table) == nodes
+
+    def test_keys_match_their_vectorized_form(self):
+        self.routing_table.add_compact(join_nodes_compact_info(self.nodes))
+        keys = self.routing_table._id_keys(self.routing_table._ids[:50])
+        assert keys.tolist() == [
+            array_routing._key(*KEYED_NODE.unpack(node.compact_info)[:3])
+            for node in self.nodes
+        ]
+
+    def test_get_closest_nodes(self):
+        self.routing_table.add_compact(join_nodes_compact_info(self.nodes))
+
+        for target in [self.nodes[0].nid, Node.create_random("", 1).nid]:
+            expected = sorted(self.nodes, key=lambda node: node.nid ^ target)[:8]
+            assert self.routing_table.get_closest_nodes(target) == expected
+            assert self.routing_table.get_closest_compact(
+                target
+            ) == join_nodes_compact_info(expected)
+
+    def test_get_closest_nodes_with_shared_prefix(self):
+        # Ids only differing in their last bytes tie in the preselection
+        nodes = [Node((0xAB << 152) + i, "1.2.3.4", 1234) for i in range(20)]
+        for node in nodes:
+            self.routing_table.add(node)
+
+        assert self.routing_table.get_closest_nodes(0xAB << 152, 3) == nodes[:3]
+
+    def test_remove_expired(self):
+        self.routing_table.add_compact(join_nodes_compact_info(self.nodes))
+        self.routing_table._last_contact[:10] = time.monotonic() - 100
+
+        assert self.routing_table.remove_expired(50) == 10
+        assert list(self.routing_table) == self.nodes[10:]
@@ -0,0 +1,48 @@
+from dhtpy.dht.cluster import Coordinator, partition_nid
+from dhtpy.dht.routing import MAX_NID
+
+
+class TestPartitionNid:
+    def test_slices(self):
+        workers = 3
+        size = (MAX_NID + 1) // workers
+        for index in range(workers):
+            for _ in range(100):
+                nid = partition_nid(index, workers)
+                assert index * size <= nid < (index + 1) * size
+
+    def test_single_worker(self):
+        assert 0 <= partition_nid(0, 1) <= MAX_NID
+
+
+class TestCoordinator:
+    def test_merges_infohashes_once(self):
+        discovered = []
+        coordinator = Coordinator(on_infohash=discovered.append)
+        coordinator.handle((0, [b"a" * 20, b"b" * 20], {}))
+        coordinator.handle((1, [b"b" * 20, b"c" * 20], {}))
+
+        assert discovered == [b"a" * 20, b"b" * 20, b"c" * 20]
+        assert coordinator.stats["infohashes"] == 3
+
+    def test_forgets_least_recently_reported(self):
+        discovered = []
+        coordinator = Coordinator(on_infohash=discovered.append, max_infohashes=2)
+        coordinator.handle((0, [b"a" * 20, b"b" * 20], {}))
+        coordinator.handle((0, [b"a" * 20, b"c" * 20], {}))
+        coordinator.handle((1, [b"a" * 20, b"b" * 20], {}))
+
+        assert discovered == [b"a" * 20, b"b" * 20, b"c" * 20, b"b" * 20]
+        assert len(coordinator.infohashes) == 2
+
+    def test_stats(self):
+        coordinator = Coordinator()
+        coordinator.handle((0, [], {"routing_nodes": 10, "peers_hit_rate": 0.5}))
+        coordinator.handle((1, [], {"routing_nodes": 5, "peers_hit_rate": 1.0}))
+        # A newer report replaces the previous one of the worker
+        coordinator.handle((1, [], {"routing_nodes": 7, "peers_hit_rate": 1.0}))
+
+        stats = coordinator.stats
+        assert stats["workers"] == 2
+        assert stats["routing_nodes"] == 17
+        assert stats["peers_hit_rate"] == 0.75
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import random
+from collections import Counter
+from typing import Any
+from typing import Counter as CounterType
+from typing import Dict, Set
+
+from dhtpy.dht.crawl import SampleCrawler
+from dhtpy.dht.exceptions import QueryError, QueryTimeout
+from dhtpy.dht.structures import Node
+from dhtpy.dht.utils import join_nodes_compact_info
+
+
+class Network:
+    """Nodes that answer sample_infohashes with their infohashes and a
+    random sample of the nodes they know."""
+
+    def __init__(self, size: int, interval: int = 300):
+        self.nodes = [
+            Node(random.getrandbits(160), f"1.0.{i // 256}.{i % 256}", 6881)
+            for i in range(size)
+        ]
+        self.infohashes = {
+            node: [os.urandom(20) for _ in range(random.randint(0, 30))]
+            for node in self.nodes
+        }
+        self.interval = interval
+        self.offline: Set[Node] = set()
+        self.unsupported: Set[Node] = set()
+        self.queried: CounterType[Node] = Counter()
+
+    def query(self, node: Node, target: bytes) -> asyncio.Future:
+        self.queried[node] += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if node in self.offline:
+            future.set_exception(QueryTimeout(message="offline"))
+            return future
+        response: Dict[bytes, Any]
+        if node in self.unsupported:
+            response = {b"id": node.id_bytes}
+        else:
+            infohashes = self.infohashes[node]
+            response = {
+                b"id": node.id_bytes,
+                b"interval": self.interval,
+                b"num": len(infohashes),
+                b"samples": b"".join(
+                    random.sample(infohashes, min(20, len(infohashes)))
+                ),
+            }
+        response[b"nodes"] = join_nodes_compact_info(random.sample(self.nodes, 8))
+        loop.call_soon(future.set_result, {b"r": response})
+        return future
+
+    @property
+    def sampled(self):
+        """Infohashes a crawl can find, with a sample of 20 per node."""
+        return {
+            infohash
+            for node, infohashes in self.infohashes.items()
+            if node not in self.offline
+            and node not in self.unsupported
+            and len(infohashes) <= 20
+            for infohash in infohashes
+        }
+
+
+async def collect(crawler, duration=None):
+    if duration is not None:
+        asyncio.get_running_loop().call_later(duration, crawler.stop)
+    return [infohash async for infohash in crawler]
+
+
+class TestSampleCrawler:
+    def setup_method(self):
+        random.seed(0)
+        self.network = Network(200)
+
+    def crawler(self, seeds=4, **kwargs) -> SampleCrawler:
+        kwargs.setdefault("rate", 1e6)
+        return SampleCrawler(
+            random.sample(self.network.nodes, seeds), self.network.query, **kwargs
+        )
+
+    def test_walks_the_network(self):
+        crawler = self.crawler()
+        found = []
+        crawler.on_infohash = found.append
+        infohashes = asyncio.run(collect(crawler, duration=0.5))
+
+        assert infohashes == found
+        assert len(infohashes) == len(set(infohashes))
+        assert set(infohashes) >= self.network.sampled
+        assert set(self.network.queried) == set(self.network.nodes)
+        # Every node is visited once within its interval
+        assert max(self.network.queried.values()) == 1
+
+        stats = crawler.stats
+        assert stats["queries"] == stats["responses"] == len(self.network.nodes)
+        assert stats["infohashes"] == len(infohashes)
+        assert stats["samples"] >= len(infohashes)
+        assert stats["queries_per_second"] > 0
+        assert stats["infohashes_per_minute"] > 0
+
+    def test_revisits_after_interval(self):
+        self.network = Network(20, interval=0)
+        crawler = self.crawler(min_interval=0.1)
+        asyncio.run(collect(crawler, duration=0.35))
+        visits = [
+            self.network.queried[node]
+            for node in self.network.nodes
+            if self.network.infohashes[node]
+        ]
+        assert all(2 <= count <= 4 for count in visits)
+
+    def test_nodes_without_infohashes_wait_for_max_interval(self):
+        self.network = Network(20, interval=0)
+        for node in self.network.nodes:
+            self.network.infohashes[node] = []
+        crawler = self.crawler(min_interval=0.01, max_interval=10)
+        asyncio.run(collect(crawler, duration=0.2))
+        assert max(self.network.queried.values()) == 1
+
+    def test_unsupported_and_offline_nodes(self):
+        self.network = Network(50, interval=0)
+        self.network.unsupported = set(self.network.nodes[:10])
+        self.network.offline = set(self.network.nodes[10:20])
+        crawler = self.crawler(seeds=10, min_interval=0.05)
+        asyncio.run(collect(crawler, duration=0.3))
+
+        assert crawler.unsupported == sum(
+            self.network.queried[node] for node in self.network.unsupported
+        )
+        assert crawler.failures >= 1
+        # Both are forgotten, they are only queried again when another node
+        # returns them
+        scheduled = {node for _, _, node in crawler._schedule._heap}
+        assert not scheduled & (self.network.unsupported | self.network.offline)
+        assert crawler.stats["nodes"] < len(self.network.nodes)
+
+    def test_forgets_least_recently_useful_nodes(self):
+        self.network = Network(100, interval=0)
+        crawler = self.crawler(max_nodes=10, min_interval=10)
+        asyncio.run(collect(crawler, duration=0.2))
+
+        # New nodes keep being visited once max_nodes are tracked
+        assert set(self.network.queried) == set(self.network.nodes)
+        assert crawler.stats["nodes"] == 10
+
+    def test_stops_when_nothing_is_left(self):
+        self.network = Network(10)
+        self.network.offline = set(self.network.nodes)
+        crawler = self.crawler()
+        assert asyncio.run(collect(crawler)) == []
+        assert crawler.failures == crawler.queries == 4
+
+    def test_rate_and_concurrency(self):
+        crawler = self.crawler(rate=100, concurrency=2)
+        asyncio.run(collect(crawler, duration=0.3))
+        # Bursts of rate / 10 on top of the rate
+        assert crawler.queries <= 100 * 0.3 + 10 + 1
+
+    def test_errors_forget_the_node(self):
+        node = self.network.nodes[0]
+
+        def query(node, target):
+            future = asyncio.get_running_loop().create_future()
+            future.set_exception(QueryError(code=204, message="Method Unknown"))
+            return future
+
+        crawler = SampleCrawler([node], query)
+        asyncio.run(collect(crawler))
+        assert crawler.stats["nodes"] == 0
+
+    def test_forgets_least_recently_sampled(self):
+        self.network = Network(20, interval=0)
+        crawler = self.crawler(min_interval=0.05, max_infohashes=10)
+        infohashes = asyncio.run(collect(crawler, duration=0.2))
+
+        assert len(crawler.infohashes) == 10
+        # Forgotten infohashes are yielded again when sampled again
+        assert len(infohashes) > len(set(infohashes))
+        assert crawler.stats["infohashes"] == len(infohashes)
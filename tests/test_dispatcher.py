@@ -0,0 +1,171 @@
+import asyncio
+import os
+from typing import Any, Dict
+
+from dhtpy.dht.dispatcher import DHTDispatcher
+from dhtpy.dht.rpc import RPC
+
+ADDRESS = ("1.2.3.4", 6881)
+NID = os.urandom(20)
+NODES = os.urandom(26 * 2)
+
+
+class Recorder(DHTDispatcher):
+    def __init__(self, rpc):
+        super().__init__(rpc)
+        self.calls = []
+
+    def record(self, name, *args, **kwargs):
+        self.calls.append((name, args, kwargs))
+
+    def on_ping_query(self, *args, **kwargs):
+        self.record("on_ping_query", *args, **kwargs)
+
+    def on_find_node_query(self, *args, **kwargs):
+        self.record("on_find_node_query", *args, **kwargs)
+
+    def on_get_peers_query(self, *args, **kwargs):
+        self.record("on_get_peers_query", *args, **kwargs)
+
+    def on_announce_peer_query(self, *args, **kwargs):
+        self.record("on_announce_peer_query", *args, **kwargs)
+
+    def on_sample_infohashes_query(self, *args, **kwargs):
+        self.record("on_sample_infohashes_query", *args, **kwargs)
+
+    def on_ping_response(self, *args, **kwargs):
+        self.record("on_ping_response", *args, **kwargs)
+
+    def on_find_node_response(self, *args, **kwargs):
+        self.record("on_find_node_response", *args, **kwargs)
+
+    def on_get_peers_response(self, *args, **kwargs):
+        self.record("on_get_peers_response", *args, **kwargs)
+
+    def on_announce_peer_response(self, *args, **kwargs):
+        self.record("on_announce_peer_response", *args, **kwargs)
+
+    def on_sample_infohashes_response(self, *args, **kwargs):
+        self.record("on_sample_infohashes_response", *args, **kwargs)
+
+
+def query(q: bytes, **arguments: Any) -> Dict[bytes, Any]:
+    encoded = {key.encode(): value for key, value in arguments.items()}
+    return {b"t": b"aa", b"y": b"q", b"q": q, b"a": {b"id": NID, **encoded}}
+
+
+def response(**body: Any) -> Dict[bytes, Any]:
+    encoded = {key.encode(): value for key, value in body.items()}
+    return {b"t": b"aa", b"y": b"r", b"r": {b"id": NID, **encoded}}
+
+
+class TestDispatcher:
+    def setup_method(self):
+        self.rpc = RPC()
+        self.dispatcher = Recorder(self.rpc)
+
+    def dispatch(self, message, query=None):
+        self.dispatcher.on_response(message, ADDRESS, query)
+        return [name for name, _, _ in self.dispatcher.calls]
+
+    def test_queries(self):
+        for name in (
+            b"ping",
+            b"find_node",
+            b"get_peers",
+            b"announce_peer",
+            b"sample_infohashes",
+        ):
+            self.dispatcher.calls = []
+            assert self.dispatch(query(name)) == [f"on_{name.decode()}_query"]
+        node, data = self.dispatcher.calls[0][1]
+        assert node.id_bytes == NID
+        assert (node.address, node.port) == ADDRESS
+
+    def test_announce_port(self):
+        for arguments, port in (
+            ({"port": 1234}, 1234),
+            ({"port": 1234, "implied_port": 1}, ADDRESS[1]),
+            ({}, ADDRESS[1]),
+        ):
+            self.dispatcher.calls = []
+            self.dispatch(query(b"announce_peer", **arguments))
+            node, _, announced = self.dispatcher.calls[0][1]
+            # The node stays at the address the query came from
+            assert (node.address, node.port) == ADDRESS
+            assert announced == port
+
+    def test_announce_invalid_port_is_dropped(self):
+        for port in (0, 65536, b"1234"):
+            assert self.dispatch(query(b"announce_peer", port=port)) == []
+
+    def test_unknown_queries_are_ignored(self):
+        assert self.dispatch(query(b"vote")) == []
+        assert self.dispatch({b"t": b"aa", b"y": b"x", b"q": b"ping"}) == []
+
+    def test_responses_are_routed_by_their_query(self):
+        # Same shape, told apart by what was asked
+        assert self.dispatch(response(nodes=NODES), b"find_node") == [
+            "on_find_node_response"
+        ]
+        nodes = self.dispatcher.calls[0][1][1]
+        assert [node.compact_info for node in nodes] == [
+            NODES[:26],
+            NODES[26:],
+        ]
+
+        self.dispatcher.calls = []
+        assert self.dispatch(response(nodes=NODES), b"get_peers") == [
+            "on_get_peers_response"
+        ]
+        kwargs = self.dispatcher.calls[0][2]
+        assert (kwargs["token"], kwargs["values"], len(kwargs["nodes"])) == (
+            None,
+            [],
+            2,
+        )
+
+        self.dispatcher.calls = []
+        assert self.dispatch(response(), b"ping") == ["on_ping_response"]
+        self.dispatcher.calls = []
+        assert self.dispatch(response(), b"announce_peer") == [
+            "on_announce_peer_response"
+        ]
+
+    def test_sample_infohashes_response(self):
+        samples = os.urandom(20 * 3)
+        self.dispatch(
+            response(interval=300, nodes=NODES, num=42, samples=samples),
+            b"sample_infohashes",
+        )
+        kwargs = self.dispatcher.calls[0][2]
+        assert kwargs["samples"] == [samples[:20], samples[20:40], samples[40:]]
+        assert (kwargs["num"], kwargs["interval"], len(kwargs["nodes"])) == (
+            42,
+            300,
+            2,
+        )
+
+    def test_malformed_messages_are_dropped(self):
+        assert self.dispatch({b"t": b"aa", b"y": b"q", b"q": b"ping"}) == []
+        assert self.dispatch(response(nodes=12), b"find_node") == [
+            "on_find_node_response"
+        ]
+        assert self.dispatcher.calls[0][1][1] == []
+
+    def test_stopped(self):
+        self.dispatcher._running = False
+        assert self.dispatch(query(b"ping")) == []
+
+    def test_rpc_passes_the_query_of_the_transaction(self):
+        async def run():
+            self.rpc.send_message = lambda *args: True
+            future = self.rpc.sample_infohashes(NID, ADDRESS, NID)
+            (tid,) = self.rpc.transactions.pending
+            message = response(samples=b"", num=0, interval=0)
+            message[b"t"] = tid
+            self.rpc._on_message(message, ADDRESS)
+            await future
+
+        asyncio.run(run())
+        assert self.dispatcher.calls[0][0] == "on_sample_infohashes_response"
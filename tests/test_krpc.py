@@ -0,0 +1,149 @@
+import pytest
+
+from dhtpy.dht import krpc
+from dhtpy.dht.constants import MAX_MESSAGE_SIZE
+from dhtpy.dht.krpc import KRPCMessage, LazyDict
+
+NID = b"n" * 20
+PING = b"d1:ad2:id20:" + NID + b"e1:q4:ping1:t2:aa1:y1:qe"
+GET_PEERS_RESPONSE = (
+    b"d1:rd2:id20:" + NID + b"5:nodes26:" + b"x" * 26 + b"5:token4:tokn"
+    b"6:valuesl6:peer016:peer02ee1:t2:bb1:v4:LT011:y1:re"
+)
+ANNOUNCE = (
+    b"d1:ad2:id20:"
+    + NID
+    + b"12:implied_porti1e9:info_hash20:"
+    + b"h" * 20
+    + b"4:porti6881e5:token4:tokne1:q13:announce_peer1:t2:cc1:y1:qe"
+)
+ERROR = b"d1:eli201e12:Server Errore1:t2:dd1:y1:ee"
+
+
+@pytest.fixture
+def scanner(monkeypatch):
+    """Decodes with the scanner even when the C extension is available."""
+    monkeypatch.setattr(krpc, "ACCELERATED", False)
+
+
+class TestScan:
+    def test_query(self):
+        message = krpc.scan(PING)
+        assert list(message) == [b"a", b"q", b"t", b"y"]
+        assert isinstance(message[b"a"], LazyDict)
+        assert dict(message[b"a"]) == {b"id": NID}
+        assert (message[b"q"], message[b"t"], message[b"y"]) == (b"ping", b"aa", b"q")
+
+    def test_response(self):
+        message = krpc.scan(GET_PEERS_RESPONSE)
+        assert message[b"t"] == b"bb"
+        assert message[b"v"] == b"LT01"
+        assert dict(message[b"r"]) == {
+            b"id": NID,
+            b"nodes": b"x" * 26,
+            b"token": b"tokn",
+            b"values": [b"peer01", b"peer02"],
+        }
+
+    def test_integers_and_nested_values(self):
+        data = b"d1:ai-12e1:bli1e2:xyd1:ci0eeee"
+        message = krpc.scan(data)
+        assert message[b"a"] == -12
+        assert message[b"b"][:2] == [1, b"xy"]
+        assert dict(message[b"b"][2]) == {b"c": 0}
+
+    def test_long_strings(self):
+        payload = b"p" * 1200
+        message = krpc.scan(b"d7:samples1200:" + payload + b"e")
+        assert message[b"samples"] == payload
+
+    def test_values_are_decoded_once(self):
+        message = krpc.scan(GET_PEERS_RESPONSE)
+        assert message[b"r"][b"values"] is message[b"r"][b"values"]
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            b"d1:t3:aae",  # value shorter than its length
+            b"d1:t2:aa",  # missing end
+            b"d1:t2:aa1:y1:qeextra",  # trailing garbage
+            b"d1:ti1xe",  # not an integer
+            b"di1e1:ae",  # key is not a string
+            b"d1:tx:aae",  # bad string length
+            b"d1:ad2:id3:abce",  # missing end of the body
+            b"l1:ae",  # not a dictionary
+        ],
+    )
+    def test_malformed(self, data):
+        assert krpc.scan(data) is None
+
+    def test_deep_nesting_falls_back_to_full_decoder(self, monkeypatch):
+        data = b"d1:a" + b"l" * 10 + b"e" * 10 + b"e"
+        decoded = []
+        monkeypatch.setattr(krpc, "decode", lambda data: decoded.append(data) or {})
+        assert krpc.scan(data) == {}
+        assert decoded == [data]
+
+
+class TestParse:
+    def test_query(self, scanner):
+        message = krpc.parse(PING)
+        assert isinstance(message, KRPCMessage)
+        assert (message.t, message.y, message.q, message.id) == (
+            b"aa",
+            b"q",
+            b"ping",
+            NID,
+        )
+        assert message[b"a"][b"id"] == NID
+
+    def test_announce(self, scanner):
+        message = krpc.parse(ANNOUNCE)
+        assert message.q == b"announce_peer"
+        assert message[b"a"][b"port"] == 6881
+        assert message[b"a"][b"info_hash"] == b"h" * 20
+        assert message[b"a"].get(b"implied_port") == 1
+
+    def test_response(self, scanner):
+        message = krpc.parse(GET_PEERS_RESPONSE)
+        assert (message.t, message.y, message.q, message.id) == (
+            b"bb",
+            b"r",
+            None,
+            NID,
+        )
+        assert message.get(b"r")[b"token"] == b"tokn"
+
+    def test_error(self, scanner):
+        message = krpc.parse(ERROR)
+        assert (message.y, message.id) == (b"e", None)
+        assert message[b"e"] == [201, b"Server Error"]
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            b"",
+            b"le",
+            PING[:-1],
+            PING + b"e",
+            PING.replace(b"20:" + NID, b"3:abc"),  # short id
+            PING.replace(b"1:y1:q", b"1:y1:x"),  # unknown type
+            PING.replace(b"1:q4:ping", b"1:qi1e"),  # query name not a string
+            b"d1:t2:aa1:y1:re",  # response without a body
+            b"d1:e3:abc1:t2:dd1:y1:ee",  # error not a list
+        ],
+    )
+    def test_rejected(self, scanner, data):
+        assert krpc.parse(data) is None
+
+    def test_oversized(self, scanner):
+        padding = b"1:p%d:" % MAX_MESSAGE_SIZE + b"p" * MAX_MESSAGE_SIZE
+        assert krpc.parse(PING[:-1] + padding + b"e") is None
+
+    def test_accelerated(self, monkeypatch):
+        decoded = {b"t": b"aa", b"y": b"q", b"q": b"ping", b"a": {b"id": NID}}
+        monkeypatch.setattr(krpc, "ACCELERATED", True)
+        monkeypatch.setattr(krpc, "decode", lambda data: decoded)
+        message = krpc.parse(PING)
+        assert message.q == b"ping"
+        assert dict(message) == decoded
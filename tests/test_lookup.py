@@ -0,0 +1,130 @@
+import asyncio
+import random
+import struct
+from typing import Any, Dict, List, Set
+
+import pytest
+
+from dhtpy.dht.exceptions import QueryTimeout
+from dhtpy.dht.lookup import Lookup
+from dhtpy.dht.structures import Node
+from dhtpy.dht.utils import join_nodes_compact_info
+
+
+def peer(i: int) -> bytes:
+    return struct.pack("!IH", i, 6881)
+
+
+class Network:
+    """Nodes that answer get_peers with the closest nodes they know."""
+
+    def __init__(
+        self, size: int, target: bytes, peer_holders: int = 8, reply_size: int = 8
+    ):
+        self.nodes = [
+            Node(random.getrandbits(160), f"1.0.{i // 256}.{i % 256}", 6881)
+            for i in range(size)
+        ]
+        self.known = {node: random.sample(self.nodes, 32) for node in self.nodes}
+        self.target = target
+        self.closest = sorted(self.nodes, key=lambda n: n.nid ^ int(target.hex(), 16))
+        self.holders = set(self.closest[:peer_holders])
+        self.offline: Set[Node] = set()
+        self.reply_size = reply_size
+        self.queried: List[Node] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def query(self, node: Node) -> asyncio.Future:
+        self.queried.append(node)
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        future.add_done_callback(self.done)
+        if node in self.offline:
+            future.set_exception(QueryTimeout(message="offline"))
+            return future
+
+        # Every node knows its own neighborhood plus a random sample
+        known = set(self.known[node]) | set(self.closest_to(node, 16))
+        nodes = sorted(known, key=lambda n: n.nid ^ int(self.target.hex(), 16))
+        nodes = nodes[: self.reply_size]
+        response: Dict[bytes, Any] = {b"id": node.id_bytes, b"token": b"tk"}
+        response[b"nodes"] = join_nodes_compact_info(nodes)
+        if node in self.holders:
+            response[b"values"] = [peer(self.nodes.index(node)), peer(0)]
+        asyncio.get_running_loop().call_soon(future.set_result, {b"r": response})
+        return future
+
+    def done(self, future: asyncio.Future):
+        self.in_flight -= 1
+
+    def closest_to(self, node: Node, count: int):
+        return sorted(self.nodes, key=lambda n: n.nid ^ node.nid)[1 : count + 1]
+
+
+class TestLookup:
+    def setup_method(self):
+        random.seed(0)
+        self.target = random.getrandbits(160).to_bytes(20, "big")
+        self.network = Network(300, self.target)
+
+    def lookup(self, **kwargs) -> Lookup:
+        seeds = random.sample(self.network.nodes, 8)
+        return Lookup(self.target, seeds, self.network.query, **kwargs)
+
+    def test_converges_on_closest_nodes(self):
+        lookup = self.lookup()
+        closest = asyncio.run(lookup.run())
+
+        assert closest == self.network.closest[:8]
+        assert set(lookup.tokens) >= set(closest)
+        assert lookup.round_trips > 1
+        assert lookup.queries == lookup.responses
+        assert lookup.queries < len(self.network.nodes)
+
+    def test_yields_peers_once(self):
+        lookup = self.lookup()
+
+        async def collect():
+            return [peer async for peer in lookup]
+
+        peers = asyncio.run(collect())
+        assert len(peers) == len(set(peers))
+        assert peer(0) in peers
+        assert lookup.time_to_first_peer is not None
+        assert lookup.round_trips_to_first_peer <= lookup.round_trips
+
+    @pytest.mark.parametrize("alpha", [1, 3])
+    def test_alpha_bounds_queries_in_flight(self, alpha):
+        lookup = self.lookup(alpha=alpha)
+        asyncio.run(lookup.run())
+
+        assert self.network.max_in_flight == alpha
+        assert self.network.in_flight == 0
+
+    def test_failed_nodes_are_skipped(self):
+        # Nodes answering with their 8 closest would keep returning the
+        # offline ones and hide the nodes right after them
+        self.network.reply_size = 10
+        self.network.offline = set(self.network.closest[:2])
+        lookup = self.lookup()
+        closest = asyncio.run(lookup.run())
+
+        assert closest == self.network.closest[2:10]
+        assert lookup.failures >= 2
+
+    def test_deadline(self):
+        loop_futures = []
+
+        def never_answers(node):
+            future = asyncio.get_running_loop().create_future()
+            loop_futures.append(future)
+            return future
+
+        seeds = self.network.nodes[:8]
+        lookup = Lookup(self.target, seeds, never_answers, alpha=3, timeout=0.05)
+        assert asyncio.run(lookup.run()) == []
+        assert lookup.timed_out
+        assert lookup.queries == 3
+        assert lookup.elapsed >= 0.05
@@ -0,0 +1,538 @@
+import asyncio
+import hashlib
+import os
+from types import SimpleNamespace
+
+import better_bencode  # type: ignore
+import pytest
+from better_bencode import _pure  # type: ignore
+
+from dhtpy.bittorrent import metadata
+from dhtpy.bittorrent.constants import BT_PROTOCOL_PREFIX
+from dhtpy.bittorrent.metadata import (
+    FetchScheduler,
+    MetadataFetcher,
+    MetadataWorker,
+    StagedWorker,
+    StageStats,
+)
+from dhtpy.bittorrent.protocol import MetadataProtocol
+from dhtpy.bittorrent.reputation import PeerReputation
+from dhtpy.bittorrent.seen import SeenFilter
+
+A, B, C = b"a" * 20, b"b" * 20, b"c" * 20
+
+
+def peer(i: int):
+    return (f"10.0.0.{i}", 6881)
+
+
+class TestFetchScheduler:
+    @pytest.fixture(autouse=True)
+    def fake_fetch(self, monkeypatch):
+        self.now = 0.0
+        # (infohash, peer) to the future the fake fetch waits for and to its
+        # worker, connecting until connect is called
+        self.connections = {}
+        self.workers = {}
+        self.done = []
+
+        async def fetch_metadata(
+            infohash,
+            peer_address,
+            max_metadata_size,
+            on_worker_done=None,
+            worker_class=None,
+            on_worker_started=None,
+        ):
+            future = asyncio.get_running_loop().create_future()
+            self.connections[infohash, peer_address] = future
+            worker = SimpleNamespace(stage=metadata.STAGE_CONNECT)
+            self.workers[infohash, peer_address] = worker
+            if on_worker_started is not None:
+                on_worker_started(worker)
+            return await future
+
+        monkeypatch.setattr(metadata, "fetch_metadata", fetch_metadata)
+        # Only the clock of the scheduler, the event loop keeps the real one
+        monkeypatch.setattr(
+            metadata, "time", SimpleNamespace(monotonic=lambda: self.now)
+        )
+
+    def scheduler(self, **kwargs) -> FetchScheduler:
+        scheduler = FetchScheduler(**kwargs)
+        scheduler.on_done = lambda infohash, data: self.done.append((infohash, data))
+        return scheduler
+
+    def open(self):
+        return sorted(
+            key for key, future in self.connections.items() if not future.done()
+        )
+
+    def connect(self, infohash, peer_address):
+        self.workers[infohash, peer_address].stage = metadata.STAGE_HANDSHAKE
+
+    async def finish(self, infohash, peer_address, result=None):
+        self.connections[infohash, peer_address].set_result(result)
+        # Let the fetch task and its done callback run
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+    def run(self, test):
+        async def main():
+            await test()
+            # Cancelling a fetch starts the next one queued
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            while tasks:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                tasks = asyncio.all_tasks() - {asyncio.current_task()}
+
+        asyncio.run(main())
+
+    def test_connection_budget(self):
+        scheduler = self.scheduler(max_connections=2)
+
+        async def test():
+            for i, infohash in enumerate((A, B, C)):
+                assert scheduler.submit(infohash, peer(i))
+            await asyncio.sleep(0)
+            assert self.open() == [(A, peer(0)), (B, peer(1))]
+            assert scheduler.stats["queue_depth"] == 1
+
+            await self.finish(A, peer(0))
+            assert self.open() == [(B, peer(1)), (C, peer(2))]
+            assert self.done == [(A, None)]
+            assert scheduler.stats["connections"] == 2
+
+        self.run(test)
+
+    def test_per_ip_budget(self):
+        scheduler = self.scheduler(max_connections_per_ip=1)
+
+        async def test():
+            scheduler.submit(A, peer(1))
+            scheduler.submit(B, ("10.0.0.1", 7000))
+            scheduler.submit(C, peer(2))
+            await asyncio.sleep(0)
+            assert self.open() == [(A, peer(1)), (C, peer(2))]
+
+            await self.finish(A, peer(1))
+            assert self.open() == [(B, ("10.0.0.1", 7000)), (C, peer(2))]
+
+        self.run(test)
+
+    def test_infohashes_announced_by_more_peers_go_first(self):
+        scheduler = self.scheduler(max_connections=1)
+
+        async def test():
+            scheduler.submit(A, peer(0))
+            scheduler.submit(B, peer(1))
+            for i in range(2, 5):
+                scheduler.submit(C, peer(i))
+            # Announcing again does not count
+            scheduler.submit(B, peer(1))
+            await asyncio.sleep(0)
+            assert self.open() == [(A, peer(0))]
+
+            await self.finish(A, peer(0))
+            assert self.open() == [(C, peer(2))]
+            assert scheduler.stats["dropped_peers"] == 1
+
+        self.run(test)
+
+    def test_per_infohash_budget_and_retries(self):
+        scheduler = self.scheduler(max_connections_per_infohash=2, stagger=0)
+
+        async def test():
+            for i in range(3):
+                scheduler.submit(A, peer(i))
+            await asyncio.sleep(0)
+            assert self.open() == [(A, peer(0)), (A, peer(1))]
+
+            await self.finish(A, peer(0))
+            assert self.open() == [(A, peer(1)), (A, peer(2))]
+
+            await self.finish(A, peer(1))
+            await self.finish(A, peer(2))
+            assert self.done == [(A, None)]
+            assert A not in scheduler
+
+        self.run(test)
+
+    def test_metadata_cancels_the_other_connections(self):
+        scheduler = self.scheduler(max_connections_per_infohash=3, stagger=0)
+
+        async def test():
+            for i in range(3):
+                scheduler.submit(A, peer(i))
+            await asyncio.sleep(0)
+
+            await self.finish(A, peer(1), b"metadata")
+            assert self.done == [(A, b"metadata")]
+            assert self.open() == []
+            # Connections are released once the cancelled tasks finish
+            for _ in range(3):
+                await asyncio.sleep(0)
+            stats = scheduler.stats
+            assert stats["connections"] == 0
+            assert (stats["succeeded"], stats["cancelled"]) == (1, 2)
+            assert scheduler._connections_per_ip == {}
+
+        self.run(test)
+
+    def test_peers_race_after_the_stagger(self):
+        scheduler = self.scheduler(stagger=0.05)
+
+        async def test():
+            for i in range(3):
+                scheduler.submit(A, peer(i))
+            await asyncio.sleep(0)
+            assert self.open() == [(A, peer(0))]
+
+            self.now = 0.05
+            await asyncio.sleep(0.06)
+            assert self.open() == [(A, peer(0)), (A, peer(1))]
+
+            self.now = 0.08
+            await self.finish(A, peer(1), b"metadata")
+            stats = scheduler.stats
+            assert stats["average_time_to_metadata"] == pytest.approx(0.08)
+            assert stats["started"] == 2
+
+        self.run(test)
+
+    def test_connected_peers_are_not_raced(self):
+        scheduler = self.scheduler(stagger=0.05)
+
+        async def test():
+            for i in range(3):
+                scheduler.submit(A, peer(i))
+            await asyncio.sleep(0)
+            self.connect(A, peer(0))
+
+            self.now = 0.05
+            await asyncio.sleep(0.06)
+            assert self.open() == [(A, peer(0))]
+
+            # Raced again once it fails, the next one as it is still connecting
+            self.now = 0.2
+            await self.finish(A, peer(0))
+            assert self.open() == [(A, peer(1))]
+            self.now = 0.25
+            await asyncio.sleep(0.06)
+            assert self.open() == [(A, peer(1)), (A, peer(2))]
+
+        self.run(test)
+
+    def test_failures_do_not_wait_for_the_stagger(self):
+        scheduler = self.scheduler(stagger=10)
+
+        async def test():
+            for i in range(3):
+                scheduler.submit(A, peer(i))
+            await asyncio.sleep(0)
+            await self.finish(A, peer(0))
+            assert self.open() == [(A, peer(1))]
+            assert A in scheduler
+
+        self.run(test)
+
+    def test_peers_with_bad_reputation_are_skipped(self):
+        reputation = PeerReputation()
+        scheduler = self.scheduler(stagger=10, reputation=reputation)
+
+        async def test():
+            reputation.record(peer(0), "unsupported")
+            assert not scheduler.submit(A, peer(0))
+
+            scheduler.submit(A, peer(1))
+            scheduler.submit(A, peer(2))
+            await asyncio.sleep(0)
+            # Skipped though it was queued before it failed
+            reputation.record(peer(2), "unsupported")
+            await self.finish(A, peer(1))
+
+            assert self.done == [(A, None)]
+            stats = scheduler.stats
+            assert stats["started"] == 1
+            assert stats["reputation_avoided"] == 2
+
+        self.run(test)
+
+    def test_outcomes_feed_the_reputation(self):
+        reputation = PeerReputation()
+        scheduler = self.scheduler(reputation=reputation)
+        worker = MetadataWorker(A, peer(0))
+        worker.fail("refused")
+        scheduler._on_worker_done(worker)
+        # Cancelled before it got anywhere
+        scheduler._on_worker_done(MetadataWorker(A, peer(1)))
+
+        assert reputation.stats == {
+            "peers": 1,
+            "avoided": 0,
+            "successes": 0,
+            "failures_refused": 1,
+        }
+
+    def test_full_queue_drops_new_infohashes(self):
+        scheduler = self.scheduler(max_connections=1, max_queued=1)
+
+        async def test():
+            assert scheduler.submit(A, peer(0))
+            assert scheduler.submit(B, peer(1))
+            assert not scheduler.submit(C, peer(2))
+            # Infohashes already queued still take new peers
+            assert scheduler.submit(B, peer(3))
+            assert scheduler.stats["dropped_full"] == 1
+
+        self.run(test)
+
+    def test_waiting_too_long_drops_infohashes(self):
+        scheduler = self.scheduler(max_connections=1, max_wait=10)
+
+        async def test():
+            scheduler.submit(A, peer(0))
+            scheduler.submit(B, peer(1))
+            await asyncio.sleep(0)
+            self.now = 5
+            assert scheduler.stats["oldest_wait"] == 5
+            self.now = 11
+            scheduler.submit(C, peer(2))
+
+            assert self.done == [(B, None)]
+            assert B not in scheduler
+            stats = scheduler.stats
+            assert stats["dropped_expired"] == 1
+            assert stats["queue_depth"] == 1
+
+            self.now = 12
+            await self.finish(A, peer(0))
+            assert self.open() == [(C, peer(2))]
+            assert scheduler.stats["average_wait"] == pytest.approx(0.5)
+
+        self.run(test)
+
+
+METADATA = _pure.dumps({b"name": b"test", b"pieces": b"x" * 40_000})
+INFOHASH = hashlib.sha1(METADATA).digest()
+PIECE_SIZE = 2 ** 14
+
+
+def frame(message: bytes) -> bytes:
+    return len(message).to_bytes(4, "big") + message
+
+
+class TestMetadataWorker:
+    @pytest.fixture(autouse=True)
+    def pure_bencode(self, monkeypatch):
+        for name in ("dumps", "loads", "load"):
+            monkeypatch.setattr(better_bencode, name, getattr(_pure, name))
+
+    @pytest.fixture(autouse=True, params=[MetadataWorker, MetadataProtocol])
+    def worker_class(self, request):
+        self.worker_class = request.param
+
+    async def serve(self, stage: str):
+        """Fake peer answering up to the given stage, then going silent."""
+
+        async def on_connection(reader, writer):
+            await reader.readexactly(68)
+            if stage == "handshake":
+                return
+            prefix = BT_PROTOCOL_PREFIX
+            if stage == "unsupported":
+                # No extension protocol bit
+                prefix = prefix[:25] + b"\x00" + prefix[26:]
+            writer.write(prefix + INFOHASH + b"-XX0000-000000000000")
+            # A keep alive and a bitfield longer than the receive buffer
+            # before the extension handshake
+            writer.write(frame(b""))
+            writer.write(frame(bytes([5]) + b"\xff" * 100_000))
+            if stage == "extended_handshake":
+                return
+            writer.write(
+                frame(
+                    bytes([20, 0])
+                    + _pure.dumps(
+                        {b"m": {b"ut_metadata": 3}, b"metadata_size": len(METADATA)}
+                    )
+                )
+            )
+            if stage == "pieces":
+                return
+
+            while True:
+                length = int.from_bytes(await reader.readexactly(4), "big")
+                message = await reader.readexactly(length)
+                if message[:2] != bytes([20, 3]):
+                    # Our extension handshake
+                    continue
+                request = _pure.loads(message[2:])
+                piece = request[b"piece"]
+                if stage == "rejected":
+                    reject = {b"msg_type": 2, b"piece": piece}
+                    writer.write(frame(bytes([20, 1]) + _pure.dumps(reject)))
+                    continue
+                header = _pure.dumps(
+                    {b"msg_type": 1, b"piece": piece, b"total_size": len(METADATA)}
+                )
+                data = METADATA[piece * PIECE_SIZE : (piece + 1) * PIECE_SIZE]
+                if stage == "truncated":
+                    data = data[:-1]
+                message = frame(bytes([20, 1]) + header + data)
+                # Messages are received in pieces
+                for i in range(0, len(message), 5000):
+                    writer.write(message[i : i + 5000])
+                    await writer.drain()
+                    await asyncio.sleep(0.001)
+
+        server = await asyncio.start_server(on_connection, "127.0.0.1", 0)
+        self.server = server
+        return server.sockets[0].getsockname()[:2]
+
+    def work(self, stage: str, **timeouts) -> MetadataWorker:
+        async def main():
+            address = await self.serve(stage)
+            worker = self.worker_class(INFOHASH, address, **timeouts)
+            self.result = await worker.work()
+            self.server.close()
+            await self.server.wait_closed()
+            return worker
+
+        return asyncio.run(main())
+
+    def test_fetch(self):
+        worker = self.work("complete")
+        assert self.result == METADATA
+        assert worker.failure is None
+        assert set(worker.durations) == {
+            "connect",
+            "handshake",
+            "extended_handshake",
+            "pieces",
+        }
+
+    @pytest.mark.parametrize("stage", ["handshake", "extended_handshake", "pieces"])
+    def test_silent_peers_are_abandoned_at_their_stage(self, stage):
+        timeouts = {
+            "handshake_timeout": 0.2,
+            "extended_handshake_timeout": 0.2,
+            "piece_timeout": 0.2,
+        }
+        worker = self.work(stage, **timeouts)
+        assert self.result is None
+        assert (worker.stage, worker.failure) == (stage, "timeout")
+        assert stage not in worker.durations
+
+    @pytest.mark.parametrize(
+        "failure, stage",
+        [("unsupported", "handshake"), ("rejected", "pieces")],
+    )
+    def test_useless_peers(self, failure, stage):
+        worker = self.work(failure, piece_timeout=5)
+        assert self.result is None
+        assert (worker.stage, worker.failure) == (stage, failure)
+
+    def test_truncated_pieces(self):
+        worker = self.work("truncated", piece_timeout=0.2)
+        assert self.result is None
+        # MetadataProtocol checks the size of every piece, MetadataWorker
+        # only the hash of the metadata
+        failure = "invalid" if self.worker_class is MetadataProtocol else "timeout"
+        assert (worker.stage, worker.failure) == ("pieces", failure)
+
+    def test_connection_refused(self):
+        async def main():
+            address = await self.serve("complete")
+            self.server.close()
+            await self.server.wait_closed()
+            worker = self.worker_class(INFOHASH, address)
+            assert await worker.work() is None
+            return worker
+
+        worker = asyncio.run(main())
+        assert (worker.stage, worker.failure) == ("connect", "refused")
+
+    def test_connect_timeout(self, monkeypatch):
+        async def connect(*args):
+            await asyncio.sleep(10)
+
+        async def main():
+            asyncio.get_running_loop().create_connection = connect
+            return await worker.work()
+
+        monkeypatch.setattr(metadata.asyncio, "open_connection", connect)
+        worker = self.worker_class(INFOHASH, ("10.0.0.1", 6881), connect_timeout=0.05)
+        assert asyncio.run(main()) is None
+        assert (worker.stage, worker.failure) == ("connect", "timeout")
+
+    def test_stage_stats(self):
+        stats = StageStats()
+        stats.record(self.work("complete"))
+        stats.record(self.work("pieces", piece_timeout=0.1))
+
+        stats = stats.stats
+        assert stats["connect_completed"] == 2
+        assert stats["pieces_completed"] == 1
+        assert stats["pieces_timeout"] == 1
+        assert stats["connect_seconds"] > 0
+
+    def test_workers_implement_work(self):
+        with pytest.raises(TypeError):
+            StagedWorker(INFOHASH, ("10.0.0.1", 6881))  # type: ignore[abstract]
+
+
+class TestMetadataFetcher:
+    @pytest.fixture(autouse=True)
+    def fake_fetch(self, monkeypatch):
+        self.requests = []
+
+        async def fetch_metadata(
+            infohash,
+            peer_address,
+            max_metadata_size,
+            on_worker_done=None,
+            worker_class=None,
+            on_worker_started=None,
+        ):
+            self.requests.append(infohash)
+            await asyncio.sleep(0)
+            return b"metadata"
+
+        monkeypatch.setattr(metadata, "fetch_metadata", fetch_metadata)
+
+    def run(self, fetcher, announces):
+        async def main():
+            for infohash in announces:
+                fetcher.fetch(infohash, peer(1))
+                await asyncio.sleep(0.01)
+
+        asyncio.run(main())
+
+    def test_fetched_infohashes_are_skipped(self):
+        results = []
+        fetcher = MetadataFetcher(
+            lambda infohash, data: results.append(infohash),
+            seen=SeenFilter(capacity=100),
+        )
+        popular, other = os.urandom(20), os.urandom(20)
+        self.run(fetcher, [popular, other, popular, popular])
+
+        assert self.requests == [popular, other]
+        assert results == [popular, other]
+        stats = fetcher.stats
+        assert stats["fetched"] == 2
+        assert stats["saved"] == 2
+        assert stats["seen_infohashes"] == 2
+
+    def test_without_filter(self):
+        fetcher = MetadataFetcher()
+        popular = os.urandom(20)
+        self.run(fetcher, [popular, popular])
+
+        assert self.requests == [popular, popular]
+        stats = fetcher.stats
+        assert (stats["fetched"], stats["saved"], stats["fetches"]) == (2, 0, 0)
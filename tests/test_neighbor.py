@@ -0,0 +1,143 @@
+import asyncio
+import os
+import random
+from types import SimpleNamespace
+from typing import Any, Dict
+
+from better_bencode import _pure  # type: ignore
+
+from dhtpy.dht import neighbor
+from dhtpy.dht.neighbor import NeighborCrawler
+from dhtpy.dht.structures import Node
+
+NID = os.urandom(20)
+
+
+def random_node(i: int) -> Node:
+    return Node(random.getrandbits(160), f"1.0.{i // 256}.{i % 256}", 6881)
+
+
+class TestNeighborCrawler:
+    def setup_method(self):
+        random.seed(0)
+        self.crawler = NeighborCrawler(max_nodes=10, max_infohashes=3, nid=NID)
+        self.sent = []
+        self.queries = []
+        self.crawler.rpc.send_encoded = lambda node, message: self.sent.append(
+            (node, _pure.loads(message))
+        )
+        self.crawler.rpc.find_node = lambda nid, node, target: self.queries.append(
+            (nid, node)
+        )
+        self.node = random_node(0)
+
+    def query(self, q: bytes, **arguments: Any):
+        encoded = {key.encode(): value for key, value in arguments.items()}
+        message: Dict[bytes, Any] = {b"t": b"aa", b"y": b"q", b"q": q}
+        message[b"a"] = {b"id": self.node.id_bytes, **encoded}
+        self.crawler.on_response(message, (self.node.address, self.node.port))
+
+    def test_replies_as_a_neighbor(self):
+        self.query(b"ping")
+        self.query(b"find_node", target=os.urandom(20))
+        for node, reply in self.sent:
+            nid = reply[b"r"][b"id"]
+            assert nid[:15] == self.node.id_bytes[:15]
+            assert nid[15:] == NID[:5]
+            assert node == self.node
+
+    def test_captures_get_peers(self):
+        infohashes = []
+        self.crawler.on_infohash = infohashes.append
+        infohash = os.urandom(20)
+        self.query(b"get_peers", info_hash=infohash)
+        self.query(b"get_peers", info_hash=infohash)
+        self.query(b"get_peers", info_hash=b"short")
+
+        assert infohashes == [infohash]
+        assert self.crawler.get_peers == 2
+        # Replies carry a token so the node announces to us
+        assert all(b"token" in reply[b"r"] for _, reply in self.sent)
+
+    def test_captures_announces(self):
+        announces = []
+        self.crawler.on_announce = lambda *args: announces.append(args)
+        infohash = os.urandom(20)
+        self.query(b"announce_peer", info_hash=infohash, port=1234, token=b"x")
+        assert announces == [(infohash, self.node.address, 1234)]
+        assert self.crawler.announces == self.crawler.infohashes == 1
+
+    def test_remembers_a_bounded_number_of_infohashes(self):
+        infohashes = [os.urandom(20) for _ in range(5)]
+        for infohash in infohashes + infohashes[:1]:
+            self.query(b"get_peers", info_hash=infohash)
+        # The first one was forgotten and reported again
+        assert self.crawler.infohashes == 6
+        assert list(self.crawler._infohashes) == infohashes[3:] + infohashes[:1]
+
+    def test_nodes_are_bounded_and_queried_oldest_first(self):
+        nodes = [random_node(i) for i in range(1, 16)]
+        self.crawler.on_find_node_response(b"aa", nodes + nodes[-3:])
+        assert self.crawler.stats["nodes"] == 10
+        assert self.crawler.nodes_seen == 15
+
+        async def tick():
+            self.crawler.queries_per_second = 40
+            self.crawler._tick()
+            self.crawler._tick_timer.cancel()
+
+        asyncio.run(tick())
+        assert [node for _, node in self.queries] == nodes[5:9]
+        for nid, node in self.queries:
+            assert nid[:15] == node.id_bytes[:15]
+        assert self.crawler.queries == 4
+        assert self.crawler.stats["nodes"] == 6
+
+    def test_bootstraps_without_nodes(self):
+        async def tick():
+            self.crawler._tick()
+            self.crawler._tick_timer.cancel()
+
+        asyncio.run(tick())
+        assert [node for _, node in self.queries] == neighbor.DHT_BOOTSTRAP_NODES
+
+    def test_bootstraps_within_the_rate(self, monkeypatch):
+        self.now = 0.0
+        monkeypatch.setattr(
+            neighbor, "time", SimpleNamespace(monotonic=lambda: self.now)
+        )
+        bootstrap_nodes = [("1.2.3.4", 6881), ("1.2.3.5", 6881), ("1.2.3.6", 6881)]
+        monkeypatch.setattr(neighbor, "DHT_BOOTSTRAP_NODES", bootstrap_nodes)
+        self.crawler.queries_per_second = 20
+
+        async def tick(now):
+            self.now = now
+            self.crawler._tick()
+            self.crawler._tick_timer.cancel()
+
+        # Two queries due per tick, the third router waits for the next time
+        asyncio.run(tick(0.0))
+        assert [node for _, node in self.queries] == bootstrap_nodes[:2]
+
+        # Not asked again until BOOTSTRAP_INTERVAL has passed
+        for now in (0.1, 1.0, self.crawler.BOOTSTRAP_INTERVAL - 0.1):
+            asyncio.run(tick(now))
+        assert len(self.queries) == 2
+        asyncio.run(tick(self.crawler.BOOTSTRAP_INTERVAL))
+        assert [node for _, node in self.queries[2:]] == bootstrap_nodes
+
+    def test_reports_capture_rates(self):
+        reports = []
+        self.crawler.on_report = reports.append
+
+        async def report():
+            self.crawler._last_report = (neighbor.time.monotonic() - 2, 0, 0, 0)
+            for _ in range(4):
+                self.query(b"get_peers", info_hash=os.urandom(20))
+            self.crawler._report()
+            self.crawler._report_timer.cancel()
+
+        asyncio.run(report())
+        assert 1.9 < reports[0]["get_peers_per_second"] <= 2
+        assert reports[0]["infohashes_per_second"] == reports[0]["get_peers_per_second"]
+        assert reports[0]["announces_per_second"] == 0
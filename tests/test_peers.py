@@ -0,0 +1,61 @@
+import time
+
+from dhtpy.dht.peers import PeerStore
+
+
+def peer(i: int) -> bytes:
+    return bytes([1, 2, 3, i]) + (6881).to_bytes(2, "big")
+
+
+class TestPeerStore:
+    def setup_method(self):
+        self.store = PeerStore(max_entries=5, ttl=60)
+        self.infohash = bytes(20)
+        self.another_infohash = bytes(19) + b"\x01"
+
+    def test_add_and_get(self):
+        self.store.add(self.infohash, peer(1))
+        self.store.add(self.infohash, peer(2))
+        self.store.add(self.infohash, peer(1))
+
+        assert self.store.get(self.infohash) == [peer(1), peer(2)]
+        assert self.store.get(self.infohash, limit=1) == [peer(1)]
+        assert len(self.store) == 2
+
+    def test_hit_rate(self):
+        self.store.add(self.infohash, peer(1))
+        self.store.get(self.infohash)
+        self.store.get(self.another_infohash)
+
+        assert self.store.stats["hits"] == 1
+        assert self.store.stats["misses"] == 1
+        assert self.store.stats["hit_rate"] == 0.5
+        assert self.store.stats["memory_usage"] > 0
+
+    def test_evicts_least_recently_announced(self):
+        for i in range(3):
+            self.store.add(self.infohash, peer(i))
+        for i in range(2):
+            self.store.add(self.another_infohash, peer(i))
+        # Announced again, now the most recent infohash
+        self.store.add(self.infohash, peer(3))
+
+        assert len(self.store) == 5
+        assert self.store.get(self.another_infohash) == [peer(1)]
+        assert self.store.stats["evictions"] == 1
+
+    def test_expiry(self):
+        self.store.add(self.infohash, peer(1))
+        self.store.add(self.infohash, peer(2))
+        self.store.add(self.another_infohash, peer(1))
+        self.store._peers[self.infohash][peer(1)] = time.monotonic() - 1
+
+        assert self.store.get(self.infohash) == [peer(2)]
+        assert len(self.store) == 2
+
+        for peers in self.store._peers.values():
+            for compact_peer in peers:
+                peers[compact_peer] = time.monotonic() - 1
+        assert self.store.remove_expired() == 2
+        assert self.infohash not in self.store
+        assert len(self.store) == 0
@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from dhtpy.dht.ratelimit import (
+    PRIORITY_QUERY,
+    PRIORITY_RESPONSE,
+    SendScheduler,
+    TokenBucket,
+)
+
+ADDRESS = ("1.2.3.4", 6881)
+
+
+class TestTokenBucket:
+    def test_consume_and_refill(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        now = time.monotonic()
+        assert bucket.consume(1, now)
+        assert bucket.consume(1, now)
+        assert not bucket.consume(1, now)
+        assert abs(bucket.delay(1) - 0.1) < 1e-9
+        assert bucket.consume(1, now + 0.15)
+        # Never refills above capacity
+        assert not bucket.consume(3, now + 100)
+
+
+class TestSendScheduler:
+    def setup_method(self):
+        self.sent = []
+
+    def scheduler(self, **kwargs) -> SendScheduler:
+        return SendScheduler(
+            lambda data, address: self.sent.append(data), burst=0, **kwargs
+        )
+
+    def test_sends_right_away_within_budget(self):
+        scheduler = self.scheduler(packets_per_second=100)
+        assert scheduler.send(b"a", ADDRESS)
+        assert self.sent == [b"a"]
+        assert scheduler.queued == 0
+
+    def test_responses_before_queries(self):
+        async def run():
+            scheduler = self.scheduler(packets_per_second=1000)
+            for i in range(3):
+                scheduler.send(b"q%d" % i, ADDRESS, PRIORITY_QUERY)
+            scheduler.send(b"r", ADDRESS, PRIORITY_RESPONSE)
+            assert scheduler.stats["queued_queries"] == 2
+            assert scheduler.stats["queued_responses"] == 1
+            await asyncio.sleep(0.05)
+            return scheduler
+
+        scheduler = asyncio.run(run())
+        assert self.sent == [b"q0", b"r", b"q1", b"q2"]
+        assert scheduler.queued == 0
+
+    def test_bytes_per_second(self):
+        async def run():
+            scheduler = self.scheduler(bytes_per_second=100_000)
+            # The bucket starts with a single datagram worth of bytes
+            for _ in range(3):
+                scheduler.send(bytes(65536), ADDRESS)
+            return scheduler
+
+        scheduler = asyncio.run(run())
+        assert len(self.sent) == 1
+        assert scheduler.stats["queued_queries"] == 2
+
+    def test_full_queue_drops_queries_first(self):
+        async def run():
+            scheduler = self.scheduler(packets_per_second=1, max_queued=2)
+            scheduler.send(b"sent", ADDRESS)
+            scheduler.send(b"q1", ADDRESS)
+            scheduler.send(b"q2", ADDRESS)
+            assert not scheduler.send(b"q3", ADDRESS)
+            assert scheduler.send(b"r1", ADDRESS, PRIORITY_RESPONSE)
+            assert scheduler.send(b"r2", ADDRESS, PRIORITY_RESPONSE)
+            assert not scheduler.send(b"r3", ADDRESS, PRIORITY_RESPONSE)
+            return scheduler.stats
+
+        stats = asyncio.run(run())
+        assert stats["dropped_queries"] == 3
+        assert stats["dropped_responses"] == 1
+        assert stats["queued_responses"] == 2
+
+    def test_contexts_of_sent_and_dropped_datagrams(self):
+        async def run():
+            scheduler = self.scheduler(packets_per_second=1, max_queued=1)
+            scheduler.on_sent = sent.append
+            scheduler.on_dropped = dropped.append
+            scheduler.send(b"sent", ADDRESS, context="sent")
+            scheduler.send(b"q1", ADDRESS, context="q1")
+            assert not scheduler.send(b"q2", ADDRESS, context="q2")
+            scheduler.send(b"r1", ADDRESS, PRIORITY_RESPONSE)
+
+        sent, dropped = [], []
+        asyncio.run(run())
+        assert sent == ["sent"]
+        assert dropped == ["q1"]
+
+    def test_backoff_and_recovery(self):
+        async def run():
+            scheduler = self.scheduler(packets_per_second=1000)
+            scheduler.on_bandwidth_exhausted()
+            assert scheduler.rate_factor == 0.5
+            # Paused, the datagram waits
+            scheduler.send(b"a", ADDRESS)
+            assert self.sent == []
+            await asyncio.sleep(0.05)
+            assert self.sent == [b"a"]
+
+            scheduler._rate_changed -= scheduler.RECOVERY_INTERVAL + 1
+            scheduler.send(b"b", ADDRESS)
+            return scheduler
+
+        scheduler = asyncio.run(run())
+        assert scheduler.rate_factor == 0.5 + scheduler.RECOVERY_STEP
+        assert scheduler.stats["backoffs"] == 1
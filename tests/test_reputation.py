@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import pytest
+
+from dhtpy.bittorrent import reputation
+from dhtpy.bittorrent.reputation import PeerReputation
+
+PEER = ("1.2.3.4", 6881)
+
+
+class TestPeerReputation:
+    def setup_method(self):
+        self.now = 0.0
+        self.reputation = PeerReputation(max_peers=3, half_life=60, threshold=2)
+
+    @pytest.fixture(autouse=True)
+    def clock(self, monkeypatch):
+        monkeypatch.setattr(
+            reputation, "time", SimpleNamespace(monotonic=lambda: self.now)
+        )
+
+    def test_failures_add_up(self):
+        assert self.reputation.allows(PEER)
+        self.reputation.record(PEER, "refused")
+        assert self.reputation.allows(PEER)
+        self.reputation.record(PEER, "timeout")
+        assert not self.reputation.allows(PEER)
+        assert not self.reputation.allows(PEER)
+
+        stats = self.reputation.stats
+        assert stats["avoided"] == 2
+        assert stats["failures_refused"] == stats["failures_timeout"] == 1
+
+    def test_peers_without_ut_metadata_are_skipped_at_once(self):
+        self.reputation.record(PEER, "unsupported")
+        assert not self.reputation.allows(PEER)
+        assert self.reputation.allows(("1.2.3.4", 6882))
+
+    def test_scores_decay(self):
+        self.reputation.record(PEER, "refused")
+        self.reputation.record(PEER, "refused")
+        self.now = 60
+        assert self.reputation.score(PEER) == pytest.approx(1)
+        assert self.reputation.allows(PEER)
+
+        # The decayed score is what the next penalty adds to
+        self.reputation.record(PEER, "refused")
+        assert self.reputation.score(PEER) == pytest.approx(2)
+        self.now = 180
+        assert self.reputation.score(PEER) == pytest.approx(0.5)
+
+    def test_successes_clear_the_score(self):
+        self.reputation.record(PEER, "refused")
+        self.reputation.record(PEER, None)
+        assert self.reputation.score(PEER) == 0
+        self.reputation.record(PEER, "refused")
+        assert self.reputation.allows(PEER)
+        assert self.reputation.stats["successes"] == 1
+
+    def test_least_recently_seen_peers_are_forgotten(self):
+        peers = [(f"10.0.0.{i}", 6881) for i in range(4)]
+        for peer in peers[:3]:
+            self.reputation.record(peer, "unsupported")
+        self.reputation.record(peers[0], "refused")
+        self.reputation.record(peers[3], "refused")
+
+        assert len(self.reputation) == 3
+        assert self.reputation.allows(peers[1])
+        assert not self.reputation.allows(peers[0])
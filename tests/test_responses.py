@@ -0,0 +1,148 @@
+import os
+from typing import Any, Dict
+
+import pytest
+from better_bencode import _pure  # type: ignore
+
+from dhtpy.dht.responses import ResponseBuilder
+from dhtpy.dht.server import Server
+from dhtpy.dht.structures import Node
+
+NID = os.urandom(20)
+# Same output as the C extension behind bencoding.encode
+encode = _pure.dumps
+
+
+def reply(tid: bytes, **body: Any) -> bytes:
+    arguments: Dict[bytes, Any] = {b"id": NID}
+    arguments.update((key.encode(), value) for key, value in body.items())
+    return encode({b"t": tid, b"y": b"r", b"r": arguments})
+
+
+class TestResponseBuilder:
+    def setup_method(self):
+        self.responses = ResponseBuilder(NID)
+
+    @pytest.mark.parametrize("tid", [b"", b"a", b"aa", os.urandom(4), b"x" * 12])
+    def test_ping(self, tid):
+        assert self.responses.ping(tid) == reply(tid)
+
+    @pytest.mark.parametrize("count", [0, 1, 8])
+    def test_find_node(self, count):
+        nodes = os.urandom(26 * count)
+        assert self.responses.find_node(b"aa", nodes) == reply(b"aa", nodes=nodes)
+
+    @pytest.mark.parametrize("count", [1, 2, 50])
+    def test_get_peers(self, count):
+        values = [os.urandom(6) for _ in range(count)]
+        token = os.urandom(2)
+        assert self.responses.get_peers(b"aa", token, values) == reply(
+            b"aa", token=token, values=values
+        )
+
+    def test_get_peers_mixed_lengths(self):
+        values = [os.urandom(6), os.urandom(18)]
+        assert self.responses.get_peers(b"aa", b"tk", values) == reply(
+            b"aa", token=b"tk", values=values
+        )
+
+    def test_sample_infohashes(self):
+        nodes, samples = os.urandom(26 * 8), os.urandom(20 * 20)
+        assert self.responses.sample_infohashes(
+            b"aa", 300, nodes, 1000, samples
+        ) == reply(b"aa", interval=300, nodes=nodes, num=1000, samples=samples)
+
+
+class TestServerReplies:
+    def setup_method(self):
+        self.server = Server(nid=NID)
+        self.sent = []
+        self.server.send_encoded = lambda node, message: self.sent.append(message)
+
+    def test_ping(self):
+        node = self.server.node
+        self.server.on_ping_query(node, {b"t": b"aa", b"a": {b"id": NID}})
+        assert self.sent == [reply(b"aa")]
+
+    def test_get_peers_with_peers(self):
+        infohash = os.urandom(20)
+        self.server.peer_store.add(infohash, b"p" * 6)
+        self.server.on_get_peers_query(
+            self.server.node, {b"t": b"aa", b"a": {b"info_hash": infohash}}
+        )
+        message = _pure.loads(self.sent[0])
+        assert self.sent[0] == reply(
+            b"aa", token=message[b"r"][b"token"], values=[b"p" * 6]
+        )
+
+    def test_get_peers_without_peers(self):
+        self.server.on_get_peers_query(
+            self.server.node, {b"t": b"aa", b"a": {b"info_hash": os.urandom(20)}}
+        )
+        message = _pure.loads(self.sent[0])
+        assert self.sent[0] == reply(b"aa", nodes=b"", token=message[b"r"][b"token"])
+        assert self.server.tokens.check(
+            message[b"r"][b"token"], self.server.node.compact_info[20:24]
+        )
+
+    @pytest.mark.parametrize(
+        "q, key",
+        [
+            (b"find_node", b"target"),
+            (b"get_peers", b"info_hash"),
+            (b"sample_infohashes", b"target"),
+        ],
+    )
+    @pytest.mark.parametrize("length", [0, 19, 21, 40])
+    def test_ids_of_another_length_are_ignored(self, q, key, length):
+        for _ in range(100):
+            self.server.routing_table.add(Node.create_random("1.2.3.4", 6881))
+        query = {b"t": b"aa", b"y": b"q", b"q": q}
+        query[b"a"] = {b"id": NID, key: os.urandom(length)}
+        self.server.on_response(query, ("1.2.3.4", 6881))
+        assert self.sent == []
+
+    def test_sample_infohashes(self):
+        infohashes = [os.urandom(20) for _ in range(30)]
+        for infohash in infohashes:
+            self.server.peer_store.add(infohash, b"p" * 6)
+        query = {b"t": b"aa", b"a": {b"id": NID, b"target": NID}}
+        self.server.on_sample_infohashes_query(self.server.node, query)
+        self.server.on_sample_infohashes_query(self.server.node, query)
+
+        message = _pure.loads(self.sent[0])
+        samples = message[b"r"][b"samples"]
+        assert message[b"r"][b"num"] == 30
+        assert len(samples) == 20 * 20
+        assert {samples[i : i + 20] for i in range(0, 400, 20)} <= set(infohashes)
+        # Samples are kept until the interval is over
+        assert _pure.loads(self.sent[1])[b"r"][b"samples"] == samples
+        assert self.sent[0] == reply(
+            b"aa",
+            interval=message[b"r"][b"interval"],
+            nodes=b"",
+            num=30,
+            samples=samples,
+        )
+
+    def test_announce_needs_a_token_of_the_querier(self):
+        infohash = os.urandom(20)
+        querier = Node(os.urandom(20), "1.2.3.4", 6881)
+        another = Node(os.urandom(20), "1.2.3.5", 6881)
+        self.server.peer_store.add(infohash, b"p" * 6)
+        self.server.on_get_peers_query(
+            querier, {b"t": b"aa", b"a": {b"info_hash": infohash}}
+        )
+        token = _pure.loads(self.sent[0])[b"r"][b"token"]
+
+        for node, announced in ((querier, b"tk"), (another, token), (querier, token)):
+            self.server.on_announce_peer_query(
+                node,
+                {b"t": b"aa", b"a": {b"info_hash": infohash, b"token": announced}},
+                1234,
+            )
+        assert set(self.server.peer_store.get(infohash)) == {
+            b"p" * 6,
+            querier.compact_info[20:24] + (1234).to_bytes(2, "big"),
+        }
+        assert self.server.stats["tokens_rejected"] == 2
@@ -1,4 +1,11 @@
-from dhtpy.dht.routing import RoutingTable
+import asyncio
+import time
+
+import pytest
+
+from dhtpy.dht.constants import NODE_UNHEARD_TIMEOUT
+from dhtpy.dht.routing import MAX_NID, RoutingTable
+from dhtpy.dht.snapshot import SnapshotError
 from dhtpy.dht.structures import Node
 
 
@@ -35,3 +42,229 @@ class TestRoutingTable:
             "0000000000000000000000000000000000000000"
         )
         assert closest_nodes == nodes[:-1]
+
+    def test_bucket_index(self):
+        routing_table = RoutingTable(nid=0)
+        assert routing_table.bucket_index(1 << 159) == 0
+
+        for _ in range(3):
+            routing_table.split(routing_table.buckets[-1])
+
+        assert routing_table.bucket_index(1 << 159) == 0
+        assert routing_table.bucket_index(1 << 158) == 1
+        assert routing_table.bucket_index(1 << 157) == 2
+        assert routing_table.bucket_index(1) == 3
+
+    def test_split_keeps_own_id_in_last_bucket(self):
+        routing_table = RoutingTable(nid=0)
+        assert routing_table.split(routing_table.buckets[0])
+        assert routing_table.buckets[-1].in_range(0)
+        assert routing_table.buckets[0].in_range(1 << 159)
+
+        # Only the last bucket can be split
+        assert not routing_table.split(routing_table.buckets[0])
+
+    def test_add_random_nodes(self):
+        own = Node.create_random("1.2.3.4", 1234)
+        routing_table = RoutingTable(own.nid)
+        nodes = [Node.create_random("1.2.3.4", 1234) for _ in range(500)]
+        added = [node for node in nodes if routing_table.add(node)]
+
+        assert all(node in routing_table for node in added)
+        for index, bucket in enumerate(routing_table.buckets):
+            assert len(bucket.nodes) <= bucket.capacity
+            for node in bucket.nodes:
+                assert routing_table.bucket_index(node.nid) == index
+
+    def test_add_max_id(self):
+        node = Node(MAX_NID, "1.2.3.4", 1234)
+        assert self.routing_table.add(node)
+        assert node in self.routing_table
+        assert len(self.routing_table.buckets) == 1
+
+    def test_max_id_goes_to_the_bucket_covering_it(self):
+        own = Node.create_random("1.2.3.4", 1234)
+        routing_table = RoutingTable(own.nid)
+        for _ in range(500):
+            routing_table.add(Node.create_random("1.2.3.4", 1234))
+        node = Node(MAX_NID, "1.2.3.4", 1234)
+        routing_table.add(node)
+
+        bucket = routing_table.buckets[routing_table.bucket_index(MAX_NID)]
+        assert bucket.in_range(MAX_NID)
+        assert node in bucket.nodes or node in bucket.replacements
+        for index, bucket in enumerate(routing_table.buckets):
+            assert all(bucket.in_range(node.nid) for node in bucket.nodes)
+            assert all(bucket.in_range(node.nid) for node in bucket.replacements)
+
+    def test_get_closest_nodes_matches_full_sort(self):
+        own = Node.create_random("1.2.3.4", 1234)
+        routing_table = RoutingTable(own.nid, bucket_size=4)
+        for _ in range(2000):
+            routing_table.add(Node.create_random("1.2.3.4", 1234))
+        nodes = routing_table.nodes
+
+        for target in [own.nid, own.nid ^ 1, own.nid ^ (1 << 159)] + [
+            Node.create_random("", 0).nid for _ in range(20)
+        ]:
+            expected = sorted(nodes, key=lambda node: node.nid ^ target)[:8]
+            assert routing_table.get_closest_nodes(target) == expected
+
+    def test_get_closest_nodes_accepts_raw_ids(self):
+        node = Node.create_random("1.2.3.4", 1234)
+        self.routing_table.add(node)
+        assert self.routing_table.get_closest_nodes(node.id_bytes) == [node]
+        assert self.routing_table.get_closest_nodes(node.id) == [node]
+
+    def test_expire(self):
+        nodes = [Node.create_random("1.2.3.4", 1234) for _ in range(3)]
+        for node in nodes:
+            self.routing_table.add(node)
+        now = nodes[-1].last_contact
+
+        assert self.routing_table.expire(now + 10 * 60) == []
+        assert sorted(self.routing_table.expire(now + 16 * 60), key=id) == sorted(
+            nodes, key=id
+        )
+        # Already reported as questionable
+        assert self.routing_table.expire(now + 17 * 60) == []
+
+        # One of them answered the ping
+        self.routing_table.add(Node(nodes[0].id, "1.2.3.4", 1234))
+        nodes[0].last_contact = now + 17 * 60
+
+        assert self.routing_table.expire(now + 21 * 60) == []
+        assert nodes[0] in self.routing_table
+        assert nodes[1] not in self.routing_table
+        assert nodes[2] not in self.routing_table
+        assert self.routing_table.expire(now + 33 * 60) == [nodes[0]]
+
+    def test_expire_skips_removed_nodes(self):
+        node = Node.create_random("1.2.3.4", 1234)
+        self.routing_table.add(node)
+        assert self.routing_table.remove(node)
+
+        assert self.routing_table.expire(node.last_contact + 16 * 60) == []
+        assert self.routing_table.next_deadline is None
+
+    def test_add_refreshes_stored_node(self):
+        node = Node.create_random("1.2.3.4", 1234)
+        self.routing_table.add(node)
+        node.last_contact -= 60
+
+        self.routing_table.add(Node(node.id, "1.2.3.4", 1234))
+        assert node.last_contact > time.monotonic() - 60
+
+    def test_replacement_promoted_on_removal(self):
+        routing_table = RoutingTable(nid=0, bucket_size=2, replacement_cache_size=2)
+        # All in the far half of the table, which cannot be split
+        routing_table.split(routing_table.buckets[0])
+        nodes = [Node((1 << 159) + i, "1.2.3.4", 1234) for i in range(5)]
+        for node in nodes:
+            routing_table.add(node)
+
+        bucket = routing_table.buckets[0]
+        assert list(bucket.nodes) == nodes[:2]
+        # Oldest candidate dropped when the cache is over capacity
+        assert list(bucket.replacements) == nodes[3:]
+
+        # Seen again, now the most recent candidate
+        routing_table.add(Node(nodes[3].id, "1.2.3.4", 1234))
+        assert list(bucket.replacements) == [nodes[4], nodes[3]]
+
+        assert routing_table.remove(nodes[0])
+        assert nodes[3] in routing_table
+        assert routing_table.remove(nodes[1])
+        assert routing_table.remove(nodes[3])
+        assert routing_table.stats["replacement_hits"] == 2
+        assert routing_table.stats["replacement_misses"] == 1
+
+    def test_split_promotes_replacements(self):
+        routing_table = RoutingTable(nid=0, bucket_size=2)
+        bucket = routing_table.buckets[0]
+        near = [Node(i + 1, "1.2.3.4", 1234) for i in range(2)]
+        far = Node(1 << 159, "1.2.3.4", 1234)
+        for node in near:
+            routing_table.add(node)
+        bucket.add_replacement(far)
+
+        assert routing_table.split(bucket)
+        assert far in routing_table
+        assert all(node in routing_table for node in near)
+
+    def test_dump_and_load(self):
+        own = Node.create_random("1.2.3.4", 1234)
+        routing_table = RoutingTable(own.nid)
+        for _ in range(200):
+            routing_table.add(Node.create_random("1.2.3.4", 1234))
+        node = next(iter(routing_table.nodes))
+        node.last_contact -= 300
+
+        restored = RoutingTable.load(routing_table.dump())
+
+        assert restored.nid == own.nid
+        assert len(restored) == len(routing_table)
+        assert restored.nodes == routing_table.nodes
+        assert restored.buckets == routing_table.buckets
+        restored_node = restored.buckets[restored.bucket_index(node.nid)].nodes[node]
+        assert abs(restored_node.last_contact - node.last_contact) < 2
+        assert len(restored._deadlines) == len(routing_table)
+
+    def test_load_builds_buckets_when_used(self):
+        own = Node.create_random("1.2.3.4", 1234)
+        routing_table = RoutingTable(own.nid)
+        for _ in range(200):
+            routing_table.add(Node.create_random("1.2.3.4", 1234))
+        node = next(iter(routing_table.buckets[0].nodes))
+
+        restored = RoutingTable.load(routing_table.dump())
+        assert all(not bucket.nodes for bucket in restored.buckets)
+        assert len(restored) == len(routing_table)
+        assert not restored.is_empty
+        assert len(restored.sample(8)) == 8
+        assert all(not bucket.nodes for bucket in restored.buckets)
+
+        assert node in restored
+        assert restored.buckets[0].nodes and not restored.buckets[0].restored
+        assert not restored.buckets[1].nodes
+
+        # Entries of buckets never built are carried over to the next snapshot
+        assert RoutingTable.load(restored.dump()).nodes == routing_table.nodes
+
+    def test_load_builds_buckets_going_questionable(self):
+        routing_table = RoutingTable(0)
+        node = Node(1 << 159, "1.2.3.4", 1234)
+        routing_table.add(node)
+        node.last_contact -= NODE_UNHEARD_TIMEOUT - 60
+
+        restored = RoutingTable.load(routing_table.dump())
+        assert restored.expire(time.monotonic() + 30) == []
+        assert restored.buckets[0].restored
+        assert restored.expire(time.monotonic() + 90) == [node]
+
+    def test_dump_skips_hostname_nodes(self):
+        self.routing_table.add(
+            Node(Node.create_random("1.2.3.4", 1).nid, "dht.example.com", 6881)
+        )
+        self.routing_table.add(Node.create_random("1.2.3.4", 1234))
+
+        restored = RoutingTable.load(self.routing_table.dump())
+        assert len(restored) == 1
+        assert next(iter(restored.nodes)).address == "1.2.3.4"
+
+    def test_save_and_load_file(self, tmp_path):
+        path = str(tmp_path / "routing_table")
+        for _ in range(50):
+            self.routing_table.add(Node.create_random("1.2.3.4", 1234))
+
+        asyncio.run(self.routing_table.save(path))
+
+        restored = RoutingTable.load_file(path)
+        assert restored.nodes == self.routing_table.nodes
+
+    def test_load_invalid_snapshot(self):
+        with pytest.raises(SnapshotError):
+            RoutingTable.load(b"not a snapshot")
+
+        with pytest.raises(SnapshotError):
+            RoutingTable.load(self.routing_table.dump()[:-1] + b"\x00" * 30)
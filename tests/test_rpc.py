@@ -0,0 +1,177 @@
+import asyncio
+
+import better_bencode  # type: ignore
+import pytest
+from better_bencode import _pure  # type: ignore
+
+from dhtpy.dht.exceptions import QueryDropped, QueryError, QueryTimeout
+from dhtpy.dht.ratelimit import PRIORITY_RESPONSE, SendScheduler
+from dhtpy.dht.rpc import RPC
+
+ADDRESS = ("1.2.3.4", 6881)
+NID = bytes(20)
+
+
+class TestRPC:
+    @pytest.fixture(autouse=True)
+    def pure_bencode(self, monkeypatch):
+        for name in ("dumps", "loads", "load"):
+            monkeypatch.setattr(better_bencode, name, getattr(_pure, name))
+
+    def setup_method(self):
+        self.rpc = RPC(query_timeout=0.05)
+        self.sent = []
+        self.received = []
+        self.rpc.scheduler._send = self.capture
+        self.rpc.on_response = lambda message, address, query: self.received.append(
+            (message, query)
+        )
+
+    def capture(self, data: bytes, address):
+        self.sent.append((_pure.loads(data), address))
+
+    def limit(self, **kwargs):
+        """Replaces the send scheduler with one sending a single datagram at
+        once."""
+        scheduler = SendScheduler(self.capture, burst=0, **kwargs)
+        scheduler.on_sent = self.rpc.transactions.start
+        scheduler.on_dropped = self.rpc.transactions.drop
+        self.rpc.scheduler = scheduler
+
+    def respond(self, data: dict, address=ADDRESS):
+        self.rpc._on_message(data, address)
+
+    def test_query_resolved_by_response(self):
+        async def run():
+            future = self.rpc.ping_node(NID, ADDRESS)
+            query, address = self.sent[0]
+            assert address == ADDRESS
+            assert query[b"q"] == b"ping"
+
+            response = {b"t": query[b"t"], b"y": b"r", b"r": {b"id": NID}}
+            self.respond(response)
+            return await future
+
+        response = asyncio.run(run())
+        assert response[b"r"][b"id"] == NID
+        assert self.received == [(response, b"ping")]
+        assert self.rpc.transactions.rtt(ADDRESS) is not None
+        assert not self.rpc.transactions.pending
+
+    def test_unique_tids(self):
+        async def run():
+            for _ in range(100):
+                self.rpc.ping_node(NID, ADDRESS)
+
+        asyncio.run(run())
+        assert len({query[b"t"] for query, _ in self.sent}) == 100
+
+    def test_stray_and_spoofed_responses_dropped(self):
+        async def run():
+            future = self.rpc.ping_node(NID, ADDRESS)
+            tid = self.sent[0][0][b"t"]
+            self.respond({b"t": b"zz", b"y": b"r", b"r": {b"id": NID}})
+            self.respond({b"t": tid, b"y": b"r", b"r": {b"id": NID}}, ("5.6.7.8", 1))
+            assert not future.done()
+
+        asyncio.run(run())
+        assert self.received == []
+        assert self.rpc.transactions.stats["unmatched"] == 2
+
+    def test_timeout(self):
+        async def run():
+            with pytest.raises(QueryTimeout):
+                await self.rpc.find_node(NID, ADDRESS, NID)
+
+        asyncio.run(run())
+        assert self.rpc.transactions.stats["timed_out"] == 1
+        assert not self.rpc.transactions.pending
+
+    def test_error_response(self):
+        async def run():
+            future = self.rpc.get_peers(NID, ADDRESS, NID)
+            tid = self.sent[0][0][b"t"]
+            self.respond({b"t": tid, b"y": b"e", b"e": [203, b"Protocol Error"]})
+            with pytest.raises(QueryError) as error:
+                await future
+            assert error.value.code == 203
+            assert error.value.message == "Protocol Error"
+
+        asyncio.run(run())
+
+    def test_dropped_queries_fail_at_once(self):
+        async def run():
+            self.limit(packets_per_second=1, max_queued=1)
+            sent = self.rpc.ping_node(NID, ADDRESS)
+            queued = self.rpc.ping_node(NID, ADDRESS)
+            dropped = self.rpc.ping_node(NID, ADDRESS)
+            with pytest.raises(QueryDropped):
+                await dropped
+            assert len(self.rpc.transactions.pending) == 2
+
+            # A response takes the place of the queued query
+            self.rpc.send_encoded(ADDRESS, b"response", PRIORITY_RESPONSE)
+            with pytest.raises(QueryDropped):
+                await queued
+            assert not sent.done()
+
+        asyncio.run(run())
+        assert len(self.sent) == 1
+        assert self.rpc.transactions.stats["dropped"] == 2
+        assert self.rpc.transactions.stats["sent"] == 1
+
+    def test_clock_starts_when_sent(self):
+        async def run():
+            self.limit(packets_per_second=10)
+            first = self.rpc.ping_node(NID, ADDRESS)
+            second = self.rpc.ping_node(NID, ADDRESS)
+            await asyncio.sleep(0.08)
+            # The first one timed out, the second one is still queued
+            assert first.done() and not second.done()
+            assert len(self.sent) == 1
+            with pytest.raises(QueryTimeout):
+                await second
+
+        asyncio.run(run())
+        assert len(self.sent) == 2
+
+
+class TestSharedPort:
+    @pytest.fixture(autouse=True)
+    def pure_bencode(self, monkeypatch):
+        for name in ("dumps", "loads", "load"):
+            monkeypatch.setattr(better_bencode, name, getattr(_pure, name))
+
+    def test_queries_go_out_of_a_port_of_their_own(self):
+        class Remote(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, address):
+                sources.append(address)
+                query = _pure.loads(data)
+                self.transport.sendto(
+                    _pure.dumps({b"t": query[b"t"], b"y": b"r", b"r": {b"id": NID}}),
+                    address,
+                )
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            transport, _ = await loop.create_datagram_endpoint(
+                Remote, local_addr=("127.0.0.1", 0)
+            )
+            rpc = RPC()
+            await rpc.start("127.0.0.1", 0, reuse_port=True)
+            try:
+                remote = transport.get_extra_info("sockname")
+                response = await asyncio.wait_for(rpc.ping_node(NID, remote), 1)
+                shared = rpc.udp_node.transport.get_extra_info("sockname")
+                return response, shared
+            finally:
+                rpc.close()
+                transport.close()
+
+        sources = []
+        response, shared = asyncio.run(run())
+        assert response[b"r"][b"id"] == NID
+        assert sources[0][1] != shared[1]
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import tracemalloc
+
+import pytest
+
+from dhtpy.bittorrent import seen
+from dhtpy.bittorrent.seen import FilterError, SeenFilter
+
+
+def infohashes(count: int):
+    return [os.urandom(20) for _ in range(count)]
+
+
+class TestSeenFilter:
+    def setup_method(self):
+        self.now = 0.0
+
+    @pytest.fixture(autouse=True)
+    def clock(self, monkeypatch):
+        monkeypatch.setattr(seen.time, "monotonic", lambda: self.now)
+
+    def test_no_false_negatives(self):
+        seen_filter = SeenFilter(capacity=10_000, generations=1)
+        added = infohashes(10_000)
+        for infohash in added:
+            seen_filter.add(infohash)
+        assert all(infohash in seen_filter for infohash in added)
+        assert all(seen_filter.add(infohash) for infohash in added)
+        assert len(seen_filter) == seen_filter.added > 9_900
+
+    def test_false_positive_rate_is_bounded(self):
+        seen_filter = SeenFilter(capacity=20_000, error_rate=0.01, generations=4)
+        for infohash in infohashes(20_000):
+            seen_filter.add(infohash)
+
+        false_positives = sum(
+            infohash in seen_filter for infohash in infohashes(20_000)
+        )
+        assert false_positives / 20_000 < 0.02
+        assert seen_filter.false_positive_rate < 0.02
+        assert 0.4 < seen_filter.fill_ratio < 0.6
+
+    def test_short_keys(self):
+        seen_filter = SeenFilter(capacity=100)
+        seen_filter.add(b"abc")
+        assert b"abc" in seen_filter
+        assert b"abd" not in seen_filter
+
+    def test_full_generations_rotate(self):
+        seen_filter = SeenFilter(
+            capacity=300, error_rate=1e-6, generations=3, rotate_interval=None
+        )
+        first, second, third, fourth = (infohashes(100) for _ in range(4))
+        for infohash in first + second + third:
+            seen_filter.add(infohash)
+        assert seen_filter.stats["generations"] == 3
+        assert all(infohash in seen_filter for infohash in first)
+
+        for infohash in fourth:
+            seen_filter.add(infohash)
+        assert seen_filter.stats["generations"] == 3
+        assert seen_filter.rotations == 3
+        assert not any(infohash in seen_filter for infohash in first)
+        assert all(infohash in seen_filter for infohash in second + fourth)
+
+    def test_old_generations_decay(self):
+        seen_filter = SeenFilter(capacity=1000, generations=2, rotate_interval=60)
+        old = os.urandom(20)
+        seen_filter.add(old)
+
+        self.now = 60
+        seen_filter.add(os.urandom(20))
+        assert old in seen_filter
+
+        self.now = 120
+        seen_filter.add(os.urandom(20))
+        assert old not in seen_filter
+
+    def test_refresh_keeps_infohashes_seen(self):
+        seen_filter = SeenFilter(capacity=1000, generations=2, rotate_interval=60)
+        popular, forgotten = os.urandom(20), os.urandom(20)
+        seen_filter.add(popular)
+        seen_filter.add(forgotten)
+        assert not seen_filter.refresh(os.urandom(20))
+        assert len(seen_filter) == 2
+
+        for now in (60, 120, 180):
+            self.now = now
+            assert seen_filter.refresh(popular)
+        assert forgotten not in seen_filter
+        assert seen_filter.refreshed == 3
+        assert seen_filter.add(popular)
+
+    def test_dump_and_load(self, tmp_path):
+        seen_filter = SeenFilter(capacity=1000, generations=2, rotate_interval=60)
+        added = infohashes(200)
+        for infohash in added[:100]:
+            seen_filter.add(infohash)
+        self.now = 70
+        for infohash in added[100:]:
+            seen_filter.add(infohash)
+
+        path = str(tmp_path / "seen")
+        asyncio.run(seen_filter.save(path))
+        loaded = SeenFilter.load_file(
+            path, capacity=10, generations=2, rotate_interval=60
+        )
+
+        assert all(infohash in loaded for infohash in added)
+        assert loaded.hashes == seen_filter.hashes
+        assert loaded.stats["generations"] == 2
+        assert loaded.fill_ratio == seen_filter.fill_ratio
+
+        # Generations keep their age, the older one is dropped first
+        self.now = 130
+        loaded.add(os.urandom(20))
+        assert all(infohash not in loaded for infohash in added[:10])
+        assert all(infohash in loaded for infohash in added[100:])
+
+    def test_load_keeps_newest_generations(self):
+        seen_filter = SeenFilter(
+            capacity=200, error_rate=1e-6, generations=2, rotate_interval=None
+        )
+        added = infohashes(200)
+        for infohash in added:
+            seen_filter.add(infohash)
+
+        loaded = SeenFilter.load(seen_filter.dump(), generations=1)
+        assert loaded.stats["generations"] == 1
+        assert all(infohash in loaded for infohash in added[100:])
+
+    def test_load_allocates_the_dumped_generations_only(self):
+        data = SeenFilter(capacity=100).dump()
+        tracemalloc.start()
+        try:
+            loaded = SeenFilter.load(data)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # Far below a generation of the default capacity
+        assert peak < SeenFilter().size // 10
+        assert (
+            loaded.stats["bytes"] == len(data) - seen.HEADER.size - seen.GENERATION.size
+        )
+
+    @pytest.mark.parametrize(
+        "mutate",
+        [
+            lambda data: data[:10],
+            lambda data: b"X" + data[1:],
+            lambda data: data[:-1],
+            lambda data: data + b"\x00",
+        ],
+    )
+    def test_corrupt_dump(self, mutate):
+        data = SeenFilter(capacity=100).dump()
+        with pytest.raises(FilterError):
+            SeenFilter.load(mutate(data))
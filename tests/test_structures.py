@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+import time
 
 from dhtpy.dht.structures import Bucket, Node
 
@@ -27,32 +27,55 @@ class TestNode:
         assert distance == 1
 
     def test_is_unheard(self):
-        self.node.last_contact = datetime.now() - timedelta(minutes=10)
+        self.node.last_contact = time.monotonic() - 10 * 60
         assert not self.node.is_unheard
 
-        self.node.last_contact = datetime.now() - timedelta(minutes=15)
+        self.node.last_contact = time.monotonic() - 15 * 60
         assert self.node.is_unheard
 
-        self.node.last_contact = datetime.now() - timedelta(minutes=21)
+        self.node.last_contact = time.monotonic() - 21 * 60
         assert self.node.is_unheard
 
     def test_is_offline(self):
-        self.node.last_contact = datetime.now() - timedelta(minutes=14)
+        self.node.last_contact = time.monotonic() - 14 * 60
         assert not self.node.is_offline
 
-        self.node.last_contact = datetime.now() - timedelta(minutes=15)
+        self.node.last_contact = time.monotonic() - 15 * 60
         assert not self.node.is_offline
 
-        self.node.last_contact = datetime.now() - timedelta(minutes=20)
+        self.node.last_contact = time.monotonic() - 20 * 60
         assert self.node.is_offline
 
     def test_compact_info(self):
         self.node.id = "0000000000000000000000000000000000000001"
         assert (
             self.node.compact_info
-            == b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x010.0.\x04\xd2"
+            == b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00\x04\xd2"
         )
 
+    def test_compact_info_packs_address(self):
+        node = Node(self.node.id, "192.168.1.10", 6881)
+        assert node.compact_info[20:] == b"\xc0\xa8\x01\n\x1a\xe1"
+        assert len(node.compact_info) == 26
+
+    def test_from_compact(self):
+        node = Node("32f54e697351ff4aec29cdbaabf2fbe3467cc267", "1.2.3.4", 6881)
+        decoded = Node.from_compact(node.compact_info)
+        assert decoded == node
+        assert decoded.id == node.id
+        assert decoded.address == "1.2.3.4"
+        assert decoded.port == 6881
+
+    def test_id_views(self):
+        assert self.node.nid == 1
+        assert self.node.id_bytes == (1).to_bytes(20, "big")
+        assert Node(self.node.id_bytes, "0.0.0.0", 1234) == self.node
+
+    def test_hostname_address(self):
+        node = Node("1", "router.bittorrent.com", 6881)
+        assert node.address == "router.bittorrent.com"
+        assert node.id == "0000000000000000000000000000000000000001"
+
     def test_hash(self):
         assert hash(self.node)
 
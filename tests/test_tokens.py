@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+import pytest
+
+from dhtpy.dht import tokens
+from dhtpy.dht.tokens import TokenIssuer
+
+IP = bytes([1, 2, 3, 4])
+ANOTHER_IP = bytes([1, 2, 3, 5])
+
+
+class TestTokenIssuer:
+    @pytest.fixture(autouse=True)
+    def clock(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(tokens, "time", SimpleNamespace(monotonic=lambda: self.now))
+        self.tokens = TokenIssuer(interval=300)
+
+    def test_token_is_bound_to_the_ip(self):
+        token = self.tokens.issue(IP)
+
+        assert self.tokens.check(token, IP)
+        assert not self.tokens.check(token, ANOTHER_IP)
+        assert not self.tokens.check(b"tk", IP)
+        assert not self.tokens.check(1, IP)
+        assert self.tokens.stats == {"issued": 1, "accepted": 1, "rejected": 3}
+
+    def test_token_outlives_one_rotation(self):
+        token = self.tokens.issue(IP)
+
+        self.now += 400
+        assert self.tokens.check(token, IP)
+        assert self.tokens.issue(IP) != token
+
+        self.now += 300
+        assert not self.tokens.check(token, IP)
+
+    def test_idle_issuer_forgets_both_secrets(self):
+        token = self.tokens.issue(IP)
+
+        self.now += 600
+        assert not self.tokens.check(token, IP)
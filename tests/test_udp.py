@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from dhtpy.dht.udp import BatchedUDPNode, UDPNode
+
+pytestmark = pytest.mark.skipif(
+    not BatchedUDPNode.is_available(), reason="recvmmsg/sendmmsg not available"
+)
+
+
+def bound_address(node) -> tuple:
+    if isinstance(node, BatchedUDPNode):
+        assert node.socket is not None
+        return node.socket.getsockname()
+    return node.transport.get_extra_info("sockname")
+
+
+async def exchange(sender, receiver, count: int, size: int = 0):
+    received = []
+    receiver.on_data_received = lambda data, address: received.append((data, address))
+    await sender.start("127.0.0.1", 0)
+    await receiver.start("127.0.0.1", 0)
+    try:
+        destination = bound_address(receiver)
+        for i in range(count):
+            sender.send_message((b"%d" % i).ljust(size), destination)
+        for _ in range(100):
+            if len(received) == count:
+                break
+            await asyncio.sleep(0.01)
+        return received, bound_address(sender)
+    finally:
+        sender.close()
+        receiver.close()
+
+
+class TestBatchedUDPNode:
+    @pytest.mark.parametrize(
+        "sender,receiver",
+        [(BatchedUDPNode, BatchedUDPNode), (BatchedUDPNode, UDPNode)],
+    )
+    def test_sends_batches(self, sender, receiver):
+        received, source = asyncio.run(exchange(sender(), receiver(), 200))
+        assert [data for data, _ in received] == [b"%d" % i for i in range(200)]
+        assert all(address == source for _, address in received)
+
+    def test_receives_batches(self):
+        receiver = BatchedUDPNode(batch_size=16)
+        batches = []
+        receiver.on_batch_received = batches.append
+        asyncio.run(exchange(UDPNode(), receiver, 100))
+
+        assert sum(len(batch) for batch in batches) == 100
+        assert receiver.receive_calls < 100
+
+    def test_truncated_datagrams_are_dropped(self):
+        receiver = BatchedUDPNode(buffer_size=64)
+        received, _ = asyncio.run(exchange(BatchedUDPNode(), receiver, 2, size=65))
+        assert received == []
+        assert receiver.truncated == 2